@@ -51,6 +51,7 @@ from lib import brush
 from lib import helpers
 from lib import mypaintlib
 from lib import brushsettings
+from lib import tiledsurface
 import gui.device
 import filehandling
 import keyboard
@@ -432,6 +433,8 @@ class Application (object):
         self._apply_pressure_mapping_settings()
         self._apply_button_mapping_settings()
         self._apply_autosave_settings()
+        self._apply_render_settings()
+        self._apply_memory_settings()
         self.preferences_window.update_ui()
 
     def load_settings(self):
@@ -490,6 +493,11 @@ class Application (object):
             'document.autosave_backups': True,
             'document.autosave_interval': 10,
 
+            'display.render_threads': 0,  # auto: one per CPU
+            'memory.tile_budget_mb': 512,
+            'memory.undo_budget_mb': 256,
+            'memory.undo_min_steps': 10,
+
             'display.colorspace': "srgb",
             # sRGB is a good default even for OS X since v10.6 / Snow
             # Leopard: http://support.apple.com/en-us/HT3712.
@@ -615,6 +623,23 @@ class Application (object):
         model.autosave_backups = active
         model.autosave_interval = interval
 
+    def _apply_render_settings(self):
+        threads = self.preferences["display.render_threads"]
+        logger.debug("Applying render settings: threads=%r", threads)
+        self.doc.model.layer_stack.render_threads = threads
+
+    def _apply_memory_settings(self):
+        budget_mb = self.preferences["memory.tile_budget_mb"]
+        logger.debug("Applying memory settings: tile budget=%rMiB", budget_mb)
+        tiledsurface.tile_store.budget = int(budget_mb) * 1024 * 1024
+        cmdstack = self.doc.model.command_stack
+        undo_budget_mb = self.preferences["memory.undo_budget_mb"]
+        undo_min_steps = self.preferences["memory.undo_min_steps"]
+        logger.debug("Applying memory settings: undo budget=%rMiB, "
+                     "min steps=%r", undo_budget_mb, undo_min_steps)
+        cmdstack.memory_budget = int(undo_budget_mb) * 1024 * 1024
+        cmdstack.min_steps = undo_min_steps
+
     def save_gui_config(self):
         Gtk.AccelMap.save(join(self.user_confpath, 'accelmap.conf'))
         workspace = self.workspace
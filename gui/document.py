@@ -546,10 +546,19 @@ class Document (CanvasController):  # TODO: rename to "DocumentController"
         if len(stack.undo_stack) > 0:
             cmd = stack.undo_stack[-1]
             desc = _("Undo %s") % cmd.display_name
+            tooltip = _(
+                u"{undo_desc}\n"
+                u"History: {steps} steps, {mib:.1f} MiB"
+            ).format(
+                undo_desc=desc,
+                steps=len(stack.undo_stack),
+                mib=stack.memory_usage / (1024 * 1024),
+            )
         else:
             desc = _("Undo")  # Used when initializing the prefs dialog
+            tooltip = desc
         undo_action.set_label(desc)
-        undo_action.set_tooltip(desc)
+        undo_action.set_tooltip(tooltip)
 
         # Redo
         redo_action = ag.get_action("Redo")
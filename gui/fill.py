@@ -1,4 +1,5 @@
 # This file is part of MyPaint.
+# -*- coding: utf-8 -*-
 # Copyright (C) 2013 by Andrew Chadwick <a.t.chadwick@gmail.com>
 #
 # This program is free software; you can redistribute it and/or modify
@@ -10,6 +11,8 @@
 ## Imports
 from __future__ import division, print_function
 
+import time
+
 import gi
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -37,6 +40,9 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
     _CURSOR_FILL_PERMITTED = gui.cursor.Name.CROSSHAIR_OPEN_PRECISE
     _CURSOR_FILL_FORBIDDEN = gui.cursor.Name.ARROW_FORBIDDEN
 
+    #: Seconds before a long fill starts keeping the UI responsive
+    _PROGRESS_DELAY = 0.25
+
     ## Instance vars (and defaults)
 
     pointer_behavior = gui.mode.Behavior.PAINT_CONSTRAINED
@@ -47,6 +53,12 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
     _fill_permitted = True
     _x = None
     _y = None
+    _fill_started = None
+    _fill_cancelled = False
+    _fill_statusbar_cid = None
+    _fill_tdw = None
+    _fill_grab_widget = None
+    _fill_disabled_action_groups = ()
 
     @property
     def cursor(self):
@@ -87,6 +99,8 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
         If the current layer is not fillable, a new layer will always be
         created for the fill.
         """
+        if self._fill_started is not None:
+            return False  # still filling, via _fill_progress_cb()
         x, y = tdw.display_to_model(event.x, event.y)
         self._x = x
         self._y = y
@@ -98,13 +112,79 @@ class FloodFillMode (gui.mode.ScrollableModeMixin,
         rootstack = tdw.doc.layer_stack
         if not rootstack.current.get_fillable():
             make_new_layer = True
-        tdw.doc.flood_fill(x, y, color.get_rgb(),
-                           tolerance=opts.tolerance,
-                           sample_merged=opts.sample_merged,
-                           make_new_layer=make_new_layer)
+        self._fill_started = time.time()
+        self._fill_cancelled = False
+        self._fill_tdw = tdw
+        try:
+            tdw.doc.flood_fill(x, y, color.get_rgb(),
+                               tolerance=opts.tolerance,
+                               sample_merged=opts.sample_merged,
+                               make_new_layer=make_new_layer,
+                               progress_cb=self._fill_progress_cb)
+        finally:
+            self._fill_started = None
+            self._fill_tdw = None
+            self._end_fill_modality()
         opts.make_new_layer = False
         return False
 
+    def _fill_progress_cb(self, tiles_done, tiles_queued):
+        """Keeps the UI responsive during long fills
+
+        Pressing Escape while a fill is running cancels it. Nothing else
+        the user does may change the document, because the fill is
+        still in progress inside the command stack.
+        """
+        if time.time() - self._fill_started < self._PROGRESS_DELAY:
+            return True
+        if self._fill_statusbar_cid is None:
+            self._begin_fill_modality()
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        return not self._fill_cancelled
+
+    def _begin_fill_modality(self):
+        """Blocks input other than Escape while a long fill runs
+
+        All of the app's actions are made insensitive, which takes care
+        of menus, toolbar buttons and keyboard shortcuts, and a GTK grab
+        on the canvas keeps pointer events away from the other widgets.
+        """
+        app = self.doc.app
+        statusbar = app.statusbar
+        cid = statusbar.get_context_id("flood-fill-progress")
+        statusbar.push(cid, _(u"Filling… (press Escape to cancel)"))
+        self._fill_statusbar_cid = cid
+        disabled = []
+        for action_group in app.ui_manager.get_action_groups():
+            if action_group.get_sensitive():
+                action_group.set_sensitive(False)
+                disabled.append(action_group)
+        self._fill_disabled_action_groups = disabled
+        tdw = self._fill_tdw
+        tdw.grab_add()
+        self._fill_grab_widget = tdw
+
+    def _end_fill_modality(self):
+        """Restores normal input after _begin_fill_modality()"""
+        if self._fill_grab_widget is not None:
+            self._fill_grab_widget.grab_remove()
+            self._fill_grab_widget = None
+        for action_group in self._fill_disabled_action_groups:
+            action_group.set_sensitive(True)
+        self._fill_disabled_action_groups = ()
+        if self._fill_statusbar_cid is not None:
+            statusbar = self.doc.app.statusbar
+            statusbar.remove_all(self._fill_statusbar_cid)
+            self._fill_statusbar_cid = None
+
+    def key_press_cb(self, win, tdw, event):
+        if self._fill_started is not None:
+            if event.keyval == Gdk.KEY_Escape:
+                self._fill_cancelled = True
+            return True
+        return super(FloodFillMode, self).key_press_cb(win, tdw, event)
+
     def motion_notify_cb(self, tdw, event):
         """Track position, and update cursor"""
         x, y = tdw.display_to_model(event.x, event.y)
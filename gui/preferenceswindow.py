@@ -198,6 +198,11 @@ class PreferencesWindow (windowing.Dialog):
         autosave_interval_adj.set_value(autosave_interval)
         self._autosave_interval_spinbutton.set_sensitive(autosave)
 
+        # Rendering
+        render_threads = int(p["display.render_threads"])
+        render_threads_adj = getobj("render_threads_adjustment")
+        render_threads_adj.set_value(render_threads)
+
         self.in_update_ui = False
 
     ## Callbacks for widgets that manipulate settings
@@ -316,6 +321,13 @@ class PreferencesWindow (windowing.Dialog):
         interval = int(round(adj.get_value()))
         self.app.preferences["document.autosave_interval"] = interval
 
+    def render_threads_adjustment_value_changed_cb(self, adj):
+        if self.in_update_ui:
+            return
+        threads = int(round(adj.get_value()))
+        self.app.preferences["display.render_threads"] = threads
+        self.app.apply_settings()
+
     def smooth_scrolling_toggled_cb(self, checkbut):
         smoothsc = bool(checkbut.get_active())
         self.app.preferences["ui.support_smooth_scrolling"] = smoothsc
@@ -1116,6 +1116,7 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         # This also applies the transformation.
         transformation, surface, sparse, mipmap_level, clip_rect = \
             self._render_prepare(cr)
+        self._update_viewport_bbox(mipmap_level)
 
         # not sure if it is a good idea to clip so tightly
         # has no effect right now because device_bbox is always smaller
@@ -1161,6 +1162,22 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
 
         return True
 
+    def _update_viewport_bbox(self, mipmap_level):
+        """Tells the model which area a zoomed-out view is showing
+
+        The model regenerates dirty mipmap tiles in idle time, and it
+        does the ones in these areas first.
+
+        """
+        bbox = None
+        if mipmap_level > 0:
+            alloc = self.get_allocation()
+            w, h = alloc.width, alloc.height
+            corners = [(0, 0), (w, 0), (0, h), (w, h)]
+            corners = [self.display_to_model(x, y) for (x, y) in corners]
+            bbox = helpers.rotated_rectangle_bbox(corners)
+        self.doc.layer_stack.set_viewport_bbox(self, bbox)
+
     def _render_get_clip_region(self, cr, device_bbox):
         """Get the area that needs to be updated, in device coords.
 
@@ -70,7 +70,7 @@ class Autosaveable:
         be skipped.
 
         :param unicode oradir: Root of OpenRaster-like structure
-        :param lib.idletask.Processor taskproc: Output: queue of tasks
+        :param lib.workerpool.ThreadedProcessor taskproc: Output: queue of tasks
         :param set manifest: Output: files in data/ to retain afterward
         :param tuple bbox: frame bounding box, (x,y,w,h)
         :param \*\*kwargs: To be passed to underlying save routines.
@@ -89,14 +89,14 @@ class Autosaveable:
            which indexes its own files,
            and includes the XML elements from its children.
 
-        Auto-recovery saving needs to be split into small tasks so that
-        it doesn't interfere too much with foreground processing.
-        Individual PNG tile strips or small file copies have about the
-        right granularity.
+        Auto-recovery saving is split into small tasks, which are run
+        in a background thread. Individual PNG tile strips or small file
+        copies have about the right granularity: the queue can be
+        cancelled between any two calls.
 
-        It follows that snapshots should be used for auto-saving,
-        because the user can make changes between the queued tasks
-        as the queue is run.
+        It follows that snapshots must be used for auto-saving, because
+        the user can make changes while the queue is being run. Tasks
+        must not touch anything else which the main thread can change.
 
         The returned element should contain sub-elements for any
         sub-layers, and the queue operation should recursively call this
@@ -9,10 +9,31 @@
 from __future__ import division, print_function
 
 from collections import OrderedDict
+from collections import namedtuple
+
+
+LRUCacheStats = namedtuple(
+    "LRUCacheStats",
+    ["size", "capacity", "hits", "misses", "evictions", "invalidations"],
+)
 
 
 class LRUCache (object):
-    """Least-recently-used cache with dict-like usage"""
+    """Least-recently-used cache with dict-like usage
+
+    >>> cache = LRUCache(capacity=3)
+    >>> for i in range(4):
+    ...     cache[i] = str(i)
+    >>> 0 in cache
+    False
+    >>> cache.get(1), cache.get(0)
+    ('1', None)
+    >>> cache.invalidate(lambda k: k >= 2)
+    2
+    >>> cache.stats
+    LRUCacheStats(size=1, capacity=3, hits=1, misses=1, evictions=1, invalidations=2)
+
+    """
     # The idea for using an OrderedDict comes from Kun Xi:
     # http://www.kunxi.org/blog/2014/05/lru-cache-in-python/
 
@@ -23,6 +44,8 @@ class LRUCache (object):
         self._cache = OrderedDict()
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
 
     def __repr__(self):
         hitrate = 1.0
@@ -38,10 +61,46 @@ class LRUCache (object):
             missrate * 100,
         )
 
+    @property
+    def stats(self):
+        """Current usage statistics, as an LRUCacheStats tuple
+
+        Hits and misses are counted since construction, or since the
+        last call to `clear()`. Selective invalidations don't reset the
+        counters, so they can be used to measure how effective
+        invalidating only part of the cache is.
+        """
+        return LRUCacheStats(
+            len(self._cache),
+            self._capacity,
+            self._hits,
+            self._misses,
+            self._evictions,
+            self._invalidations,
+        )
+
     def clear(self):
         self._cache.clear()
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def invalidate(self, predicate):
+        """Removes every item whose key matches a predicate
+
+        :param callable predicate: called as predicate(key)
+        :returns: the number of items removed
+        :rtype: int
+
+        The order of the remaining items is unchanged, and the hit and
+        miss counters are retained.
+        """
+        doomed = [k for k in self._cache.iterkeys() if predicate(k)]
+        for key in doomed:
+            del self._cache[key]
+        self._invalidations += len(doomed)
+        return len(doomed)
 
     def __len__(self):
         return len(self._cache)
@@ -71,4 +130,18 @@ class LRUCache (object):
         except KeyError:
             while len(self._cache) >= self._capacity:
                 self._cache.popitem(last=False)
+                self._evictions += 1
         self._cache[key] = item
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
@@ -11,6 +11,7 @@
 from __future__ import division, print_function
 
 import lib.layer
+import lib.tiledsurface
 import helpers
 from observable import event
 import lib.stroke
@@ -27,14 +28,36 @@ logger = getLogger(__name__)
 
 
 class CommandStack (object):
-    """Undo/redo stack"""
+    """Undo/redo stack
 
-    MAXLEN = 30   # FIXME: dynamic size (psutil)?
+    The undo history is limited by the memory its commands retain for
+    layer data (see `Command.get_memory_usage()`), rather than just by
+    the number of steps: many small strokes can be kept, but only a few
+    flood fills of a huge layer.
 
-    def __init__(self, **kwargs):
+    If `spill_file` is set, older steps which don't fit in the budget
+    are moved there instead of being discarded (see `Command.spill()`).
+
+    """
+
+    #: Maximum number of undo steps, whatever their memory use.
+    MAXLEN = 200
+
+    #: Default minimum number of undo steps, whatever their memory use.
+    DEFAULT_MIN_STEPS = 10
+
+    #: Default memory budget for the undo history, in bytes.
+    DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 min_steps=DEFAULT_MIN_STEPS, **kwargs):
         super(CommandStack, self).__init__()
         self.undo_stack = []
         self.redo_stack = []
+        self._memory_budget = int(memory_budget)
+        self._min_steps = int(min_steps)
+        #: Where to move older steps' data (lib.tiledsurface.TileSpillFile)
+        self.spill_file = None
         self.stack_updated()
 
     def __repr__(self):
@@ -59,10 +82,13 @@ class CommandStack (object):
 
         This operation adds a new command to the undo stack after
         calling its redo() method to perform the work it represents.
-        It also trims the undo stack.
+        It also trims the undo stack. If the command was cancelled
+        while it was being performed, nothing is changed.
         """
-        self._discard_redo()
         command.redo()
+        if command.cancelled:
+            return
+        self._discard_redo()
         self.undo_stack.append(command)
         self.reduce_undo_history()
         self.stack_updated()
@@ -96,17 +122,88 @@ class CommandStack (object):
         self.stack_updated()
         return command
 
+    @property
+    def memory_budget(self):
+        """Memory budget for the undo history, in bytes
+
+        Setting this trims the undo stack if needed.
+        """
+        return self._memory_budget
+
+    @memory_budget.setter
+    def memory_budget(self, budget):
+        self._memory_budget = max(0, int(budget))
+        self._trim_and_notify()
+
+    @property
+    def min_steps(self):
+        """Number of undo steps kept even if over the memory budget
+
+        Setting this trims the undo stack if needed.
+        """
+        return self._min_steps
+
+    @min_steps.setter
+    def min_steps(self, n):
+        self._min_steps = max(1, int(n))
+        self._trim_and_notify()
+
+    @property
+    def memory_usage(self):
+        """Estimated memory retained by the undo stack, in bytes"""
+        return sum(c.get_memory_usage() for c in self.undo_stack)
+
+    def _trim_and_notify(self):
+        n = len(self.undo_stack)
+        self.reduce_undo_history()
+        if len(self.undo_stack) != n:
+            self.stack_updated()
+
     def reduce_undo_history(self):
-        """Trims the undo stack"""
+        """Trims the undo stack
+
+        The newest `min_steps` steps are always kept. Older steps are
+        kept while the memory they retain fits within `memory_budget`,
+        up to a maximum of `MAXLEN` steps. Commands with
+        `automatic_undo` set don't count as steps.
+
+        With a `spill_file`, steps which don't fit are spilled to it,
+        and only the `MAXLEN` limit discards history.
+
+        """
         stack = self.undo_stack
-        self.undo_stack = []
+        keep = 0
         steps = 0
-        for item in reversed(stack):
-            self.undo_stack.insert(0, item)
+        memory = 0
+        live_tiles = None
+        for i, item in enumerate(reversed(stack)):
             if not item.automatic_undo:
                 steps += 1
-            if steps == self.MAXLEN:  # and memory > ...
+            if steps > self.MAXLEN:
                 break
+            item_memory = item.get_memory_usage()
+            over_budget = (memory + item_memory) > self._memory_budget
+            if steps > self._min_steps and over_budget:
+                if self.spill_file is None:
+                    break
+                if not item.spilled:
+                    # Tiles the document is using stay in memory
+                    if live_tiles is None:
+                        live_tiles = set(
+                            id(t)
+                            for d in item.doc.layer_stack.get_tiledicts()
+                            for t in d.itervalues()
+                        )
+                    item.spill(self.spill_file, live_tiles)
+                    item_memory = item.get_memory_usage()
+            memory += item_memory
+            keep = i + 1
+        if keep < len(stack):
+            logger.debug(
+                "Trimming %d undo steps (budget=%d bytes)",
+                len(stack) - keep, self._memory_budget,
+            )
+            self.undo_stack = stack[len(stack)-keep:]
 
     def get_last_command(self):
         """Returns the most recently performed command"""
@@ -156,6 +253,13 @@ class Command (object):
 
     automatic_undo = False
     display_name = _("Unknown Command")
+    #: Set by redo() if the work was abandoned, leaving no changes.
+    #: The command is then not added to the undo stack.
+    cancelled = False
+    #: Set by spill(), and reset when the memory usage is recalculated.
+    spilled = False
+    _memory_usage = 0
+    _retained = ()
 
     ## Method defs
 
@@ -208,6 +312,67 @@ class Command (object):
         """
         raise NotImplementedError
 
+    ## Memory use
+
+    def get_memory_usage(self):
+        """Estimates the memory retained for undoing the command
+
+        :returns: memory used, in bytes
+        :rtype: int
+
+        Only layer pixel data which the document did not use after the
+        command was last performed is counted. Tiles shared with other
+        commands may be counted by each of them. The base
+        implementation returns 0, or whatever the last call to
+        `_update_memory_usage()` calculated.
+        """
+        return self._memory_usage
+
+    def _update_memory_usage(self, held, exclude=()):
+        """Recalculates get_memory_usage()'s return value
+
+        :param list held: layers or layer snapshots retained for undo
+        :param list exclude: layers or snapshots whose data isn't counted
+
+        Subclasses call this when they're performed. When a single layer
+        snapshot is held and a later state of the same layer is
+        excluded, only the tiles which changed in between are examined,
+        so it's cheap enough to call for every stroke.
+        """
+        changed = None
+        if len(held) == 1 and len(exclude) == 1:
+            if isinstance(held[0], lib.layer.LayerBaseSnapshot):
+                changed = held[0].get_changed_tiledicts(exclude[0])
+        if changed is not None:
+            usage = lib.tiledsurface.get_tiles_memory_usage(changed)
+        else:
+            usage = lib.tiledsurface.get_tiles_memory_usage(
+                [d for obj in held for d in obj.get_tiledicts()],
+                [d for obj in exclude for d in obj.get_tiledicts()],
+            )
+        self._memory_usage = usage
+        self._retained = [weakref.ref(obj) for obj in held]
+        self.spilled = False
+
+    def spill(self, spill_file, exclude=()):
+        """Moves the layer data retained for undo into a spill file
+
+        :param lib.tiledsurface.TileSpillFile spill_file: where to move it
+        :param set exclude: ids of tiles which must stay in memory
+
+        This covers the data last passed to `_update_memory_usage()`.
+        It is read back lazily when next used, typically when the
+        command is undone and the canvas is redrawn.
+        """
+        held = [r() for r in self._retained]
+        tiledicts = [d for obj in held if obj is not None
+                     for d in obj.get_tiledicts()]
+        freed = spill_file.spill_tiles(tiledicts, exclude)
+        if freed is None:
+            return
+        self._memory_usage = max(0, self._memory_usage - freed)
+        self.spilled = True
+
     ## Deprecated utility functions for subclasses
 
     def _notify_canvas_observers(self, layer_bboxes):
@@ -333,6 +498,7 @@ class Brushwork (Command):
         self._stroke_seq = stroke
         layer.add_stroke_shape(stroke, self._sshot_before)
         self._sshot_after = layer.save_snapshot()
+        self._update_memory_usage([self._sshot_before], [self._sshot_after])
 
     def _check_recording_started(self):
         """Ensure command is in the recording phase"""
@@ -453,6 +619,7 @@ class Brushwork (Command):
         layer.add_stroke_shape(self._stroke_seq, self._sshot_before)
         self._sshot_after = layer.save_snapshot()
         self._sshot_after_applied = True  # changes happened before redo()
+        self._update_memory_usage([self._sshot_before], [self._sshot_after])
         tiles_changed = (not self._stroke_seq.empty)
         logger.debug(
             "Stopped recording %r: tiles_changed=%r",
@@ -470,7 +637,7 @@ class FloodFill (Command):
     display_name = _("Flood Fill")
 
     def __init__(self, doc, x, y, color, bbox, tolerance,
-                 sample_merged, make_new_layer, **kwds):
+                 sample_merged, make_new_layer, progress_cb=None, **kwds):
         super(FloodFill, self).__init__(doc, **kwds)
         self.x = x
         self.y = y
@@ -479,6 +646,8 @@ class FloodFill (Command):
         self.tolerance = tolerance
         self.sample_merged = sample_merged
         self.make_new_layer = make_new_layer
+        #: Only used when the fill is first performed
+        self.progress_cb = progress_cb
         self.new_layer = None
         self.new_layer_path = None
         self.snapshot = None
@@ -492,25 +661,39 @@ class FloodFill (Command):
             src_layer = layers.current
         # Choose a target
         if self.make_new_layer:
-            # Write to a new layer
+            # Write to a new layer, inserted after the fill. Inserting it
+            # first would discard the cached tiles a merged fill can use.
             assert self.new_layer is None
             nl = lib.layer.PaintingLayer()
             self.new_layer = nl
-            path = layers.get_current_path()
-            path = layers.path_above(path, insert=1)
-            layers.deepinsert(path, nl)
-            path = layers.deepindex(nl)
-            self.new_layer_path = path
-            layers.set_current_path(path)
             dst_layer = nl
         else:
             # Overwrite current, but snapshot 1st
             assert self.snapshot is None
             self.snapshot = layers.current.save_snapshot()
             dst_layer = layers.current
-        # Fill connected areas of the source into the destination
-        src_layer.flood_fill(self.x, self.y, self.color, self.bbox,
-                             self.tolerance, dst_layer=dst_layer)
+        # Fill connected areas of the source into the destination.
+        # Cancelled fills leave the destination unchanged.
+        progress_cb = self.progress_cb
+        self.progress_cb = None
+        filled = src_layer.flood_fill(self.x, self.y, self.color, self.bbox,
+                                      self.tolerance, dst_layer=dst_layer,
+                                      progress_cb=progress_cb)
+        if filled is False:
+            self.cancelled = True
+            self.new_layer = None
+            self.snapshot = None
+            return
+        if self.make_new_layer:
+            nl = self.new_layer
+            path = layers.get_current_path()
+            path = layers.path_above(path, insert=1)
+            layers.deepinsert(path, nl)
+            path = layers.deepindex(nl)
+            self.new_layer_path = path
+            layers.set_current_path(path)
+        if self.snapshot is not None:
+            self._update_memory_usage([self.snapshot], [dst_layer])
 
     def undo(self):
         layers = self.doc.layer_stack
@@ -541,6 +724,7 @@ class TrimLayer (Command):
         self.before = layer.save_snapshot()
         frame = self.doc.get_frame()
         layer.trim(frame)
+        self._update_memory_usage([self.before], [layer])
 
     def undo(self):
         layer = self.doc.layer_stack.current
@@ -560,6 +744,7 @@ class ClearLayer (Command):
         layer = self.doc.layer_stack.current
         self._before = layer.save_snapshot()
         layer.clear()
+        self._update_memory_usage([self._before], [layer])
 
     def undo(self):
         layer = self.doc.layer_stack.current
@@ -584,6 +769,7 @@ class LoadLayer (Command):
         layer = self.doc.layer_stack.current
         self.before = layer.save_snapshot()
         layer.load_from_surface(self.surface)
+        self._update_memory_usage([self.before], [layer])
 
     def undo(self):
         self.doc.layer_stack.current.load_snapshot(self.before)
@@ -694,6 +880,7 @@ class MergeVisibleLayers (Command):
         # isn't it always the same as the insert path?
         self._result_final_path = rootstack.deepindex(merged)
         rootstack.current_path = self._result_final_path
+        self._update_memory_usage(self._layers_merged, [merged])
 
     def undo(self):
         if self._nothing_initially_visible:
@@ -739,6 +926,10 @@ class MergeLayerDown (Command):
         assert self._upper_layer is not None
         assert rootstack.deepget(self._upper_path) is merged
         rootstack.current_path = self._upper_path
+        self._update_memory_usage(
+            [self._upper_layer, self._lower_layer],
+            [merged],
+        )
 
     def undo(self):
         rootstack = self.doc.layer_stack
@@ -781,6 +972,7 @@ class NormalizeLayerMode (Command):
         normalized = layers.layer_new_normalized(self._path)
         parent[idx] = normalized
         layers.current_path = self._path
+        self._update_memory_usage([self._old_layer], [normalized])
 
     def undo(self):
         layers = self.doc.layer_stack
@@ -844,6 +1036,7 @@ class RemoveLayer (Command):
         path = layers.get_current_path()
         path_above = layers.path_above(path)
         self._removed_layer = layers.deeppop(self._unwanted_path)
+        self._update_memory_usage([self._removed_layer])
         if len(layers) == 0:
             logger.debug("Removed last layer")
             if self.doc.CREATE_PAINTING_LAYER_IF_EMPTY:
@@ -1430,6 +1623,7 @@ class ExternalLayerEdit (Command):
         else:
             layer.load_from_external_edit_tempfile(self._tmpfile)
             self._after = layer.save_snapshot()
+        self._update_memory_usage([self._before], [self._after])
 
     def undo(self):
         layer = self.doc.layer_stack.deepget(self._layer_path)
@@ -17,7 +17,6 @@ import zipfile
 import tempfile
 import time
 import traceback
-from os.path import join
 from cStringIO import StringIO
 import xml.etree.ElementTree as ET
 from warnings import warn
@@ -45,9 +44,11 @@ import lib.layer as layer
 import lib.brush as brush
 from lib.observable import event
 import lib.pixbuf
+import lib.surface
+import lib.zipwriter
 from lib.errors import FileHandlingError
 from lib.errors import AllocationError
-import lib.idletask
+import lib.workerpool
 from lib.gettext import C_
 import lib.xml
 import lib.glib
@@ -63,6 +64,7 @@ CACHE_APP_SUBDIR_NAME = u"mypaint"
 CACHE_DOC_SUBDIR_PREFIX = u"doc."
 CACHE_DOC_AUTOSAVE_SUBDIR = u"autosave"
 CACHE_ACTIVITY_FILE = u"active"
+CACHE_UNDO_SPILL_FILE = u"undo-tiles.bin"
 CACHE_UPDATE_INTERVAL = 10  # seconds
 
 # Logging and error reporting strings
@@ -226,6 +228,73 @@ class AutosaveInfo (namedtuple("AutosaveInfo", _AUTOSAVE_INFO_FIELDS)):
         )
 
 
+class _OraFileRef (object):
+    """Identifies an OpenRaster file which layers were loaded or saved
+
+    Layers record which file their data was last stored in by keeping
+    one of these. When the document is next saved, an unchanged layer's
+    members can be copied across from that file, but only if it hasn't
+    been touched by anything else since.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> orafile = os.path.join(tmpdir, "test.ora")
+    >>> zipfile.ZipFile(orafile, "w").close()
+    >>> ref = _OraFileRef()
+    >>> ref.open_if_unchanged() is None
+    True
+    >>> ref.set_path(orafile)
+    >>> ref.open_if_unchanged().close()
+    >>> with open(orafile, "ab") as fp:
+    ...     fp.write(b"changed")
+    >>> ref.open_if_unchanged() is None
+    True
+    >>> shutil.rmtree(tmpdir)
+
+    """
+
+    def __init__(self):
+        super(_OraFileRef, self).__init__()
+        self._path = None
+        self._stat_key = None
+
+    @staticmethod
+    def _get_stat_key(path):
+        st = os.stat(path)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def set_path(self, path):
+        """Sets the file's path, and remembers its current state
+
+        :param unicode path: Real path of the file, after writing it
+
+        """
+        try:
+            self._stat_key = self._get_stat_key(path)
+        except OSError:
+            logger.exception("Cannot stat %r", path)
+            self._stat_key = None
+        self._path = path
+
+    def open_if_unchanged(self):
+        """Opens the file for reading, if it is unchanged
+
+        :returns: the opened file, or None
+        :rtype: zipfile.ZipFile
+
+        """
+        if self._path is None or self._stat_key is None:
+            return None
+        try:
+            if self._get_stat_key(self._path) != self._stat_key:
+                logger.debug("%r has changed since last used", self._path)
+                return None
+            return zipfile.ZipFile(self._path)
+        except (EnvironmentError, zipfile.BadZipfile):
+            logger.exception("Cannot reopen %r", self._path)
+            return None
+
+
 class Document (object):
     """In-memory representation of everything to be worked on & saved
 
@@ -284,8 +353,13 @@ class Document (object):
         self._autosave_processor = None
         self._autosave_countdown_id = None
         self._autosave_dirty = False
+        self._autosave_run_id = 0  # changed when writes are stopped
+        self._ora_file_ref = None  # file which layer data can be copied from
         if not painting_only:
-            self._autosave_processor = lib.idletask.Processor()
+            self._autosave_processor = lib.workerpool.ThreadedProcessor(
+                name = "autosave",
+                finished_cb = self._autosave_writes_finished_cb,
+            )
             self.command_stack.stack_updated += self._command_stack_updated_cb
             self.effective_bbox_changed += self._effective_bbox_changed_cb
 
@@ -346,6 +420,10 @@ class Document (object):
             doc_cache_dir = doc_cache_dir.decode(sys.getfilesystemencoding())
         logger.debug("Created working-doc cache dir %r", doc_cache_dir)
         self._cache_dir = doc_cache_dir
+        # Older undo steps are spilled to disk there.
+        self.command_stack.spill_file = tiledsurface.TileSpillFile(
+            os.path.join(doc_cache_dir, CACHE_UNDO_SPILL_FILE),
+        )
         # Start the cache updater, which kicks off background autosaves,
         # and updates an activity canary file.
         # Not a perfect solution, but maybe a better cross-platform one
@@ -370,6 +448,13 @@ class Document (object):
             return
         self._stop_cache_updater()
         self._stop_autosave_writes()
+        # The undo history is about to be discarded anyway, and clearing
+        # it first means close() has fewer spilled tiles to read back.
+        spill_file = self.command_stack.spill_file
+        if spill_file is not None:
+            self.command_stack.spill_file = None
+            self.command_stack.clear()
+            spill_file.close()
         shutil.rmtree(self._cache_dir, ignore_errors=True)
         if os.path.exists(self._cache_dir):
             logger.error(
@@ -487,14 +572,16 @@ class Document (object):
         self._autosave_countdown_id = None
         return False
 
-    ## Queued autosave writes: low priority & chunked
+    ## Queued autosave writes: in a background thread, & chunked
 
     def _queue_autosave_writes(self):
         """Add autosaved backup tasks to the background processor
 
         These tasks consist of nicely chunked writes for all layers
         whose data has changed, plus a few extra structural and
-        bookeeping ones.
+        bookeeping ones. They run in a worker thread, and only use
+        snapshots of the document's data. Completion is reported back
+        to the main thread by `_autosave_writes_finished_idle_cb()`.
 
         """
         if not self._cache_dir:
@@ -570,6 +657,9 @@ class Document (object):
             oradir = oradir,
             manifest = manifest,
         )
+        # Everything has been snapshotted, so any changes made after
+        # this will need another autosave.
+        self._autosave_dirty = False
 
     def _autosave_thumbnail_cb(self, rootstack, bbox, filename):
         """Autosaved backup task: write Thumbnails/thumbnail.png
@@ -630,14 +720,41 @@ class Document (object):
                 "autosave: missing %r (listed in the manifest)",
                 path,
             )
-        self._autosave_dirty = False
-        logger.debug("autosave: all done, doc marked autosave-clean")
+        return False
+
+    def _autosave_writes_finished_cb(self, ok):
+        """Autosave processor callback: pass completion to main thread
+
+        This is called in the autosave thread.
+
+        """
+        GLib.idle_add(
+            self._autosave_writes_finished_idle_cb,
+            ok,
+            self._autosave_run_id,
+        )
+
+    def _autosave_writes_finished_idle_cb(self, ok, run_id):
+        """Idle callback: autosave writes have finished"""
+        assert not self._painting_only
+        if run_id != self._autosave_run_id:
+            return False  # stopped since
+        if ok:
+            logger.debug("autosave: all done")
+        else:
+            logger.error("autosave: failed, will retry")
+            self._autosave_dirty = True
+        # Changes made while writing couldn't restart the countdown.
+        self._start_autosave_countdown()
         return False
 
     def _stop_autosave_writes(self):
         assert not self._painting_only
         logger.debug("autosave stopped: clearing task queue")
+        if self._autosave_processor.has_work():
+            self._autosave_dirty = True
         self._autosave_processor.stop()
+        self._autosave_run_id += 1
 
     def _command_stack_updated_cb(self, cmdstack):
         assert not self._painting_only
@@ -796,6 +913,7 @@ class Document (object):
             self._create_cache_dir()
         self.command_stack.clear()
         self._layers.clear()
+        self._ora_file_ref = None
         if self.CREATE_PAINTING_LAYER_IF_EMPTY:
             self.add_layer((-1,))
             self._layers.current_path = (0,)
@@ -871,7 +989,8 @@ class Document (object):
     ## Other painting/drawing
 
     def flood_fill(self, x, y, color, tolerance=0.1,
-                   sample_merged=False, make_new_layer=False):
+                   sample_merged=False, make_new_layer=False,
+                   progress_cb=None):
         """Flood-fills a point on the current layer with a color
 
         :param x: Starting point X coordinate
@@ -884,6 +1003,8 @@ class Document (object):
         :type sample_merged: bool
         :param make_new_layer: Write output to a new layer on top
         :type make_new_layer: bool
+        :param callable progress_cb: Called during long fills, as for
+            `lib.tiledsurface.flood_fill()`. Return false to cancel.
 
         Filling an infinite canvas requires limits. If the frame is
         enabled, this limits the maximum size of the fill, and filling
@@ -907,7 +1028,8 @@ class Document (object):
         elif not self.frame_enabled:
             bbox.expandToIncludePoint(x, y)
         cmd = command.FloodFill(self, x, y, color, bbox, tolerance,
-                                sample_merged, make_new_layer)
+                                sample_merged, make_new_layer,
+                                progress_cb=progress_cb)
         self.do(cmd)
 
     ## Graphical refresh
@@ -1001,15 +1123,11 @@ class Document (object):
         """Returns the data bounding box of the document
 
         This is currently the union of all the data bounding boxes of all of
-        the layers. It disregards the user-chosen frame.
+        the layers. It disregards the user-chosen frame. The layer stack
+        caches it, so it's cheap to call repeatedly.
 
         """
-        res = helpers.Rect()
-        for layer in self.layer_stack.deepiter():
-            # OPTIMIZE: only visible layers?
-            bbox = layer.get_bbox()
-            res.expandToIncludeRect(bbox)
-        return res
+        return self.layer_stack.get_bbox()
 
     def get_full_redraw_bbox(self):
         """Returns the full-redraw bounding box of the document
@@ -1458,9 +1576,29 @@ class Document (object):
 
     save_jpeg = save_jpg
 
-    @fileutils.via_tempfile
     def save_ora(self, filename, options=None, **kwargs):
-        """Saves OpenRaster data to a file"""
+        """Saves OpenRaster data to a file
+
+        Layer data which hasn't changed since it was loaded from or
+        saved to the previous OpenRaster file is copied from that file,
+        provided it hasn't been modified since.
+
+        """
+        ref = _OraFileRef()
+        thumbnail = self._save_ora_via_tempfile(
+            filename,
+            options=options,
+            source_ref=self._ora_file_ref,
+            ref=ref,
+            **kwargs
+        )
+        ref.set_path(os.path.realpath(filename))
+        self._ora_file_ref = ref
+        return thumbnail
+
+    @fileutils.via_tempfile
+    def _save_ora_via_tempfile(self, filename, options=None, **kwargs):
+        """Internal: saves OpenRaster data to a file (see save_ora())"""
         logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
         t0 = time.time()
         thumbnail = _save_layers_to_new_orazip(
@@ -1492,6 +1630,7 @@ class Document (object):
         image_yres = max(0, int(image_elem.attrib.get('yres', 0)))
 
         # Delegate loading of image data to the layers tree itself
+        ref = _OraFileRef()
         self.layer_stack.clear()
         self.layer_stack.load_from_openraster(
             orazip,
@@ -1499,6 +1638,7 @@ class Document (object):
             cache_dir,
             feedback_cb,
             x=0, y=0,
+            ora_ref=ref,
             **kwargs
         )
         assert len(self.layer_stack) > 0
@@ -1523,6 +1663,8 @@ class Document (object):
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
         orazip.close()
+        ref.set_path(os.path.realpath(filename))
+        self._ora_file_ref = ref
 
         logger.info('%.3fs load_ora total', time.time() - t0)
 
@@ -1622,7 +1764,7 @@ class Document (object):
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
 
-def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=None, frame_active=False, **kwargs):
+def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=None, frame_active=False, source_ref=None, ref=None, **kwargs):
     """Save a root layer stack to a new OpenRaster zipfile
 
     :param lib.layer.RootLayerStack root_stack: what to save
@@ -1631,6 +1773,8 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=
     :param int xres: nominal X resolution for the doc
     :param int yres: nominal Y resolution for the doc
     :param frame_active: True if the frame is enabled
+    :param _OraFileRef source_ref: file to copy unchanged layer data from
+    :param _OraFileRef ref: identifies the new file, for later saves
     :param \*\*kwargs: Passed through to root_stack.save_to_openraster()
     :rtype: GdkPixbuf
     :returns: Thumbnail preview image (256x256 max) of what was saved
@@ -1652,22 +1796,47 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=
     if not isinstance(tempdir, unicode):
         tempdir = tempdir.decode(sys.getfilesystemencoding())
 
-    orazip = zipfile.ZipFile(
-        filename, 'w',
-        compression=zipfile.ZIP_STORED,
+    # Layer PNGs are encoded in parallel by worker threads, which mustn't
+    # call feedback_cb. The members are still written in a fixed order.
+    feedback_cb = kwargs.pop("feedback_cb", None)
+    source = None
+    if source_ref is not None:
+        source = source_ref.open_if_unchanged()
+    orazip = lib.zipwriter.ParallelZipWriter(
+        zipfile.ZipFile(
+            filename, 'w',
+            compression=zipfile.ZIP_STORED,
+        ),
+        feedback_cb=feedback_cb,
+        source=source,
+        source_ref=source_ref,
+        ref=ref,
     )
+    try:
+        return _save_layers_to_orazip(
+            root_stack, orazip, tempdir, bbox,
+            xres, yres, frame_active, **kwargs
+        )
+    finally:
+        if source is not None:
+            source.close()
+
+
+def _save_layers_to_orazip(root_stack, orazip, tempdir, bbox,
+                           xres, yres, frame_active, **kwargs):
+    """Internal: writes the content of a new OpenRaster zipfile
+
+    See _save_layers_to_new_orazip().
 
+    """
     # The mimetype entry must be first
     helpers.zipfile_writestr(orazip, 'mimetype', lib.xml.OPENRASTER_MEDIA_TYPE)
 
     # Update the initially-selected flag on all layers
-    # Also get the data bounding box as we go
-    data_bbox = helpers.Rect()
     for s_path, s_layer in root_stack.walk():
         selected = (s_path == root_stack.current_path)
         s_layer.initially_selected = selected
-        data_bbox.expandToIncludeRect(s_layer.get_bbox())
-    data_bbox = tuple(data_bbox)
+    data_bbox = tuple(root_stack.get_bbox())
 
     # Save the layer stack
     image = ET.Element('image')
@@ -1697,20 +1866,25 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=
 
     # Thumbnail preview (256x256)
     thumbnail = root_stack.render_thumbnail(bbox)
-    tmpfile = join(tempdir, 'tmp.png')
-    lib.pixbuf.save(thumbnail, tmpfile, 'png')
-    orazip.write(tmpfile, 'Thumbnails/thumbnail.png')
-    os.remove(tmpfile)
-
-    # Save fully rendered image too
-    tmpfile = os.path.join(tempdir, "mergedimage.png")
-    root_stack.save_as_png(
-        tmpfile, *bbox,
+    thumbnail_buf = StringIO()
+    lib.pixbuf.save_to_stream(thumbnail, thumbnail_buf, 'png')
+    helpers.zipfile_writestr(
+        orazip,
+        'Thumbnails/thumbnail.png',
+        thumbnail_buf.getvalue(),
+    )
+
+    # Save fully rendered image too, from a copy of the layers because
+    # the live stack can change while the worker renders it.
+    root_stack_clone = layer.RootLayerStack(doc=None)
+    root_stack_clone.load_snapshot(root_stack.save_snapshot())
+    orazip.submit(
+        'mergedimage.png',
+        lib.surface.encode_png,
+        root_stack_clone, *bbox,
         alpha=False, background=True,
         **kwargs
     )
-    orazip.write(tmpfile, 'mergedimage.png')
-    os.remove(tmpfile)
 
     # Prettification
     lib.xml.indent_etree(image)
@@ -41,6 +41,8 @@ static void
 png_write_error_callback (png_structp png_save_ptr,
                           png_const_charp error_msg)
 {
+    // The GIL may have been released by the caller, see write()
+    PyGILState_STATE gstate = PyGILState_Ensure();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -51,10 +53,39 @@ png_write_error_callback (png_structp png_save_ptr,
             PyErr_Format(PyExc_RuntimeError, "Error writing PNG: %s", error_msg);
         }
     }
+    PyGILState_Release(gstate);
     longjmp (png_jmpbuf(png_save_ptr), 1);
 }
 
 
+// Output functions for writing to Python file-like objects.
+// The GIL may have been released by the caller.
+
+static void
+png_write_pyfile_callback (png_structp png_ptr,
+                           png_bytep data,
+                           png_size_t length)
+{
+    PyObject *file = (PyObject *)png_get_io_ptr(png_ptr);
+    PyGILState_STATE gstate = PyGILState_Ensure();
+    PyObject *result = PyObject_CallMethod(
+        file, (char *)"write", (char *)"s#",
+        (char *)data, (int)length
+    );
+    const bool failed = (result == NULL);
+    Py_XDECREF(result);
+    PyGILState_Release(gstate);
+    if (failed) {
+        png_error(png_ptr, "Write Error (file-like object)");
+    }
+}
+
+static void
+png_flush_pyfile_callback (png_structp png_ptr)
+{
+}
+
+
 struct ProgressivePNGWriter::State
 {
     int width;
@@ -133,23 +164,29 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
 
     const int bpc = 8;
 
-    if (! PyFile_Check(file)) {
-        PyErr_SetString(
-            PyExc_TypeError,
-            "file arg must be a builtin file object"
-        );
+    // Builtin files are written to directly. Anything else with a
+    // write() method is written to via png_write_pyfile_callback().
+    FILE *fp = NULL;
+    if (PyFile_Check(file)) {
+        fp = PyFile_AsFile(file);
+        if (!fp) {
+            PyErr_SetString(
+                PyExc_TypeError,
+                "file arg has no FILE* associated with it?"
+            );
+            return;
+        }
     }
-    state->file = file;
-    Py_INCREF(file);
-
-    FILE *fp = PyFile_AsFile(file);
-    if (!fp) {
+    else if (! PyObject_HasAttrString(file, "write")) {
         PyErr_SetString(
             PyExc_TypeError,
-            "file arg has no FILE* associated with it?"
+            "file arg must be a builtin file object, "
+            "or have a write() method"
         );
         return;
     }
+    state->file = file;
+    Py_INCREF(file);
 
     png_ptr = png_create_write_struct (PNG_LIBPNG_VER_STRING,
                                        (png_voidp)NULL,
@@ -181,7 +218,14 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
         return;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_write_fn(png_ptr, (png_voidp)file,
+                         png_write_pyfile_callback,
+                         png_flush_pyfile_callback);
+    }
 
     png_set_IHDR (png_ptr, info_ptr,
                   w, h, bpc,
@@ -266,32 +310,44 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     assert(PyArray_STRIDE(arr, 1) == 4);
     assert(PyArray_STRIDE(arr, 2) == 1);
 
-    if (setjmp(png_jmpbuf(state->png_ptr))) {
-        if (PyErr_Occurred()) {
-            state->cleanup();
-            return NULL;
-        }
-        err_type = PyExc_RuntimeError;
-        err_text = "libpng error during write()";
-        goto errexit;
-    }
     rowcount = PyArray_DIM(arr, 0);
     rowstride = PyArray_STRIDE(arr, 0);
     rowdata = (png_bytep)PyArray_DATA(arr);
     row_p = (png_bytep)rowdata;
-    for (row=0; row<rowcount; row++) {
-        png_write_row(state->png_ptr, row_p);
-        if (! state->check_valid()) {
-            state->cleanup();
-            return NULL;
+    if (state->y + rowcount > state->height) {
+        err_type = PyExc_RuntimeError;
+        err_text = "too many pixel rows written";
+        goto errexit;
+    }
+
+    // Filtering and compression are the slow part of saving.
+    // Release the GIL for them so that several layers can be encoded
+    // at once by different threads. The array is kept alive by the
+    // caller, and libpng's callbacks reacquire the GIL if needed.
+    {
+        bool failed = false;
+        PyThreadState *thread_state = PyEval_SaveThread();
+        if (setjmp(png_jmpbuf(state->png_ptr))) {
+            failed = true;
         }
-        row_p += rowstride;
-        if (++(state->y) > state->height) {
+        else {
+            for (row=0; row<rowcount; row++) {
+                png_write_row(state->png_ptr, row_p);
+                row_p += rowstride;
+            }
+        }
+        PyEval_RestoreThread(thread_state);
+        if (failed) {
+            if (PyErr_Occurred()) {
+                state->cleanup();
+                return NULL;
+            }
             err_type = PyExc_RuntimeError;
-            err_text = "too many pixel rows written";
+            err_text = "libpng error during write()";
             goto errexit;
         }
     }
+    state->y += rowcount;
     Py_RETURN_NONE;
 
   errexit:
@@ -349,6 +405,8 @@ static void
 png_read_error_callback (png_structp png_read_ptr,
                          png_const_charp error_msg)
 {
+    // The GIL may have been released by the caller
+    PyGILState_STATE gstate = PyGILState_Ensure();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -361,10 +419,52 @@ png_read_error_callback (png_structp png_read_ptr,
                          error_msg);
         }
     }
+    PyGILState_Release(gstate);
     longjmp (png_jmpbuf(png_read_ptr), 1);
 }
 
 
+// Input function for reading from Python file-like objects.
+// The GIL may have been released by the caller.
+
+static void
+png_read_pyfile_callback (png_structp png_ptr,
+                          png_bytep data,
+                          png_size_t length)
+{
+    PyObject *file = (PyObject *)png_get_io_ptr(png_ptr);
+    PyGILState_STATE gstate = PyGILState_Ensure();
+    bool failed = false;
+    // read() may return less than was asked for, so keep asking.
+    while (length > 0) {
+        PyObject *chunk = PyObject_CallMethod(
+            file, (char *)"read", (char *)"i", (int)length
+        );
+        char *chunk_data = NULL;
+        Py_ssize_t chunk_len = 0;
+        if (!chunk || PyBytes_AsStringAndSize(chunk, &chunk_data,
+                                              &chunk_len) < 0) {
+            Py_XDECREF(chunk);
+            failed = true;
+            break;
+        }
+        if (chunk_len <= 0 || (png_size_t)chunk_len > length) {
+            Py_DECREF(chunk);
+            failed = true;
+            break;
+        }
+        memcpy(data, chunk_data, chunk_len);
+        data += chunk_len;
+        length -= chunk_len;
+        Py_DECREF(chunk);
+    }
+    PyGILState_Release(gstate);
+    if (failed) {
+        png_error(png_ptr, "Read Error (file-like object)");
+    }
+}
+
+
 static const double PNG_gAMA_scale = 100000;
 static const double PNG_cHRM_scale = 100000;
 
@@ -377,38 +477,31 @@ log_lcms2_error (cmsContext context_id, cmsUInt32Number err_code,
 }
 
 
-/** load_png_fast_progressive:
- *
- * @filename: filename to load, in the system encoding
- * @get_buffer_callback: a Python callable returning writeable arrays
- * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
- * returns: a dict of flags describing what was read.
- *
- * Read a PNG progressively as 8bit RGBA. The callback must have the signature
- *
- *   numpy_array = callback(full_image_width, full_image_height)
+/* load_png_progressive:
  *
- * @get_buffer_callback  must return a writeable array of the image width.  If
- * the height is smaller than the image height, the callback will be called
- * again until the full image has been processed. The buffer will be written
- * with 8-bit RGBA data
+ * @fp: open FILE to read from, or NULL
+ * @file: Python file-like object to read from if @fp is NULL
+ * @get_buffer_callback, @convert_to_srgb, returns: see below.
  *
+ * Common implementation of the public loader functions. The GIL is
+ * released while rows are decoded, so that several images can be
+ * loaded at once by different threads.
  */
 
-PyObject *
-load_png_fast_progressive (char *filename,
-                           PyObject *get_buffer_callback,
-                           bool convert_to_srgb)
+static PyObject *
+load_png_progressive (FILE *fp,
+                      PyObject *file,
+                      PyObject *get_buffer_callback,
+                      bool convert_to_srgb)
 {
     // Note: we are not using the method that libpng calls "Reading PNG
     // files progressively". That method would involve feeding the data
     // into libpng piece by piece, which is not necessary if we can give
-    // libpng a simple FILE pointer.
+    // libpng a simple FILE pointer or a read function.
 
     png_structp png_ptr = NULL;
     png_infop info_ptr = NULL;
     PyObject *result = NULL;
-    FILE *fp = NULL;
     uint32_t width, height;
     uint32_t rows_left;
     png_byte color_type;
@@ -455,37 +548,6 @@ load_png_fast_progressive (char *filename,
 
     cmsSetLogErrorHandler(log_lcms2_error);
 
-#ifdef _WIN32
-    wchar_t *win32_filename;
-#ifdef __MINGW64_VERSION_MAJOR
-    // mbstowcs seems mismatch with default python encoding, force to be utf8
-    __mingw_str_utf8_wide(filename, &win32_filename, NULL);
-#else
-    size_t len;
-    wchar_t *buf;
-    // what __mingw_str_utf8_wide is
-    len = MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, NULL, 0); 
-    buf = (wchar_t *) calloc(len + 1, sizeof (wchar_t));
-    if(!buf)
-        len = 0;
-    else {
-        if (len != 0)
-            MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, buf, len);
-        buf[len] = L'0'; // Must null-terminated
-    }
-    win32_filename = buf;
-#endif
-    fp = _wfopen(win32_filename, L"rb");
-    if (win32_filename)
-        free(win32_filename);
-#else
-    fp = fopen(filename, "rb");
-#endif
-    if (!fp) {
-        PyErr_SetFromErrno(PyExc_IOError);
-        goto cleanup;
-    }
-
     png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)NULL,
                                       png_read_error_callback, NULL);
     if (!png_ptr) {
@@ -503,7 +565,12 @@ load_png_fast_progressive (char *filename,
         goto cleanup;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_read_fn(png_ptr, (png_voidp)file, png_read_pyfile_callback);
+    }
 
     png_read_info(png_ptr, info_ptr);
 
@@ -800,40 +867,64 @@ load_png_fast_progressive (char *filename,
             }
         }
 
-        // Populate the strip of memory with pixels decoded from the PNG stream
-        png_read_rows(png_ptr, row_pointers, NULL, rows);
-        rows_left -= rows;
-
-        if (convert_to_srgb) {
-            // Apply CMS transform
-            for (row=0; row<rows; row++) {
-                uint8_t *pyarr_row = (uint8_t *)PyArray_DATA(pyarr)
-                                   + row*PyArray_STRIDE(pyarr, 0);
-                uint8_t *input_row = row_pointers[row];
-                // Really minimal fake colour management. Just remaps to sRGB.
-                cmsDoTransform(
-                    input_buffer_to_nparray,
-                    input_row,
-                    pyarr_row,
-                    width
-                );
-                // lcms2 ignores alpha, so copy that verbatim
-                // If it's 8bpc RGBA, use A.
-                // If it's 16bpc RrGgBbAa, use A.
-                for (uint32_t i=0; i<width; ++i) {
-                    const uint32_t pyarr_alpha_byte = (i*4) + 3;
-                    const uint32_t buf_alpha_byte =
-                        (i*input_buf_bytes_per_pixel)
-                        + ((bit_depth==8) ? 3 : 6);
-                    pyarr_row[pyarr_alpha_byte] = input_row[buf_alpha_byte];
+        // Populate the strip of memory with pixels decoded from the PNG
+        // stream. Decompression and colour conversion don't need the
+        // GIL. The array is kept alive by our reference to it, and
+        // libpng's callbacks reacquire the GIL if they need it.
+        {
+            bool failed = false;
+            PyThreadState *thread_state = PyEval_SaveThread();
+            if (setjmp(png_jmpbuf(png_ptr))) {
+                failed = true;
+            }
+            else {
+                png_read_rows(png_ptr, row_pointers, NULL, rows);
+                if (convert_to_srgb) {
+                    // Apply CMS transform
+                    for (row=0; row<rows; row++) {
+                        uint8_t *pyarr_row = (uint8_t *)PyArray_DATA(pyarr)
+                                           + row*PyArray_STRIDE(pyarr, 0);
+                        uint8_t *input_row = row_pointers[row];
+                        // Really minimal fake colour management.
+                        // Just remaps to sRGB.
+                        cmsDoTransform(
+                            input_buffer_to_nparray,
+                            input_row,
+                            pyarr_row,
+                            width
+                        );
+                        // lcms2 ignores alpha, so copy that verbatim
+                        // If it's 8bpc RGBA, use A.
+                        // If it's 16bpc RrGgBbAa, use A.
+                        for (uint32_t i=0; i<width; ++i) {
+                            const uint32_t pyarr_alpha_byte = (i*4) + 3;
+                            const uint32_t buf_alpha_byte =
+                                (i*input_buf_bytes_per_pixel)
+                                + ((bit_depth==8) ? 3 : 6);
+                            pyarr_row[pyarr_alpha_byte]
+                                = input_row[buf_alpha_byte];
+                        }
+                    }
                 }
             }
-            free(input_buffer);
+            PyEval_RestoreThread(thread_state);
+            if (input_buffer) {
+                free(input_buffer);
+            }
+            free(row_pointers);
+            Py_DECREF(obj);
+            if (failed) {
+                goto cleanup;
+            }
         }
-        free(row_pointers);
-        Py_DECREF(obj);
+        rows_left -= rows;
     } //while (rows_left)
 
+    // Errors from here on unwind to this point rather than the
+    // per-strip handler above, which has gone out of scope.
+    if (setjmp(png_jmpbuf(png_ptr))) {
+        goto cleanup;
+    }
     png_read_end(png_ptr, NULL);
 
     result = Py_BuildValue(
@@ -850,8 +941,6 @@ cleanup:
     }
     // libpng's style is to free internally allocated stuff like the icc
     // tables in png_destroy_*(). I think.
-    if (fp)
-        fclose(fp);
     if (convert_to_srgb) {
         if (input_buffer_profile)
             cmsCloseProfile(input_buffer_profile);
@@ -865,3 +954,111 @@ cleanup:
 
     return result;
 }
+
+
+/** load_png_fast_progressive:
+ *
+ * @filename: filename to load, in the system encoding
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
+ * returns: a dict of flags describing what was read.
+ *
+ * Read a PNG progressively as 8bit RGBA. The callback must have the signature
+ *
+ *   numpy_array = callback(full_image_width, full_image_height)
+ *
+ * @get_buffer_callback  must return a writeable array of the image width.  If
+ * the height is smaller than the image height, the callback will be called
+ * again until the full image has been processed. The buffer will be written
+ * with 8-bit RGBA data
+ *
+ */
+
+PyObject *
+load_png_fast_progressive (char *filename,
+                           PyObject *get_buffer_callback,
+                           bool convert_to_srgb)
+{
+    FILE *fp = NULL;
+    PyObject *result = NULL;
+
+#ifdef _WIN32
+    wchar_t *win32_filename;
+#ifdef __MINGW64_VERSION_MAJOR
+    // mbstowcs seems mismatch with default python encoding, force to be utf8
+    __mingw_str_utf8_wide(filename, &win32_filename, NULL);
+#else
+    size_t len;
+    wchar_t *buf;
+    // what __mingw_str_utf8_wide is
+    len = MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, NULL, 0); 
+    buf = (wchar_t *) calloc(len + 1, sizeof (wchar_t));
+    if(!buf)
+        len = 0;
+    else {
+        if (len != 0)
+            MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, buf, len);
+        buf[len] = L'0'; // Must null-terminated
+    }
+    win32_filename = buf;
+#endif
+    fp = _wfopen(win32_filename, L"rb");
+    if (win32_filename)
+        free(win32_filename);
+#else
+    fp = fopen(filename, "rb");
+#endif
+    if (!fp) {
+        PyErr_SetFromErrno(PyExc_IOError);
+        goto cleanup;
+    }
+
+    result = load_png_progressive(fp, NULL, get_buffer_callback,
+                                  convert_to_srgb);
+
+cleanup:
+    if (fp)
+        fclose(fp);
+    return result;
+}
+
+
+/** load_png_fast_progressive_from_file:
+ *
+ * @file: a builtin file object, or any object with a read() method
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
+ * returns: a dict of flags describing what was read.
+ *
+ * Like load_png_fast_progressive(), but reads from an open file-like
+ * object, for example a zipfile member. The file is not closed.
+ *
+ */
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb)
+{
+    FILE *fp = NULL;
+    if (PyFile_Check(file)) {
+        fp = PyFile_AsFile(file);
+        if (!fp) {
+            PyErr_SetString(
+                PyExc_TypeError,
+                "file arg has no FILE* associated with it?"
+            );
+            return NULL;
+        }
+    }
+    else if (! PyObject_HasAttrString(file, "read")) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "file arg must be a builtin file object, "
+            "or have a read() method"
+        );
+        return NULL;
+    }
+    return load_png_progressive(fp, file, get_buffer_callback,
+                                convert_to_srgb);
+}
@@ -47,4 +47,12 @@ load_png_fast_progressive (char *filename,
                            PyObject *get_buffer_callback,
                            bool convert_to_srgb);
 
+// Like load_png_fast_progressive(), but reading from a file-like object
+// with a read() method, such as an open zipfile member.
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb);
+
 #endif //FASTPNG_HPP
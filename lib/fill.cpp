@@ -19,6 +19,11 @@
 #include <glib.h>
 #include <mypaint-tiled-surface.h>
 
+#include <vector>
+#include <deque>
+#include <map>
+#include <utility>
+
 
 
 // Pixel access helper for arrays in the tile format.
@@ -128,90 +133,66 @@ typedef struct {
 } _floodfill_point;
 
 
-// Flood fill implementation
+// Overflow directions, and the edges of a tile which receive them
 
-PyObject *
-tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
-                 PyObject *dst, /* output HxWx4 array of uint16 */
-                 PyObject *seeds, /* List of 2-tuples */
-                 int targ_r, int targ_g, int targ_b, int targ_a, //premult
-                 double fill_r, double fill_g, double fill_b,
-                 int min_x, int min_y, int max_x, int max_y,
-                 double tol) /* [0..1] */
-{
-    // Scale the fractional tolerance arg
-    const fix15_t tolerance = (fix15_t)(  MIN(1.0, MAX(0.0, tol))
-                                        * fix15_one);
+enum {
+    _FLOODFILL_NORTH = 0,
+    _FLOODFILL_EAST,
+    _FLOODFILL_SOUTH,
+    _FLOODFILL_WEST,
+    _FLOODFILL_NUM_DIRECTIONS
+};
 
-    // Fill colour args are floats [0.0 .. 1.0], non-premultiplied by alpha.
-    // The targ_ colour components are 15-bit scaled ints in the range
-    // [0 .. 1<<15], and are premultiplied by targ_a which has the same range.
-    const fix15_short_t targ[4] = {
-            fix15_short_clamp(targ_r), fix15_short_clamp(targ_g),
-            fix15_short_clamp(targ_b), fix15_short_clamp(targ_a)
-        };
-    PyArrayObject *src_arr = ((PyArrayObject *)src);
-    PyArrayObject *dst_arr = ((PyArrayObject *)dst);
-    // Dimensions are [y][x][component]
-#ifdef HEAVY_DEBUG
-    assert(PyArray_Check(src));
-    assert(PyArray_Check(dst));
-    assert(PyArray_DIM(src_arr, 0) == MYPAINT_TILE_SIZE);
-    assert(PyArray_DIM(dst_arr, 0) == MYPAINT_TILE_SIZE);
-    assert(PyArray_DIM(src_arr, 1) == MYPAINT_TILE_SIZE);
-    assert(PyArray_DIM(dst_arr, 1) == MYPAINT_TILE_SIZE);
-    assert(PyArray_DIM(src_arr, 2) == 4);
-    assert(PyArray_DIM(dst_arr, 2) == 4);
-    assert(PyArray_TYPE(src_arr) == NPY_UINT16);
-    assert(PyArray_TYPE(dst_arr) == NPY_UINT16);
-    assert(PyArray_ISCARRAY(src_arr));
-    assert(PyArray_ISCARRAY(dst_arr));
-    assert(PySequence_Check(seeds));
-#endif
-    if (min_x < 0) min_x = 0;
-    if (min_y < 0) min_y = 0;
-    if (max_x > MYPAINT_TILE_SIZE-1) max_x = MYPAINT_TILE_SIZE-1;
-    if (max_y > MYPAINT_TILE_SIZE-1) max_y = MYPAINT_TILE_SIZE-1;
+typedef bool _floodfill_edges[_FLOODFILL_NUM_DIRECTIONS][MYPAINT_TILE_SIZE];
+
+
+// Flood-fills one tile, starting at a list of seed points.
+//
+// This doesn't use the Python API, so it can run without the GIL. Where the
+// fill reaches the edge of the tile, flags are set in `overflows`, which is
+// indexed by direction and then by the pixel position along that edge.
+// Returns the number of pixels filled.
+
+static int
+_floodfill_tile(PyArrayObject *src_arr,
+                PyArrayObject *dst_arr,
+                const std::vector<_floodfill_point> &seeds,
+                const fix15_short_t targ[4],
+                const double fill_r, const double fill_g, const double fill_b,
+                const int min_x, const int min_y,
+                const int max_x, const int max_y,
+                const fix15_t tolerance,
+                _floodfill_edges overflows)
+{
+    int nfilled = 0;
     if (min_x > max_x || min_y > max_y) {
-        return Py_BuildValue("[()()()()]");
+        return nfilled;
     }
 
     // Populate a working queue with seeds
-    int x = 0;
-    int y = 0;
-    GQueue *queue = g_queue_new();   /* Of tuples, to be exhausted */
-    for (int i=0; i<PySequence_Size(seeds); ++i) {
-        PyObject *seed_tup = PySequence_GetItem(seeds, i);
-#ifdef HEAVY_DEBUG
-        assert(PySequence_Size(seed_tup) == 2);
-#endif
-        if (! PyArg_ParseTuple(seed_tup, "ii", &x, &y)) {
-            continue;
-        }
-        Py_DECREF(seed_tup);
-        x = MAX(0, MIN(x, MYPAINT_TILE_SIZE-1));
-        y = MAX(0, MIN(y, MYPAINT_TILE_SIZE-1));
+    std::vector<_floodfill_point> queue;
+    for (size_t i=0; i<seeds.size(); ++i) {
+        const int x = MIN((int)seeds[i].x, MYPAINT_TILE_SIZE-1);
+        const int y = MIN((int)seeds[i].y, MYPAINT_TILE_SIZE-1);
         const fix15_short_t *src_pixel = _floodfill_getpixel(src_arr, x, y);
         const fix15_short_t *dst_pixel = _floodfill_getpixel(dst_arr, x, y);
         if (_floodfill_should_fill(src_pixel, dst_pixel, targ, tolerance)) {
-            _floodfill_point *seed_pt = (_floodfill_point*)
-                                          malloc(sizeof(_floodfill_point));
-            seed_pt->x = x;
-            seed_pt->y = y;
-            g_queue_push_tail(queue, seed_pt);
+            _floodfill_point seed_pt = {(unsigned int)x, (unsigned int)y};
+            queue.push_back(seed_pt);
         }
     }
 
-    PyObject *result_n = PyList_New(0);
-    PyObject *result_e = PyList_New(0);
-    PyObject *result_s = PyList_New(0);
-    PyObject *result_w = PyList_New(0);
-
-    while (! g_queue_is_empty(queue)) {
-        _floodfill_point *pos = (_floodfill_point*) g_queue_pop_head(queue);
-        int x0 = pos->x;
-        int y = pos->y;
-        free(pos);
+    // The queue is processed as a stack: order doesn't matter.
+    while (! queue.empty()) {
+        const _floodfill_point pos = queue.back();
+        queue.pop_back();
+        int x0 = pos.x;
+        int y = pos.y;
+        // Queued pixels may have been filled since they were queued,
+        // in which case their neighbours have been dealt with already.
+        if (_floodfill_getpixel(dst_arr, x0, y)[3] != 0) {
+            continue;
+        }
         // Find easternmost and westernmost points of the same colour
         // Westwards loop includes (x,y), eastwards ignores it.
         static const int x_delta[] = {-1, 1};
@@ -252,6 +233,7 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
                 dst_pixel[1] = fix15_short_clamp(fill_g * alpha);
                 dst_pixel[2] = fix15_short_clamp(fill_b * alpha);
                 dst_pixel[3] = alpha;
+                ++nfilled;
                 // In addition, enqueue the pixels above and below.
                 // Scanline algorithm here to avoid some pointless queue faff.
                 if (y > 0) {
@@ -268,12 +250,9 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
                     if (match_above) {
                         if (look_above) {
                             // Enqueue the pixel to the north
-                            _floodfill_point *p = (_floodfill_point *) malloc(
-                                                    sizeof(_floodfill_point)
-                                                  );
-                            p->x = x;
-                            p->y = y-1;
-                            g_queue_push_tail(queue, p);
+                            _floodfill_point p = {(unsigned int)x,
+                                                  (unsigned int)(y-1)};
+                            queue.push_back(p);
                             look_above = false;
                         }
                     }
@@ -284,12 +263,7 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
                 else {
                     // Overflow onto the tile to the North.
                     // Scanlining not possible here: pixel is over the border.
-                    PyObject *s = Py_BuildValue("ii", x, MYPAINT_TILE_SIZE-1);
-                    PyList_Append(result_n, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    overflows[_FLOODFILL_NORTH][x] = true;
                 }
                 if (y < MYPAINT_TILE_SIZE - 1) {
                     fix15_short_t *src_pixel_below = _floodfill_getpixel(
@@ -306,12 +280,9 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
                     if (match_below) {
                         if (look_below) {
                             // Enqueue the pixel to the South
-                            _floodfill_point *p = (_floodfill_point *) malloc(
-                                                    sizeof(_floodfill_point)
-                                                  );
-                            p->x = x;
-                            p->y = y+1;
-                            g_queue_push_tail(queue, p);
+                            _floodfill_point p = {(unsigned int)x,
+                                                  (unsigned int)(y+1)};
+                            queue.push_back(p);
                             look_below = false;
                         }
                     }
@@ -322,51 +293,394 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
                 else {
                     // Overflow onto the tile to the South
                     // Scanlining not possible here: pixel is over the border.
-                    PyObject *s = Py_BuildValue("ii", x, 0);
-                    PyList_Append(result_s, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    overflows[_FLOODFILL_SOUTH][x] = true;
                 }
                 // If the fill is now at the west or east extreme, we have
                 // overflowed there too.  Seed West and East tiles.
                 if (x == 0) {
-                    PyObject *s = Py_BuildValue("ii", MYPAINT_TILE_SIZE-1, y);
-                    PyList_Append(result_w, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    overflows[_FLOODFILL_WEST][y] = true;
                 }
                 else if (x == MYPAINT_TILE_SIZE-1) {
-                    PyObject *s = Py_BuildValue("ii", 0, y);
-                    PyList_Append(result_e, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    overflows[_FLOODFILL_EAST][y] = true;
                 }
             }
         }
     }
+    return nfilled;
+}
 
-    // Clean up working state, and return where the fill has overflowed
-    // into neighbouring tiles.
-    g_queue_free(queue);
-    PyObject *result = Py_BuildValue("[OOOO]", result_n, result_e,
-                                               result_s, result_w);
-    Py_DECREF(result_n);
-    Py_DECREF(result_e);
-    Py_DECREF(result_s);
-    Py_DECREF(result_w);
+
+// Seed point in a neighbouring tile for an overflow flag
+
+static inline _floodfill_point
+_floodfill_overflow_seed(const int direction, const int i)
+{
+    static const int last = MYPAINT_TILE_SIZE - 1;
+    _floodfill_point p = {0, 0};
+    switch (direction) {
+        case _FLOODFILL_NORTH: p.x = i; p.y = last; break;
+        case _FLOODFILL_EAST:  p.x = 0; p.y = i; break;
+        case _FLOODFILL_SOUTH: p.x = i; p.y = 0; break;
+        case _FLOODFILL_WEST:  p.x = last; p.y = i; break;
+    }
+    return p;
+}
+
+
+// Flood fill implementation (single tile)
+
+PyObject *
+tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
+                 PyObject *dst, /* output HxWx4 array of uint16 */
+                 PyObject *seeds, /* List of 2-tuples */
+                 int targ_r, int targ_g, int targ_b, int targ_a, //premult
+                 double fill_r, double fill_g, double fill_b,
+                 int min_x, int min_y, int max_x, int max_y,
+                 double tol) /* [0..1] */
+{
+    // Scale the fractional tolerance arg
+    const fix15_t tolerance = (fix15_t)(  MIN(1.0, MAX(0.0, tol))
+                                        * fix15_one);
+
+    // Fill colour args are floats [0.0 .. 1.0], non-premultiplied by alpha.
+    // The targ_ colour components are 15-bit scaled ints in the range
+    // [0 .. 1<<15], and are premultiplied by targ_a which has the same range.
+    const fix15_short_t targ[4] = {
+            fix15_short_clamp(targ_r), fix15_short_clamp(targ_g),
+            fix15_short_clamp(targ_b), fix15_short_clamp(targ_a)
+        };
+    PyArrayObject *src_arr = ((PyArrayObject *)src);
+    PyArrayObject *dst_arr = ((PyArrayObject *)dst);
+    // Dimensions are [y][x][component]
 #ifdef HEAVY_DEBUG
-    assert(result_n->ob_refcnt == 1);
-    assert(result_e->ob_refcnt == 1);
-    assert(result_s->ob_refcnt == 1);
-    assert(result_w->ob_refcnt == 1);
-    assert(result->ob_refcnt == 1);
+    assert(PyArray_Check(src));
+    assert(PyArray_Check(dst));
+    assert(PyArray_DIM(src_arr, 0) == MYPAINT_TILE_SIZE);
+    assert(PyArray_DIM(dst_arr, 0) == MYPAINT_TILE_SIZE);
+    assert(PyArray_DIM(src_arr, 1) == MYPAINT_TILE_SIZE);
+    assert(PyArray_DIM(dst_arr, 1) == MYPAINT_TILE_SIZE);
+    assert(PyArray_DIM(src_arr, 2) == 4);
+    assert(PyArray_DIM(dst_arr, 2) == 4);
+    assert(PyArray_TYPE(src_arr) == NPY_UINT16);
+    assert(PyArray_TYPE(dst_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(src_arr));
+    assert(PyArray_ISCARRAY(dst_arr));
+    assert(PySequence_Check(seeds));
 #endif
+    if (min_x < 0) min_x = 0;
+    if (min_y < 0) min_y = 0;
+    if (max_x > MYPAINT_TILE_SIZE-1) max_x = MYPAINT_TILE_SIZE-1;
+    if (max_y > MYPAINT_TILE_SIZE-1) max_y = MYPAINT_TILE_SIZE-1;
+    if (min_x > max_x || min_y > max_y) {
+        return Py_BuildValue("[()()()()]");
+    }
+
+    // Convert the seeds
+    std::vector<_floodfill_point> seed_pts;
+    for (int i=0; i<PySequence_Size(seeds); ++i) {
+        PyObject *seed_tup = PySequence_GetItem(seeds, i);
+        int x = 0;
+        int y = 0;
+        bool ok = PyArg_ParseTuple(seed_tup, "ii", &x, &y);
+        Py_DECREF(seed_tup);
+        if (! ok) {
+            PyErr_Clear();
+            continue;
+        }
+        x = MAX(0, MIN(x, MYPAINT_TILE_SIZE-1));
+        y = MAX(0, MIN(y, MYPAINT_TILE_SIZE-1));
+        _floodfill_point seed_pt = {(unsigned int)x, (unsigned int)y};
+        seed_pts.push_back(seed_pt);
+    }
+
+    _floodfill_edges overflows = {{false}};
+    _floodfill_tile(src_arr, dst_arr, seed_pts, targ,
+                    fill_r, fill_g, fill_b,
+                    min_x, min_y, max_x, max_y,
+                    tolerance, overflows);
+
+    // Return where the fill has overflowed into neighbouring tiles.
+    PyObject *result = PyList_New(_FLOODFILL_NUM_DIRECTIONS);
+    for (int d=0; d<_FLOODFILL_NUM_DIRECTIONS; ++d) {
+        PyObject *seeds_out = PyList_New(0);
+        for (int i=0; i<MYPAINT_TILE_SIZE; ++i) {
+            if (! overflows[d][i]) {
+                continue;
+            }
+            const _floodfill_point p = _floodfill_overflow_seed(d, i);
+            PyObject *s = Py_BuildValue("ii", p.x, p.y);
+            PyList_Append(seeds_out, s);
+            Py_DECREF(s);
+        }
+        PyList_SET_ITEM(result, d, seeds_out);  // steals the ref
+    }
     return result;
 }
 
+
+// Flood fill implementation (whole surface)
+
+// Integer division rounding towards negative infinity, for tile indices
+
+static inline int
+_floodfill_floor_div(const int a, const int b)
+{
+    const int q = a / b;
+    return (a % b != 0 && a < 0) ? q - 1 : q;
+}
+
+
+// Per-tile state for flood_fill_tiles()
+
+typedef std::pair<int, int> _floodfill_tile_index;
+
+struct _floodfill_tile_state {
+    PyArrayObject *src;        // owned ref, fetched when first needed
+    PyArrayObject *dst;        // owned ref, made when first needed
+    bool queued;               // in the work queue already
+    int nfilled;               // pixels filled so far
+    _floodfill_edges seeds;    // pending seeds, merged by edge position
+};
+
+typedef std::map<_floodfill_tile_index, _floodfill_tile_state>
+        _floodfill_tile_map;
+
+
+static void
+_floodfill_tile_state_init(_floodfill_tile_state &state)
+{
+    state.src = NULL;
+    state.dst = NULL;
+    state.queued = false;
+    state.nfilled = 0;
+    for (int d=0; d<_FLOODFILL_NUM_DIRECTIONS; ++d) {
+        for (int i=0; i<MYPAINT_TILE_SIZE; ++i) {
+            state.seeds[d][i] = false;
+        }
+    }
+}
+
+
+static void
+_floodfill_tile_map_clear(_floodfill_tile_map &tiles)
+{
+    _floodfill_tile_map::iterator it;
+    for (it = tiles.begin(); it != tiles.end(); ++it) {
+        Py_XDECREF(it->second.src);
+        Py_XDECREF(it->second.dst);
+    }
+    tiles.clear();
+}
+
+
+// Fetches a source tile by calling get_src_tile(tx, ty).
+// Returns a new reference, or NULL with an exception set.
+
+static PyArrayObject *
+_floodfill_get_src_tile(PyObject *get_src_tile, int tx, int ty)
+{
+    PyObject *tile = PyObject_CallFunction(get_src_tile, (char *)"ii",
+                                           tx, ty);
+    if (tile == NULL) {
+        return NULL;
+    }
+    PyArrayObject *arr = (PyArrayObject *)tile;
+    if (! PyArray_Check(tile)
+        || PyArray_NDIM(arr) != 3
+        || PyArray_DIM(arr, 0) != MYPAINT_TILE_SIZE
+        || PyArray_DIM(arr, 1) != MYPAINT_TILE_SIZE
+        || PyArray_DIM(arr, 2) != 4
+        || PyArray_TYPE(arr) != NPY_UINT16)
+    {
+        Py_DECREF(tile);
+        PyErr_SetString(PyExc_TypeError,
+                        "get_src_tile() must return a tile array "
+                        "(NxNx4 uint16)");
+        return NULL;
+    }
+    return arr;
+}
+
+
+PyObject *
+flood_fill_tiles (PyObject *get_src_tile,
+                  int x, int y,
+                  int targ_r, int targ_g, int targ_b, int targ_a, //premult
+                  double fill_r, double fill_g, double fill_b,
+                  int bbx, int bby, int bbw, int bbh,
+                  double tol, /* [0..1] */
+                  PyObject *progress_cb)
+{
+    static const int N = MYPAINT_TILE_SIZE;
+    static const int progress_interval = 32;  // tiles
+
+    const fix15_t tolerance = (fix15_t)(  MIN(1.0, MAX(0.0, tol))
+                                        * fix15_one);
+    const fix15_short_t targ[4] = {
+            fix15_short_clamp(targ_r), fix15_short_clamp(targ_g),
+            fix15_short_clamp(targ_b), fix15_short_clamp(targ_a)
+        };
+    if (progress_cb == Py_None) {
+        progress_cb = NULL;
+    }
+
+    // Limits: pixel bbox, and the range of tiles it touches
+    PyObject *result = PyDict_New();
+    if (bbw <= 0 || bbh <= 0) {
+        return result;
+    }
+    const int bbx1 = bbx + bbw - 1;
+    const int bby1 = bby + bbh - 1;
+    if (x < bbx || x > bbx1 || y < bby || y > bby1) {
+        return result;
+    }
+    const int min_tx = _floodfill_floor_div(bbx, N);
+    const int min_ty = _floodfill_floor_div(bby, N);
+    const int max_tx = _floodfill_floor_div(bbx1, N);
+    const int max_ty = _floodfill_floor_div(bby1, N);
+
+    // Work queue of tile indices. Each tile is queued at most once at a
+    // time, however many seeds overflow into it before it's processed.
+    _floodfill_tile_map tiles;
+    std::deque<_floodfill_tile_index> queue;
+    const _floodfill_tile_index start(_floodfill_floor_div(x, N),
+                                      _floodfill_floor_div(y, N));
+    std::vector<_floodfill_point> seed_pts;
+    _floodfill_point start_pt = {(unsigned int)(x - start.first*N),
+                                 (unsigned int)(y - start.second*N)};
+    seed_pts.push_back(start_pt);
+    _floodfill_tile_state &start_state = tiles[start];
+    _floodfill_tile_state_init(start_state);
+    start_state.queued = true;
+    queue.push_back(start);
+
+    int ndone = 0;
+    bool first = true;
+    while (! queue.empty()) {
+        const _floodfill_tile_index ti = queue.front();
+        queue.pop_front();
+        _floodfill_tile_state &state = tiles[ti];
+        state.queued = false;
+        const int tx = ti.first;
+        const int ty = ti.second;
+
+        // Gather up the merged seeds.
+        if (! first) {
+            seed_pts.clear();
+            for (int d=0; d<_FLOODFILL_NUM_DIRECTIONS; ++d) {
+                for (int i=0; i<N; ++i) {
+                    if (state.seeds[d][i]) {
+                        seed_pts.push_back(_floodfill_overflow_seed(d, i));
+                        state.seeds[d][i] = false;
+                    }
+                }
+            }
+        }
+        first = false;
+
+        // Tile arrays
+        if (state.src == NULL) {
+            state.src = _floodfill_get_src_tile(get_src_tile, tx, ty);
+            if (state.src == NULL) {
+                _floodfill_tile_map_clear(tiles);
+                Py_DECREF(result);
+                return NULL;
+            }
+        }
+        if (state.dst == NULL) {
+            npy_intp dims[] = {N, N, 4};
+            state.dst = (PyArrayObject *)PyArray_ZEROS(3, dims, NPY_UINT16, 0);
+            if (state.dst == NULL) {
+                _floodfill_tile_map_clear(tiles);
+                Py_DECREF(result);
+                return NULL;
+            }
+        }
+
+        // Pixel limits within this tile vary at the edges of the bbox
+        const int min_px = (tx == min_tx) ? (bbx - tx*N) : 0;
+        const int min_py = (ty == min_ty) ? (bby - ty*N) : 0;
+        const int max_px = (tx == max_tx) ? (bbx1 - tx*N) : (N-1);
+        const int max_py = (ty == max_ty) ? (bby1 - ty*N) : (N-1);
+
+        // Fill the tile
+        _floodfill_edges overflows = {{false}};
+        int nfilled = 0;
+        Py_BEGIN_ALLOW_THREADS
+        nfilled = _floodfill_tile(state.src, state.dst, seed_pts, targ,
+                                  fill_r, fill_g, fill_b,
+                                  min_px, min_py, max_px, max_py,
+                                  tolerance, overflows);
+        Py_END_ALLOW_THREADS
+        state.nfilled += nfilled;
+
+        // Merge overflows into the neighbours' pending seeds
+        static const int dtx[] = {0, 1, 0, -1};
+        static const int dty[] = {-1, 0, 1, 0};
+        for (int d=0; d<_FLOODFILL_NUM_DIRECTIONS; ++d) {
+            const _floodfill_tile_index nti(tx + dtx[d], ty + dty[d]);
+            if (nti.first < min_tx || nti.first > max_tx
+                || nti.second < min_ty || nti.second > max_ty)
+            {
+                continue;
+            }
+            bool any = false;
+            for (int i=0; i<N; ++i) {
+                if (overflows[d][i]) {
+                    any = true;
+                    break;
+                }
+            }
+            if (! any) {
+                continue;
+            }
+            _floodfill_tile_map::iterator it = tiles.find(nti);
+            if (it == tiles.end()) {
+                _floodfill_tile_state &nstate = tiles[nti];
+                _floodfill_tile_state_init(nstate);
+                it = tiles.find(nti);
+            }
+            _floodfill_tile_state &nstate = it->second;
+            for (int i=0; i<N; ++i) {
+                if (overflows[d][i]) {
+                    nstate.seeds[d][i] = true;
+                }
+            }
+            if (! nstate.queued) {
+                nstate.queued = true;
+                queue.push_back(nti);
+            }
+        }
+
+        // Report progress, and allow cancellation
+        ++ndone;
+        if (progress_cb && (ndone % progress_interval == 0)) {
+            PyObject *r = PyObject_CallFunction(progress_cb, (char *)"ii",
+                                                ndone, (int)queue.size());
+            int keep_going = (r == NULL) ? -1 : PyObject_IsTrue(r);
+            Py_XDECREF(r);
+            if (keep_going <= 0) {
+                _floodfill_tile_map_clear(tiles);
+                Py_DECREF(result);
+                if (keep_going < 0) {
+                    return NULL;
+                }
+                Py_RETURN_NONE;
+            }
+        }
+    }
+
+    // Return the tiles which were filled
+    _floodfill_tile_map::iterator it;
+    for (it = tiles.begin(); it != tiles.end(); ++it) {
+        if (it->second.nfilled <= 0) {
+            continue;
+        }
+        PyObject *key = Py_BuildValue("ii", it->first.first,
+                                      it->first.second);
+        PyDict_SetItem(result, key, (PyObject *)it->second.dst);
+        Py_DECREF(key);
+    }
+    _floodfill_tile_map_clear(tiles);
+    return result;
+}
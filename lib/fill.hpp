@@ -30,5 +30,30 @@ tile_flood_fill (PyObject *src,     // readonly HxWx4 array of uint16
                  double tolerance);       // [0..1]
 
 
+// Flood-fills connected areas of a tiled surface, starting at a seed pixel.
+//
+// Source tiles are fetched as needed by calling get_src_tile(tx, ty), which
+// must return a readonly NxNx4 array of uint16. The fill is limited to the
+// pixel bbox (bbx, bby, bbw, bbh). Seeds which overflow into a neighbouring
+// tile are merged and deduplicated, and each tile is queued at most once at
+// a time.
+//
+// If progress_cb is not None, it is called as progress_cb(tiles_done,
+// tiles_queued) every so often. If it returns a false value, the fill is
+// cancelled and None is returned.
+//
+// Returns a dict {(tx, ty): array} of the tiles which were filled, as NxNx4
+// arrays of uint16, ready to be composited over a destination surface.
+
+PyObject *
+flood_fill_tiles (PyObject *get_src_tile,  // callable (tx, ty) -> array
+                  int x, int y,            // seed pixel, model coords
+                  int targ_r, int targ_g, int targ_b, int targ_a, //premult
+                  double fill_r, double fill_g, double fill_b,
+                  int bbx, int bby, int bbw, int bbh,
+                  double tolerance,        // [0..1]
+                  PyObject *progress_cb);  // callable or None
+
+
 #endif //__HAVE_FILL_HPP
 
@@ -460,6 +460,27 @@ def zipfile_writestr(z, arcname, data):
     z.writestr(zi, data)
 
 
+def zipfile_open(z, arcname):
+    """Open a zipfile entry for reading, tolerating bad member names
+
+    :param zipfile.ZipFile z: A zip file open for reading.
+    :param unicode arcname: Name of the file entry to open.
+    :returns: a file-like object for reading the entry's data
+
+    Old versions of the GIMP ORA plugin wrote UTF-8 encoded names
+    without setting the UTF-8 flag, so those are tried too.
+
+    """
+    try:
+        return z.open(arcname, mode='r')
+    except KeyError:
+        fp = z.open(arcname.encode('utf-8'), mode='r')
+        logger.warning('Bad ZIP file. There is an utf-8 encoded '
+                       'filename that does not have the utf-8 '
+                       'flag set: %r', arcname)
+        return fp
+
+
 def run_garbage_collector():
     logger.info('MEM: garbage collector run, collected %d objects',
                 gc.collect())
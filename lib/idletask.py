@@ -13,9 +13,85 @@
 from __future__ import division, print_function
 
 import collections
+import time
+import logging
 
 from gi.repository import GLib
 
+logger = logging.getLogger(__name__)
+
+
+## Module constants
+
+#: Suggested time budget for time-sliced processors, in seconds.
+DEFAULT_TIME_BUDGET = 0.004
+
+#: Limits for adaptive time budgets, in seconds.
+MIN_TIME_BUDGET = 0.001
+MAX_TIME_BUDGET = 0.016
+
+#: Time between dispatches which adaptive budgets allow the rest of
+#: the main loop, in seconds. Roughly one frame at 60fps.
+TARGET_FRAME_TIME = 1/60
+
+
+## Task timing counters
+
+#: Timing counters for one kind of task.
+#: Times are totals and maxima per call, in seconds.
+TaskStats = collections.namedtuple(
+    "TaskStats",
+    ["calls", "total_time", "max_time"],
+)
+
+_task_stats = {}  # {name: [calls, total_time, max_time]}, all processors
+
+
+def get_task_stats():
+    """Returns timing counters for all the tasks run by all processors
+
+    :returns: counters for each kind of task, by name
+    :rtype: dict
+
+    Tasks are named after their function, or their class if they're
+    callable objects.
+
+    """
+    return dict(
+        (name, TaskStats(*counts))
+        for name, counts in _task_stats.iteritems()
+    )
+
+
+def reset_task_stats():
+    """Resets the counters returned by get_task_stats()"""
+    _task_stats.clear()
+
+
+def _get_task_name(func):
+    """Internal: name to count a task under"""
+    name = getattr(func, "__name__", None)
+    if name is None:
+        return func.__class__.__name__
+    owner = getattr(func, "__self__", None)
+    if owner is not None:
+        return "%s.%s" % (owner.__class__.__name__, name)
+    return name
+
+
+def _count(stats, name, dt):
+    """Internal: updates a dict of timing counters"""
+    counts = stats.get(name)
+    if counts is None:
+        stats[name] = [1, dt, dt]
+    else:
+        counts[0] += 1
+        counts[1] += dt
+        counts[2] = max(counts[2], dt)
+
+
+## Class defs
+
 
 class Processor (object):
     """Queue of low priority tasks for background processing
@@ -25,14 +101,60 @@ class Processor (object):
 
     The default priority is much lower than gui event processing.
 
+    By default, each idle dispatch makes just one call to the task at
+    the head of the queue. In time-sliced mode, calls are made until a
+    time budget has been spent instead, so cheap tasks get through
+    their work faster. The budget can be adapted to how much time the
+    rest of the main loop is taking between dispatches.
+
+    >>> proc = Processor(time_budget=DEFAULT_TIME_BUDGET)
+    >>> items = list(range(100))
+    >>> proc.add_work(lambda: items.pop() > 50)
+    >>> proc.finish_all()
+    >>> len(items), proc.stats["<lambda>"].calls
+    (50, 50)
+
     """
 
-    def __init__(self, priority=GLib.PRIORITY_LOW):
-        """Initialize, specifying a priority"""
+    def __init__(self, priority=GLib.PRIORITY_LOW, time_budget=None,
+                 adaptive=False):
+        """Initialize, specifying a priority
+
+        :param int priority: Priority for the idle callbacks
+        :param float time_budget: Seconds of work per idle dispatch.
+            None means make just one call per dispatch.
+        :param bool adaptive: Adapt the time budget to how busy the
+            main loop is (time-sliced mode only).
+
+        """
         object.__init__(self)
         self._queue = collections.deque()
         self._priority = priority
         self._idle_id = None
+        self._time_budget = time_budget
+        self._adaptive = bool(adaptive and time_budget)
+        self._last_dispatch_end = None
+        self._stats = {}  # {name: [calls, total_time, max_time]}
+
+    @property
+    def time_budget(self):
+        """Current time budget per idle dispatch, in seconds (or None)"""
+        return self._time_budget
+
+    @property
+    def stats(self):
+        """Timing counters for the tasks this processor has run
+
+        :returns: counters for each kind of task, by name
+        :rtype: dict
+
+        See also: `get_task_stats()`.
+
+        """
+        return dict(
+            (name, TaskStats(*counts))
+            for name, counts in self._stats.iteritems()
+        )
 
     def has_work(self):
         return len(self._queue) > 0
@@ -73,17 +195,63 @@ class Processor (object):
             GLib.source_remove(self._idle_id)
             self._idle_id = None
         self._queue.clear()
+        self._last_dispatch_end = None
         assert self._idle_id is None
         assert len(self._queue) == 0
 
     def _process(self):
         if not self._idle_id:
             return False
-        if len(self._queue) > 0:
+        t0 = time.time()
+        if self._adaptive:
+            self._adapt_time_budget(t0)
+        budget = self._time_budget
+        while self._idle_id and len(self._queue) > 0:
             func, args, kwargs = self._queue[0]
+            t_call = time.time()
             func_done = bool(func(*args, **kwargs))
+            t1 = time.time()
+            name = _get_task_name(func)
+            _count(self._stats, name, t1 - t_call)
+            _count(_task_stats, name, t1 - t_call)
             if not func_done:
                 self._queue.popleft()
+            if budget is None or (t1 - t0) >= budget:
+                break
         if len(self._queue) == 0:
             self._idle_id = None
+            self._last_dispatch_end = None
+        else:
+            self._last_dispatch_end = time.time()
         return bool(self._queue)
+
+    def _adapt_time_budget(self, now):
+        """Shrinks the budget if the main loop is busy, or grows it
+
+        The time since the end of the previous dispatch is what the
+        rest of the main loop spent, drawing frames for example.
+
+        """
+        if self._last_dispatch_end is None:
+            return
+        elsewhere = now - self._last_dispatch_end
+        if elsewhere > TARGET_FRAME_TIME:
+            budget = self._time_budget * 0.5
+        else:
+            budget = self._time_budget * 1.25
+        budget = max(MIN_TIME_BUDGET, min(MAX_TIME_BUDGET, budget))
+        self._time_budget = budget
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -707,7 +707,8 @@ class LayerBase (TileBlittable, TileCompositable):
 
     ## Flood fill
 
-    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None):
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None,
+                   progress_cb=None):
         """Fills a point on the surface with a color
 
         See PaintingLayer.flood_fill() for parameters and semantics.
@@ -799,6 +800,22 @@ class LayerBase (TileBlittable, TileCompositable):
         """
         raise NotImplementedError
 
+    def update_mipmaps(self, max_tiles, priority_bboxes=(),
+                       priority_only=False):
+        """Regenerates a batch of the layer's dirty mipmap tiles
+
+        :param int max_tiles: Maximum number of tiles to regenerate
+        :param iterable priority_bboxes: Model areas to do first
+        :param bool priority_only: Only do tiles in priority_bboxes
+        :returns: the number of tiles regenerated
+        :rtype: int
+
+        This is called in idle time by the root stack, so that zoomed
+        out views don't have to regenerate lots of mipmap tiles at once
+        when they're first drawn. The base implementation does nothing.
+        """
+        return 0
+
     ## Translation
 
     def get_move(self, x, y):
@@ -867,7 +884,8 @@ class LayerBase (TileBlittable, TileCompositable):
                            canvas_bbox, frame_bbox, **kwargs):
         """Saves the layer's data into an open OpenRaster ZipFile
 
-        :param orazip: a `zipfile.ZipFile` open for write
+        :param orazip: the zipfile being written
+        :type orazip: lib.zipwriter.ParallelZipWriter
         :param tmpdir: path to a temp dir, removed after the save
         :param path: Unique path of the layer, for encoding in filenames
         :type path: tuple of ints
@@ -961,6 +979,16 @@ class LayerBase (TileBlittable, TileCompositable):
         """Restores the layer from snapshot data"""
         sshot.restore_to_layer(self)
 
+    def get_tiledicts(self):
+        """Returns the tiledicts holding the layer's pixel data
+
+        :rtype: list
+
+        This is used for estimating memory use. The base implementation
+        returns an empty list.
+        """
+        return []
+
     ## Trimming
 
     def trim(self, rect):
@@ -1000,6 +1028,22 @@ class LayerBaseSnapshot (object):
         layer.visible = self.visible
         layer.locked = self.locked
 
+    def get_tiledicts(self):
+        """Returns the tiledicts held by the snapshot (see LayerBase)"""
+        return []
+
+    def get_changed_tiledicts(self, other):
+        """Returns tiledicts of the tiles which another state doesn't share
+
+        :param other: A later snapshot of the same layer, or the layer
+        :returns: tiledicts, or None if they can't be found cheaply
+        :rtype: list
+
+        This is used for estimating the memory retained for undo without
+        examining every tile. The base implementation returns None.
+        """
+        return None
+
 
 class ExternallyEditable:
     """Interface for layers which can be edited in an external app"""
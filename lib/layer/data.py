@@ -26,6 +26,7 @@ from copy import deepcopy
 from random import randint
 import uuid
 import struct
+import itertools
 
 from lib.gettext import C_
 import lib.tiledsurface as tiledsurface
@@ -33,6 +34,7 @@ import lib.strokemap
 import lib.helpers as helpers
 import lib.fileutils
 import lib.pixbuf
+from lib.errors import FileHandlingError
 from lib.modes import *
 import core
 import lib.layer.error
@@ -40,6 +42,13 @@ import lib.autosave
 import lib.xml
 
 
+## Module constants
+
+# Numbers for naming autosaved PNGs. Each one gets a new name, so that
+# the stack.xml written before it still refers to a consistent set.
+_AUTOSAVE_PNG_SERIALS = itertools.count()
+
+
 ## Base classes
 
 
@@ -62,6 +71,18 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     #: Substitute content if the layer cannot be loaded.
     FALLBACK_CONTENT = None
 
+    #: Errors which make PNG loading fall back to GdkPixbuf.
+    #: It's slower, but it supports interlaced PNGs for example.
+    _PNG_STREAM_ERRORS = (
+        EnvironmentError,
+        KeyError,
+        zipfile.BadZipfile,
+        FileHandlingError,
+    )
+
+    #: Autosaved layers list their tile log, if any, in this attribute.
+    _ORA_TILE_LOG_ATTR = "{%s}tile-log" % (lib.xml.OPENRASTER_MYPAINT_NS,)
+
     ## Initialization
 
     def __init__(self, surface=None, **kwargs):
@@ -76,6 +97,13 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         """
         super(SurfaceBackedLayer, self).__init__(**kwargs)
 
+        # Where data was last loaded from or saved to, for reuse.
+        # {kind: (ora_ref, member_name, key, info)}
+        self._ora_members = {}
+
+        # Changes since the autosaved PNG was written (non-looped only)
+        self._autosave_tilelog = None
+
         # Pluggable surface implementation
         # Only connect observers if using the default tiled surface
         if surface is None:
@@ -165,28 +193,59 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
                 "Only %r are supported" % (suffixes,),
             )
         # Delegate the actual loading part
-        self._load_surface_from_orazip_member(
+        rect = self._load_surface_from_orazip_member(
             orazip,
             cache_dir,
             src,
             feedback_cb,
             x, y,
         )
+        # The loaded PNG can be copied when saving if nothing changes.
+        # The caller can identify the zipfile with an "ora_ref" kwarg.
+        if rect is not None:
+            self._record_ora_member(
+                "png",
+                kwargs.get("ora_ref"),
+                src,
+                self._surface.content_generation,
+                tuple(rect),
+            )
 
     def _load_surface_from_orazip_member(self, orazip, cache_dir,
                                          src, feedback_cb, x, y):
         """Loads the surface from a member of an OpenRaster zipfile
 
+        :returns: Position and size of the loaded image, or None
+        :rtype: tuple
+
         Intended strictly for override by subclasses which need to first
         extract and then keep the file around afterwards.
 
+        PNG data is streamed from the zipfile straight into the
+        surface's tiles if possible, without an intermediate pixbuf.
+
         """
+        if src.lower().endswith(".png"):
+            try:
+                fp = helpers.zipfile_open(orazip, src)
+                try:
+                    return self._surface.load_from_png_stream(
+                        fp, x, y,
+                        feedback_cb=feedback_cb,
+                    )
+                finally:
+                    fp.close()
+            except self._PNG_STREAM_ERRORS as err:
+                logger.warning(
+                    "Streaming %r failed (%s), trying GdkPixbuf",
+                    src, err,
+                )
         pixbuf = lib.pixbuf.load_from_zipfile(
             datazip=orazip,
             filename=src,
             feedback_cb=feedback_cb,
         )
-        self.load_surface_from_pixbuf(pixbuf, x=x, y=y)
+        return self.load_surface_from_pixbuf(pixbuf, x=x, y=y)
 
     def load_from_openraster_dir(self, oradir, elem, cache_dir, feedback_cb,
                                  x=0, y=0, **kwargs):
@@ -234,17 +293,44 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             feedback_cb,
             x, y,
         )
+        # Autosaves may have later changes to apply on top of that.
+        tilelog_src = attrs.get(self._ORA_TILE_LOG_ATTR, None)
+        if tilelog_src:
+            tilelog_path = os.path.join(oradir, tilelog_src)
+            if os.path.isfile(tilelog_path):
+                self._surface.load_tile_log(tilelog_path, x, y)
+            else:
+                logger.warning("Tile log %r is missing", tilelog_path)
 
     def _load_surface_from_oradir_member(self, oradir, cache_dir,
                                          src, feedback_cb, x, y):
         """Loads the surface from a file in an OpenRaster-like folder
 
+        :returns: Position and size of the loaded image, or None
+        :rtype: tuple
+
         Intended strictly for override by subclasses which need to
         make copies to manage.
 
+        PNG files are streamed straight into the surface's tiles if
+        possible, without an intermediate pixbuf.
+
         """
-        self.load_surface_from_pixbuf_file(
-            os.path.join(oradir, src),
+        filename = os.path.join(oradir, src)
+        if src.lower().endswith(".png"):
+            try:
+                with open(filename, "rb") as fp:
+                    return self._surface.load_from_png_stream(
+                        fp, x, y,
+                        feedback_cb=feedback_cb,
+                    )
+            except self._PNG_STREAM_ERRORS as err:
+                logger.warning(
+                    "Streaming %r failed (%s), trying GdkPixbuf",
+                    filename, err,
+                )
+        return self.load_surface_from_pixbuf_file(
+            filename,
             x, y,
             feedback_cb,
         )
@@ -304,7 +390,8 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
 
     ## Flood fill
 
-    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None):
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None,
+                   progress_cb=None):
         """Fills a point on the surface with a color
 
         See `PaintingLayer.flood_fill() for parameters and semantics. This
@@ -357,6 +444,17 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         """Renders this layer as a pixbuf"""
         return self._surface.render_as_pixbuf(*rect, **kwargs)
 
+    def update_mipmaps(self, max_tiles, priority_bboxes=(),
+                       priority_only=False):
+        """Regenerates a batch of the surface's dirty mipmap tiles"""
+        if not self._surface.has_dirty_mipmaps():
+            return 0
+        return self._surface.update_mipmaps(
+            max_tiles,
+            priority_bboxes,
+            priority_only,
+        )
+
     ## Translating
 
     def get_move(self, x, y):
@@ -384,10 +482,27 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
-        """Saves the layer's data into an open OpenRaster ZipFile"""
-        rect = self.get_bbox()
-        return self._save_rect_to_ora(orazip, tmpdir, "layer", path,
-                                      frame_bbox, rect, **kwargs)
+        """Saves the layer's data into an open OpenRaster ZipFile
+
+        If the surface hasn't changed since it was loaded from or saved
+        to the writer's source file, the PNG is copied from there
+        instead of being encoded again.
+
+        """
+        generation = self._surface.content_generation
+        pngname = self._make_refname("layer", path, ".png")
+        storepath = "data/%s" % (pngname,)
+        record = self._copy_ora_member(orazip, "png", generation, storepath)
+        if record:
+            rect = record[3]
+            elem = self._get_png_stackxml_element(storepath, frame_bbox, rect)
+        else:
+            rect = tuple(self.get_bbox())
+            elem = self._save_rect_to_ora(orazip, tmpdir, "layer", path,
+                                          frame_bbox, rect, **kwargs)
+        self._record_ora_member("png", orazip.ref, storepath,
+                                generation, rect)
+        return elem
 
     def queue_autosave(self, oradir, taskproc, manifest, bbox, **kwargs):
         """Queues the layer for auto-saving"""
@@ -404,17 +519,27 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         # mypaint-specific attribute name. If/when OpenRaster
         # standardizes looped layer data, that code should be moved
         # here.
+        #
+        # Other layers only rewrite their PNG now and then. The tiles
+        # which changed since are appended to a tile log, which the
+        # <layer/> lists too.
+
+        if not self._surface.looped:
+            elem = self._queue_autosave_tiles(oradir, taskproc, manifest,
+                                              bbox, **kwargs)
+            self.autosave_dirty = False
+            return elem
 
         png_basename = self.autosave_uuid + ".png"
         png_relpath = os.path.join("data", png_basename)
         png_path = os.path.join(oradir, png_relpath)
-        png_bbox = self._surface.looped and bbox or tuple(self.get_bbox())
+        png_bbox = bbox
         if self.autosave_dirty or not os.path.exists(png_path):
             task = tiledsurface.PNGFileUpdateTask(
                 surface = self._surface,
                 filename = png_path,
                 rect = png_bbox,
-                alpha = (not self._surface.looped),  # assume that means bg
+                alpha = False,  # looped layers are backgrounds
                 **kwargs
             )
             taskproc.add_work(task)
@@ -431,6 +556,102 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         elem.attrib["src"] = png_relpath
         return elem
 
+    def _queue_autosave_tiles(self, oradir, taskproc, manifest, bbox,
+                              **kwargs):
+        """Internal: queues auto-saving of a non-looped surface
+
+        A new PNG and an empty tile log are started if there isn't a
+        usable log yet, or if the log has grown too big. Otherwise, just
+        the tiles which changed since the last autosave are appended to
+        the log. New PNGs get new names, so the previous PNG and log
+        stay valid until the manifest cleanup removes them, after the
+        new stack.xml has been written.
+
+        Layers which haven't changed since the last autosave just
+        re-declare their existing PNG and log. Changes are found from
+        the surface's generation logs, so the cost of an update depends
+        on how much was painted, not on the size of the layer.
+
+        """
+        tilelog = self._autosave_tilelog
+        has_log = False
+        if tilelog is None or tilelog.needs_new_base():
+            sshot = self._surface.save_snapshot()
+            png_basename = u"%s-%d.png" % (
+                self.autosave_uuid,
+                next(_AUTOSAVE_PNG_SERIALS),
+            )
+            png_path = os.path.join(oradir, "data", png_basename)
+            png_bbox = tuple(self.get_bbox())
+            tilelog = tiledsurface.TileLog(
+                filename = png_path[:-4] + u".tilelog",
+                base_filename = png_path,
+                base_rect = png_bbox,
+            )
+            self._autosave_tilelog = tilelog
+            task = tiledsurface.PNGFileUpdateTask(
+                surface = self._surface,
+                filename = png_path,
+                rect = png_bbox,
+                alpha = True,
+                **kwargs
+            )
+            taskproc.add_work(task)
+            taskproc.add_work(tilelog.set_base, sshot)
+        elif self.autosave_dirty:
+            sshot = self._surface.save_snapshot()
+            changes = tilelog.get_changes(sshot)
+            if changes:
+                task = tiledsurface.TileLogUpdateTask(
+                    tilelog,
+                    sshot,
+                    changes,
+                )
+                taskproc.add_work(task)
+            has_log = bool(changes) or tilelog.size > 0
+        else:
+            has_log = tilelog.size > 0
+        # Calculate appropriate offsets
+        png_x, png_y = tilelog.base_rect[0:2]
+        ref_x, ref_y = bbox[0:2]
+        x = png_x - ref_x
+        y = png_y - ref_y
+        # Declare and index what is about to be written
+        png_relpath = os.path.relpath(tilelog.base_filename, oradir)
+        manifest.add(png_relpath)
+        elem = self._get_stackxml_element("layer", x, y)
+        elem.attrib["src"] = png_relpath
+        if has_log:
+            tilelog_relpath = os.path.relpath(tilelog.filename, oradir)
+            manifest.add(tilelog_relpath)
+            elem.attrib[self._ORA_TILE_LOG_ATTR] = tilelog_relpath
+        return elem
+
+    def _clone_surface(self):
+        """Internal: copies the surface for a worker thread to read
+
+        Saving pumps GUI events while the workers encode, so the user
+        can keep painting. Workers encode a copy made from a snapshot
+        instead of the live surface, which may change under them.
+
+        """
+        surface = self._surface
+        clone = tiledsurface.Surface(
+            looped = surface.looped,
+            looped_size = surface.looped_size,
+        )
+        clone.load_snapshot(surface.save_snapshot())
+        return clone
+
+    @staticmethod
+    def _encode_png_timed(surface, name, rect, kwargs):
+        """Internal: encodes a rectangle as PNG data, logging the time"""
+        t0 = time.time()
+        data = surface.encode_png(*rect, **kwargs)
+        t1 = time.time()
+        logger.debug('%.3fs surface encoding %r', t1-t0, name)
+        return data
+
     @staticmethod
     def _make_refname(prefix, path, suffix, sep='-'):
         """Internal: standardized filename for something wiith a path"""
@@ -443,18 +664,18 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     def _save_rect_to_ora(self, orazip, tmpdir, prefix, path,
                           frame_bbox, rect, **kwargs):
         """Internal: saves a rectangle of the surface to an ORA zip"""
-        # Write PNG data via a tempfile
+        # Encode the PNG data in parallel with other layers
         pngname = self._make_refname(prefix, path, ".png")
-        pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(pngpath, *rect, **kwargs)
-        t1 = time.time()
-        logger.debug('%.3fs surface saving %r', t1-t0, pngname)
-        # Archive and remove
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
-        # Return details
+        orazip.submit(
+            storepath,
+            self._encode_png_timed,
+            self._clone_surface(), pngname, rect, kwargs,
+        )
+        return self._get_png_stackxml_element(storepath, frame_bbox, rect)
+
+    def _get_png_stackxml_element(self, storepath, frame_bbox, rect):
+        """Internal: <layer/> for a PNG of a rect, positioned in a frame"""
         png_bbox = tuple(rect)
         png_x, png_y = png_bbox[0:2]
         ref_x, ref_y = frame_bbox[0:2]
@@ -465,6 +686,42 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         elem.attrib["src"] = storepath
         return elem
 
+    def _record_ora_member(self, kind, ora_ref, name, key, info=None):
+        """Internal: records where some of the layer's data was stored
+
+        :param str kind: What the data is, e.g. "png"
+        :param ora_ref: Identifies the OpenRaster file, or None
+        :param unicode name: Name of the member in that file
+        :param key: Compared when saving to decide whether to copy
+        :param info: Extra details, returned with the record
+
+        """
+        if ora_ref is None:
+            self._ora_members.pop(kind, None)
+        else:
+            self._ora_members[kind] = (ora_ref, name, key, info)
+
+    def _copy_ora_member(self, orazip, kind, key, arcname):
+        """Internal: copies unchanged data from the writer's source file
+
+        :param lib.zipwriter.ParallelZipWriter orazip: Output zipfile
+        :param str kind: What the data is, e.g. "png"
+        :param key: Must equal the recorded key for a copy to happen
+        :param unicode arcname: Name for the copied member
+        :returns: The record (ora_ref, name, key, info), or None
+        :rtype: tuple
+
+        """
+        record = self._ora_members.get(kind)
+        if record is None or orazip.source_ref is None:
+            return None
+        ora_ref, name, recorded_key, info = record
+        if ora_ref is not orazip.source_ref or recorded_key != key:
+            return None
+        logger.debug("Copying unchanged %r from %r", arcname, name)
+        orazip.copy_from_source(name, arcname)
+        return record
+
     ## Painting symmetry axis
 
     def set_symmetry_state(self, active, center_x):
@@ -480,6 +737,10 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         """Snapshots the state of the layer, for undo purposes"""
         return SurfaceBackedLayerSnapshot(self)
 
+    def get_tiledicts(self):
+        """Returns the tiledicts holding the layer's pixel data"""
+        return [self._surface.tiledict]
+
     ## Trimming
 
     def get_trimmable(self):
@@ -544,6 +805,22 @@ class SurfaceBackedLayerSnapshot (core.LayerBaseSnapshot):
         super(SurfaceBackedLayerSnapshot, self).restore_to_layer(layer)
         layer._surface.load_snapshot(self.surface_sshot)
 
+    def get_tiledicts(self):
+        return [self.surface_sshot.tiledict]
+
+    def get_changed_tiledicts(self, other):
+        """Tiles differing in a later snapshot, or in the layer itself
+
+        Only the tile positions logged since the snapshot are examined.
+        """
+        if isinstance(other, SurfaceBackedLayerSnapshot):
+            state = other.surface_sshot
+        elif isinstance(other, SurfaceBackedLayer):
+            state = other._surface
+        else:
+            return None
+        return [self.surface_sshot.get_changed_tiles(state)]
+
 
 class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
     """A layer with primarily file-based storage
@@ -631,7 +908,7 @@ class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
             os.makedirs(tmpdir)
         orazip.extract(src, path=tmpdir)
         tmp_filename = os.path.join(tmpdir, src)
-        self.load_surface_from_pixbuf_file(
+        rect = self.load_surface_from_pixbuf_file(
             tmp_filename,
             x, y,
             feedback_cb,
@@ -648,6 +925,7 @@ class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
         # Record its loaded position
         self._x = x
         self._y = y
+        return rect
 
     def _load_surface_from_oradir_member(self, oradir, cache_dir,
                                          src, feedback_cb, x, y):
@@ -658,7 +936,8 @@ class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
 
         """
         # Load the displayed surface tiles
-        super(FileBackedLayer, self)._load_surface_from_oradir_member(
+        load = super(FileBackedLayer, self)._load_surface_from_oradir_member
+        rect = load(
             oradir, cache_dir,
             src, feedback_cb,
             x, y,
@@ -675,6 +954,7 @@ class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
         # Record its loaded position
         self._x = x
         self._y = y
+        return rect
 
     ## Snapshots & cloning
 
@@ -741,27 +1021,35 @@ class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
         final_relpath = os.path.join("data", final_basename)
         final_path = os.path.join(oradir, final_relpath)
         if self.autosave_dirty or not os.path.exists(final_path):
-            final_dir = os.path.join(oradir, "data")
-            tmp_fp = tempfile.NamedTemporaryFile(
-                mode = "wb",
-                prefix = final_basename,
-                dir = final_dir,
-                delete = False,
+            # The task keeps the managed file alive till it's copied.
+            taskproc.add_work(
+                self._autosave_copy_cb,
+                self._workfile,
+                final_path,
             )
-            tmp_path = tmp_fp.name
-            # Copy the managed tempfile now.
-            # Though perhaps this could be processed in chunks
-            # like other layers.
-            with open(src_path, "rb") as src_fp:
-                shutil.copyfileobj(src_fp, tmp_fp)
-            tmp_fp.close()
-            lib.fileutils.replace(tmp_path, final_path)
             self.autosave_dirty = False
         # Return details of what gets written.
         manifest.add(final_relpath)
         elem.attrib["src"] = unicode(final_relpath)
         return elem
 
+    @staticmethod
+    def _autosave_copy_cb(workfile, final_path):
+        """Autosave task: copy the working file"""
+        tmp_fp = tempfile.NamedTemporaryFile(
+            mode = "wb",
+            prefix = os.path.basename(final_path),
+            dir = os.path.dirname(final_path),
+            delete = False,
+        )
+        tmp_path = tmp_fp.name
+        # Perhaps this could be processed in chunks like other layers.
+        with open(unicode(workfile), "rb") as src_fp:
+            shutil.copyfileobj(src_fp, tmp_fp)
+        tmp_fp.close()
+        lib.fileutils.replace(tmp_path, final_path)
+        return False
+
     ## Editing via external apps
 
     def new_external_edit_tempfile(self):
@@ -1011,14 +1299,12 @@ class BackgroundLayer (SurfaceBackedLayer):
         rect = (x+x0, y+y0, w, h)
 
         pngname = self._make_refname("background", path, "tile.png")
-        tmppath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(tmppath, *rect, **kwargs)
-        t1 = time.time()
         storename = 'data/%s' % (pngname,)
-        logger.debug('%.3fs surface saving %s', t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
+        orazip.submit(
+            storename,
+            self._encode_png_timed,
+            self._clone_surface(), pngname, rect, kwargs,
+        )
         elem.attrib[self.ORA_BGTILE_LEGACY_ATTR] = storename
         elem.attrib[self.ORA_BGTILE_ATTR] = storename
         return elem
@@ -1067,6 +1353,9 @@ class BackgroundLayerSnapshot (core.LayerBaseSnapshot):
         super(BackgroundLayerSnapshot, self).restore_to_layer(layer)
         layer._surface = self.surface
 
+    def get_tiledicts(self):
+        return [self.surface.tiledict]
+
 
 class VectorLayer (FileBackedLayer):
     """SVG-based vector layer
@@ -1222,10 +1511,55 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
     def __init__(self, **kwargs):
         super(PaintingLayer, self).__init__(**kwargs)
         self._external_edit = None
-        #: Stroke map.
-        #: List of strokemap.StrokeShape instances (not stroke.Stroke),
-        #: ordered by depth.
-        self.strokes = []
+        self._strokes = []
+        self._stroke_index = None  # built when first needed
+        # Raw strokemap data loaded from a file, parsed when first needed.
+        # Tuple (data, x, y): its shapes go beneath those in _strokes.
+        self._unparsed_strokemap = None
+        # Where the autosaved strokemap is relative to
+        self._autosave_strokemap_origin = None
+
+    @property
+    def strokes(self):
+        """Stroke map.
+
+        List of strokemap.StrokeShape instances (not stroke.Stroke),
+        ordered by depth. Assigning a new list is fine, but code which
+        changes the list in place should call `invalidate_stroke_index()`
+        afterwards.
+
+        Strokemaps loaded from files are only parsed when this is first
+        accessed.
+
+        """
+        self._parse_loaded_strokemap()
+        return self._strokes
+
+    @strokes.setter
+    def strokes(self, strokes):
+        self._unparsed_strokemap = None
+        self._strokes = strokes
+        self.invalidate_stroke_index()
+
+    def _parse_loaded_strokemap(self):
+        """Internal: parses any strokemap data waiting to be used"""
+        unparsed = self._unparsed_strokemap
+        if unparsed is None:
+            return
+        self._unparsed_strokemap = None
+        data, x, y = unparsed
+        t0 = time.time()
+        sio = StringIO(data)
+        shapes = _read_strokemap(sio, x, y)
+        sio.close()
+        t1 = time.time()
+        logger.debug("%.3fs parsing %d loaded strokes", t1-t0, len(shapes))
+        self._strokes[:0] = shapes
+        self.invalidate_stroke_index()
+
+    def invalidate_stroke_index(self):
+        """Discards the spatial index used for picking strokes"""
+        self._stroke_index = None
 
     def clear(self):
         """Clear both the surface and the strokemap"""
@@ -1249,7 +1583,19 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
             x=x, y=y,
             **kwargs
         )
-        self._load_strokemap_from_ora(elem, x, y, orazip=orazip)
+        strokemap_name = self._load_strokemap_from_ora(
+            elem, x, y,
+            orazip=orazip,
+        )
+        if strokemap_name is not None:
+            x += int(elem.attrib.get('x', 0))
+            y += int(elem.attrib.get('y', 0))
+            self._record_ora_member(
+                "strokemap",
+                kwargs.get("ora_ref"),
+                strokemap_name,
+                self._get_strokemap_key(x, y),
+            )
 
     def load_from_openraster_dir(self, oradir, elem, cache_dir, feedback_cb,
                                  x=0, y=0, **kwargs):
@@ -1266,7 +1612,11 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         self._load_strokemap_from_ora(elem, x, y, oradir=oradir)
 
     def _load_strokemap_from_ora(self, elem, x, y, orazip=None, oradir=None):
-        """Load the strokemap from a layer elem & an ora{zip|dir}."""
+        """Load the strokemap from a layer elem & an ora{zip|dir}.
+
+        :returns: the name of the strokemap file loaded, or None
+
+        """
         attrs = elem.attrib
         x += int(attrs.get('x', 0))
         y += int(attrs.get('y', 0))
@@ -1286,16 +1636,19 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
             )
             break
         if strokemap_name is None:
-            return
+            return None
+        # Only the raw bytes are read now. The source file may change
+        # after loading, so they're kept until the strokes are needed.
         if orazip:
-            sio = StringIO(orazip.read(strokemap_name))
-            self.load_strokemap_from_file(sio, x, y)
-            sio.close()
+            data = orazip.read(strokemap_name)
         elif oradir:
             with open(os.path.join(oradir, strokemap_name), "rb") as sfp:
-                self.load_strokemap_from_file(sfp, x, y)
+                data = sfp.read()
         else:
             raise ValueError("either orazip or oradir must be specified")
+        assert not self._strokes and self._unparsed_strokemap is None
+        self._unparsed_strokemap = (data, x, y)
+        return strokemap_name
 
     def get_paintable(self):
         """True if this layer currently accepts painting brushstrokes"""
@@ -1312,7 +1665,8 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
 
     ## Flood fill
 
-    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None):
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None,
+                   progress_cb=None):
         """Fills a point on the surface with a color
 
         :param x: Starting point X coordinate
@@ -1325,6 +1679,9 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         :type tolerance: float [0.0, 1.0]
         :param dst_layer: Optional target layer (default is self!)
         :type dst_layer: PaintingLayer
+        :param callable progress_cb: Progress/cancellation callback
+        :returns: False if the fill was cancelled
+        :rtype: bool
 
         The `tolerance` parameter controls how much pixels are permitted to
         vary from the starting color.  We use the 4D Euclidean distance from
@@ -1334,12 +1691,18 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         The default target layer is `self`. This method invalidates the filled
         area of the target layer's surface, queueing a redraw if it is part of
         a visible document.
+
+        If `progress_cb` is given, it's called every so often during long
+        fills as ``progress_cb(tiles_done, tiles_queued)``. Returning a
+        false value from it cancels the fill, leaving the target as it was.
+        See `lib.tiledsurface.flood_fill()`.
         """
         if dst_layer is None:
             dst_layer = self
         dst_layer.autosave_dirty = True   # XXX hmm, not working?
-        self._surface.flood_fill(x, y, color, bbox, tolerance,
-                                 dst_surface=dst_layer._surface)
+        return self._surface.flood_fill(x, y, color, bbox, tolerance,
+                                        dst_surface=dst_layer._surface,
+                                        progress_cb=progress_cb)
 
     ## Painting
 
@@ -1404,7 +1767,10 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         )
         if shape is not None:
             shape.brush_string = stroke.brush_settings
-            self.strokes.append(shape)
+            # Loaded shapes go beneath, so they can stay unparsed.
+            self._strokes.append(shape)
+            if self._stroke_index is not None:
+                self._stroke_index.add(shape)
 
     ## Snapshots
 
@@ -1424,85 +1790,112 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         """Trim the layer and its strokemap"""
         super(PaintingLayer, self).trim(rect)
         empty_strokes = []
-        for stroke in self.strokes:
+        for stroke in self.strokes:  # parses any loaded strokemap
             if not stroke.trim(rect):
                 empty_strokes.append(stroke)
         for stroke in empty_strokes:
             logger.debug("Removing emptied stroke %r", stroke)
-            self.strokes.remove(stroke)
+            self._strokes.remove(stroke)
+        self.invalidate_stroke_index()
 
     ## Strokemap
 
     def load_strokemap_from_file(self, f, translate_x, translate_y):
         assert not self.strokes
-        brushes = []
-        N = tiledsurface.N
-        x = int(translate_x//N) * N
-        y = int(translate_y//N) * N
-        dx = translate_x % N
-        dy = translate_y % N
-        while True:
-            t = f.read(1)
-            if t == 'b':
-                length, = struct.unpack('>I', f.read(4))
-                tmp = f.read(length)
-                brushes.append(zlib.decompress(tmp))
-            elif t == 's':
-                brush_id, length = struct.unpack('>II', f.read(2*4))
-                stroke = lib.strokemap.StrokeShape()
-                tmp = f.read(length)
-                stroke.init_from_string(tmp, x, y)
-                stroke.brush_string = brushes[brush_id]
-                # Translate non-aligned strokes
-                if (dx, dy) != (0, 0):
-                    stroke.translate(dx, dy)
-                self.strokes.append(stroke)
-            elif t == '}':
-                break
-            else:
-                assert False, 'invalid strokemap'
+        self._strokes.extend(_read_strokemap(f, translate_x, translate_y))
+        self.invalidate_stroke_index()
 
     def get_stroke_info_at(self, x, y):
         """Get the stroke at the given point"""
-        x, y = int(x), int(y)
-        for s in reversed(self.strokes):
-            if s.touches_pixel(x, y):
-                return s
+        self._parse_loaded_strokemap()
+        index = self._stroke_index
+        if index is None or index.stale or len(index) != len(self._strokes):
+            index = lib.strokemap.StrokeIndex(self._strokes)
+            self._stroke_index = index
+        return index.get_stroke_at(x, y)
 
     def get_last_stroke_info(self):
-        if not self.strokes:
+        strokes = self._strokes or self.strokes
+        if not strokes:
             return None
-        return self.strokes[-1]
+        return strokes[-1]
 
     ## Saving
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
-        """Save the strokemap too, in addition to the base implementation"""
+        """Save the strokemap too, in addition to the base implementation
+
+        Like the PNG data, an unchanged strokemap is copied from the
+        writer's source file if possible.
+
+        """
         # Save the layer normally
 
         elem = super(PaintingLayer, self).save_to_openraster(
             orazip, tmpdir, path,
             canvas_bbox, frame_bbox, **kwargs
         )
-        # Store stroke shape data too
-        x, y, w, h = self.get_bbox()
-        sio = StringIO()
-        t0 = time.time()
-        _write_strokemap(sio, self.strokes, -x, -y)
-        t1 = time.time()
-        data = sio.getvalue()
-        sio.close()
+        # Store stroke shape data too, relative to the PNG's position
+        x = frame_bbox[0] + int(elem.attrib.get("x", 0))
+        y = frame_bbox[1] + int(elem.attrib.get("y", 0))
         datname = self._make_refname("layer", path, "strokemap.dat")
-        logger.debug("%.3fs strokemap saving %r", t1-t0, datname)
         storepath = "data/%s" % (datname,)
-        helpers.zipfile_writestr(orazip, storepath, data)
+        key = self._get_strokemap_key(x, y)
+        data = self._get_unparsed_strokemap_data(x, y)
+        if self._copy_ora_member(orazip, "strokemap", key, storepath):
+            pass
+        elif data is not None:
+            helpers.zipfile_writestr(orazip, storepath, data)
+        else:
+            # Written by a worker, which needs the shapes' current state
+            strokes = tuple(s.frozen() for s in self.strokes)
+            orazip.submit_stream(
+                storepath,
+                _write_strokemap_timed, strokes, -x, -y, datname,
+            )
+        self._record_ora_member("strokemap", orazip.ref, storepath, key)
         # Add strokemap XML attrs and return.
         # See comment above for compatibility strategy.
         elem.attrib[self._ORA_STROKEMAP_ATTR] = storepath
         elem.attrib[self._ORA_STROKEMAP_LEGACY_ATTR] = storepath
         return elem
 
+    def _get_strokemap_key(self, x, y):
+        """Internal: describes the strokemap's state, for saving
+
+        :param int x: X coordinate the strokemap is relative to
+        :param int y: Y coordinate the strokemap is relative to
+
+        The strokes are compared by identity. They are only changed in
+        place along with the surface, which gets a new generation then.
+        Unparsed strokemap data is compared by identity too.
+
+        """
+        return (
+            self._surface.content_generation,
+            x, y,
+            self._unparsed_strokemap,
+            tuple(id(s) for s in self._strokes),
+        )
+
+    def _get_unparsed_strokemap_data(self, x, y):
+        """Internal: loaded strokemap data which can be saved as it is
+
+        :param int x: X coordinate the saved strokemap is relative to
+        :param int y: Y coordinate the saved strokemap is relative to
+        :returns: The raw data, or None if it has to be reencoded
+        :rtype: bytes
+
+        """
+        unparsed = self._unparsed_strokemap
+        if unparsed is None or self._strokes:
+            return None
+        data, ux, uy = unparsed
+        if (ux, uy) != (x, y):
+            return None
+        return data
+
     def queue_autosave(self, oradir, taskproc, manifest, bbox, **kwargs):
         """Queues the layer for auto-saving"""
         dat_basename = u"%s-strokemap.dat" % (self.autosave_uuid,)
@@ -1510,19 +1903,29 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         dat_path = os.path.join(oradir, dat_relpath)
         # Have to do this before the supercall because that will clear
         # the dirty flag.
-        if self.autosave_dirty or not os.path.exists(dat_path):
-            x, y, w, h = self.get_bbox()
-            task = _StrokemapFileUpdateTask(
-                self.strokes,
-                dat_path,
-                -x, -y,
-            )
-            taskproc.add_work(task)
+        dirty = self.autosave_dirty or not os.path.exists(dat_path)
         # Supercall to queue saving PNG and obtain basic XML
         elem = super(PaintingLayer, self).queue_autosave(
             oradir, taskproc, manifest, bbox,
             **kwargs
         )
+        # The strokemap is relative to the PNG, which isn't necessarily
+        # rewritten when the layer's bbox changes.
+        x = bbox[0] + int(elem.attrib.get("x", 0))
+        y = bbox[1] + int(elem.attrib.get("y", 0))
+        if dirty or (x, y) != self._autosave_strokemap_origin:
+            data = self._get_unparsed_strokemap_data(x, y)
+            strokes = ()
+            if data is None:
+                strokes = tuple(s.frozen() for s in self.strokes)
+            task = _StrokemapFileUpdateTask(
+                strokes,
+                dat_path,
+                -x, -y,
+                data = data,
+            )
+            taskproc.add_work(task)
+            self._autosave_strokemap_origin = (x, y)
         # Add strokemap XML attrs and return.
         # See comment above for compatibility strategy.
         elem.attrib[self._ORA_STROKEMAP_ATTR] = dat_relpath
@@ -1577,6 +1980,38 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         self.autosave_dirty = True
 
 
+def _read_strokemap(f, translate_x, translate_y):
+    """Reads a strokemap file, returning a list of StrokeShapes"""
+    shapes = []
+    brushes = []
+    N = tiledsurface.N
+    x = int(translate_x//N) * N
+    y = int(translate_y//N) * N
+    dx = translate_x % N
+    dy = translate_y % N
+    while True:
+        t = f.read(1)
+        if t == 'b':
+            length, = struct.unpack('>I', f.read(4))
+            tmp = f.read(length)
+            brushes.append(zlib.decompress(tmp))
+        elif t == 's':
+            brush_id, length = struct.unpack('>II', f.read(2*4))
+            stroke = lib.strokemap.StrokeShape()
+            tmp = f.read(length)
+            stroke.init_from_string(tmp, x, y)
+            stroke.brush_string = brushes[brush_id]
+            # Translate non-aligned strokes
+            if (dx, dy) != (0, 0):
+                stroke.translate(dx, dy)
+            shapes.append(stroke)
+        elif t == '}':
+            break
+        else:
+            assert False, 'invalid strokemap'
+    return shapes
+
+
 def _write_strokemap(f, strokes, dx, dy):
     brush2id = {}
     for stroke in strokes:
@@ -1584,6 +2019,14 @@ def _write_strokemap(f, strokes, dx, dy):
     f.write('}')
 
 
+def _write_strokemap_timed(f, strokes, dx, dy, name):
+    """Writes a strokemap to a file, logging the time taken"""
+    t0 = time.time()
+    _write_strokemap(f, strokes, dx, dy)
+    t1 = time.time()
+    logger.debug("%.3fs strokemap saving %r", t1-t0, name)
+
+
 def _write_strokemap_stroke(f, stroke, brush2id, dx, dy):
     s = stroke.brush_string
     # save brush (if not already known)
@@ -1593,17 +2036,28 @@ def _write_strokemap_stroke(f, stroke, brush2id, dx, dy):
         f.write('b')
         f.write(struct.pack('>I', len(s)))
         f.write(s)
-    # save stroke
-    s = stroke.save_to_string(dx, dy)
+    # save stroke, without joining its tiles' data into one big string
+    chunks = stroke.get_save_chunks(dx, dy)
+    size = sum(len(c) for c in chunks)
     f.write('s')
-    f.write(struct.pack('>II', brush2id[stroke.brush_string], len(s)))
-    f.write(s)
+    f.write(struct.pack('>II', brush2id[stroke.brush_string], size))
+    for chunk in chunks:
+        f.write(chunk)
 
 
 class _StrokemapFileUpdateTask (object):
     """Updates a strokemap file in chunked calls (for autosave)"""
 
-    def __init__(self, strokes, filename, dx, dy):
+    def __init__(self, strokes, filename, dx, dy, data=None):
+        """Initialize, ready to write shapes or raw data
+
+        :param tuple strokes: The frozen StrokeShapes to write
+        :param unicode filename: The file to update
+        :param int dx: X offset for the shapes
+        :param int dy: Y offset for the shapes
+        :param bytes data: Complete raw strokemap to write instead
+
+        """
         super(_StrokemapFileUpdateTask, self).__init__()
         tmp = tempfile.NamedTemporaryFile(
             mode = "wb",
@@ -1616,8 +2070,9 @@ class _StrokemapFileUpdateTask (object):
         self._dx = dx
         self._dy = dy
         self._brush2id = {}
-        self._strokes = strokes[:]
+        self._strokes = strokes
         self._strokes_i = 0
+        self._data = data
         logger.debug("autosave: scheduled update of %r", self._final_name)
 
     def __call__(self):
@@ -1634,7 +2089,10 @@ class _StrokemapFileUpdateTask (object):
             self._strokes_i += 1
             return True
         else:
-            self._tmp.write('}')
+            if self._data is None:
+                self._tmp.write('}')
+            else:
+                self._tmp.write(self._data)
             self._tmp.close()
             lib.fileutils.replace(self._tmp.name, self._final_name)
             logger.debug("autosave: updated %r", self._final_name)
@@ -1646,11 +2104,13 @@ class PaintingLayerSnapshot (SurfaceBackedLayerSnapshot):
 
     def __init__(self, layer):
         super(PaintingLayerSnapshot, self).__init__(layer)
-        self.strokes = layer.strokes[:]
+        self.strokes = layer._strokes[:]
+        self.unparsed_strokemap = layer._unparsed_strokemap
 
     def restore_to_layer(self, layer):
         super(PaintingLayerSnapshot, self).restore_to_layer(layer)
         layer.strokes = self.strokes[:]
+        layer._unparsed_strokemap = self.unparsed_strokemap
         layer.autosave_dirty = True
 
 
@@ -1674,7 +2134,12 @@ class PaintingLayerMove (SurfaceBackedLayerMove):
         dy = self._final_dy
         # Arrange for the strokemap to be moved too;
         # this happens in its own background idler.
-        for stroke in self._layer.strokes:
+        # Unparsed data just gets a new position for when it's parsed.
+        unparsed = self._layer._unparsed_strokemap
+        if unparsed is not None:
+            data, x, y = unparsed
+            self._layer._unparsed_strokemap = (data, x+dx, y+dy)
+        for stroke in self._layer._strokes:
             stroke.translate(dx, dy)
             # Minor problem: huge strokemaps take a long time to move, and the
             # translate must be forced to completion before drawing or any
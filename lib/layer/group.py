@@ -14,7 +14,10 @@
 from __future__ import division, print_function
 
 import logging
+import threading
+import contextlib
 logger = logging.getLogger(__name__)
+import zipfile
 
 import numpy as np
 
@@ -30,6 +33,20 @@ import data
 import lib.layer.error
 import lib.surface
 import lib.autosave
+import lib.workerpool
+
+
+## Module vars
+
+#: Worker threads for loading layers in parallel from OpenRaster files.
+#: Threads are started when needed, and stopped after the outermost
+#: stack has finished loading. See `_using_load_pool()`.
+_LOAD_POOL = lib.workerpool.WorkerPool(name="layerload")
+_LOAD_POOL_USERS = 0
+_LOAD_POOL_LOCK = threading.Lock()
+
+#: How often to call feedback_cb while waiting for loader threads
+_LOAD_FEEDBACK_INTERVAL = 0.1
 
 
 ## Class defs
@@ -69,6 +86,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
     def __init__(self, **kwargs):
         """Initialize, with no sub-layers"""
         self._layers = []  # must be done before supercall
+        self._bbox_cache = None  # (extents serial, bbox tuple)
         super(LayerStack, self).__init__(**kwargs)
         # Blank background, for use in rendering
         N = tiledsurface.N
@@ -103,22 +121,87 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
             self.mode = PASS_THROUGH_MODE
 
         # Document order is the same as _layers, bottom layer to top.
-        for child_elem in elem.findall("./*"):
-            assert child_elem is not elem
-            self._load_child_layer_from_orazip(
+        # Plain PNG layers are decoded by worker threads, each reading
+        # from its own ZipFile, while this thread gets on with the rest.
+        # Everything is appended in document order afterwards.
+        zip_filename = orazip.filename
+        with _using_load_pool() as pool:
+            children = []
+            try:
+                for child_elem in elem.findall("./*"):
+                    assert child_elem is not elem
+                    if zip_filename and self._can_load_child_in_worker(
+                            child_elem):
+                        child = pool.submit(
+                            self._new_child_layer_from_orazip_file,
+                            zip_filename,
+                            child_elem,
+                            cache_dir,
+                            x, y,
+                            kwargs,
+                        )
+                    else:
+                        child = self._new_child_layer_from_orazip(
+                            orazip,
+                            child_elem,
+                            cache_dir,
+                            feedback_cb,
+                            x=x, y=y,
+                            **kwargs
+                        )
+                    children.append(child)
+                self._append_loaded_children(children, feedback_cb)
+            except:
+                _cancel_load_jobs(children)
+                raise
+
+    def _can_load_child_in_worker(self, elem):
+        """True if a child element can be loaded by a worker thread
+
+        :param xml.etree.ElementTree.Element elem: <layer/> or <stack/>
+        :rtype: bool
+
+        Only PNG layers are worth loading in parallel, and they are
+        expected to load as PaintingLayers, which don't touch anything
+        shared while loading. Subclasses can exclude elements which need
+        special handling in the main thread.
+
+        """
+        if elem.tag != "layer":
+            return False
+        src = elem.attrib.get("src", "")
+        return src.lower().endswith(".png")
+
+    def _new_child_layer_from_orazip_file(self, zip_filename, elem,
+                                          cache_dir, x, y, kwargs):
+        """Internal: loads a child layer in a worker thread
+
+        ZipFile objects can't be shared between threads safely, so this
+        opens the OpenRaster file again. The caller handles feedback.
+
+        """
+        with zipfile.ZipFile(zip_filename) as orazip:
+            return self._new_child_layer_from_orazip(
                 orazip,
-                child_elem,
+                elem,
                 cache_dir,
-                feedback_cb,
+                None,
                 x=x, y=y,
                 **kwargs
             )
 
-    def _load_child_layer_from_orazip(self, orazip, elem, cache_dir,
-                                      feedback_cb, x=0, y=0, **kwargs):
-        """Loads a single child layer element from an open .ora file"""
+    def _new_child_layer_from_orazip(self, orazip, elem, cache_dir,
+                                     feedback_cb, x=0, y=0, **kwargs):
+        """Loads a single child layer element from an open .ora file
+
+        :returns: the new layer, or None if there's nothing to append
+
+        Child classes can override this, but otherwise it's an internal
+        method.
+
+        """
         try:
-            child = _layer_new_from_orazip(
+            return _layer_new_from_orazip(
                 orazip,
                 elem,
                 cache_dir,
@@ -129,8 +212,25 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
             )
         except lib.layer.error.LoadingFailed:
             logger.warning("Skipping non-loadable layer")
-        else:
-            self.append(child)
+            return None
+
+    def _append_loaded_children(self, children, feedback_cb):
+        """Internal: appends loaded layers, waiting for workers
+
+        :param list children: Layers, Jobs returning layers, or None
+        :param callable feedback_cb: Called while waiting for workers
+
+        """
+        for child in children:
+            if isinstance(child, lib.workerpool.Job):
+                while not child.wait(_LOAD_FEEDBACK_INTERVAL):
+                    if feedback_cb:
+                        feedback_cb()
+                if feedback_cb:
+                    feedback_cb()
+                child = child.result()
+            if child is not None:
+                self.append(child)
 
     def load_from_openraster_dir(self, oradir, elem, cache_dir, feedback_cb,
                                  x=0, y=0, **kwargs):
@@ -155,28 +255,49 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
                            and (isolated_flag.lower() == "auto"))
         if is_pass_through:
             self.mode = PASS_THROUGH_MODE
-        # Delegate loading of child layers
-        for child_elem in elem.findall("./*"):
-            assert child_elem is not elem
-            self._load_child_layer_from_oradir(
-                oradir,
-                child_elem,
-                cache_dir,
-                feedback_cb,
-                x=x, y=y,
-                **kwargs
-            )
-
-    def _load_child_layer_from_oradir(self, oradir, elem, cache_dir,
-                                      feedback_cb, x=0, y=0, **kwargs):
-        """Loads a single child layer element from an open .ora file
+        # Delegate loading of child layers, in parallel where possible
+        with _using_load_pool() as pool:
+            children = []
+            try:
+                for child_elem in elem.findall("./*"):
+                    assert child_elem is not elem
+                    if self._can_load_child_in_worker(child_elem):
+                        child = pool.submit(
+                            self._new_child_layer_from_oradir,
+                            oradir,
+                            child_elem,
+                            cache_dir,
+                            None,
+                            x=x, y=y,
+                            **kwargs
+                        )
+                    else:
+                        child = self._new_child_layer_from_oradir(
+                            oradir,
+                            child_elem,
+                            cache_dir,
+                            feedback_cb,
+                            x=x, y=y,
+                            **kwargs
+                        )
+                    children.append(child)
+                self._append_loaded_children(children, feedback_cb)
+            except:
+                _cancel_load_jobs(children)
+                raise
+
+    def _new_child_layer_from_oradir(self, oradir, elem, cache_dir,
+                                     feedback_cb, x=0, y=0, **kwargs):
+        """Loads a single child layer element from an OpenRaster dir
+
+        :returns: the new layer, or None if there's nothing to append
 
         Child classes can override this, but otherwise it's an internal
         method.
 
         """
         try:
-            child = _layer_new_from_oradir(
+            return _layer_new_from_oradir(
                 oradir,
                 elem,
                 cache_dir,
@@ -187,14 +308,14 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
             )
         except lib.layer.error.LoadingFailed:
             logger.warning("Skipping non-loadable layer")
-        else:
-            self.append(child)
+            return None
 
     def clear(self):
         """Clears the layer, and removes any child layers"""
         super(LayerStack, self).clear()
         removed = list(self._layers)
         self._layers[:] = []
+        self._invalidate_bbox_cache()
         for i, layer in reversed(list(enumerate(removed))):
             self._notify_disown(layer, i)
 
@@ -262,6 +383,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         """Appends a layer (notifies root)"""
         newindex = len(self)
         self._layers.append(layer)
+        self._invalidate_bbox_cache()
         self._notify_adopt(layer, newindex)
         self._content_changed(*layer.get_full_redraw_bbox())
 
@@ -271,6 +393,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         assert oldindex is not None
         removed = self._layers.pop(oldindex)
         assert removed is not None
+        self._invalidate_bbox_cache()
         self._notify_disown(removed, oldindex)
         self._content_changed(*removed.get_full_redraw_bbox())
 
@@ -282,6 +405,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         else:
             index = self._normidx(index)
             removed = self._layers.pop(index)
+        self._invalidate_bbox_cache()
         self._notify_disown(removed, index)
         self._content_changed(*removed.get_full_redraw_bbox())
         return removed
@@ -312,6 +436,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         """Adds a layer before an index (notifies root)"""
         index = self._normidx(index, insert=True)
         self._layers.insert(index, layer)
+        self._invalidate_bbox_cache()
         self._notify_adopt(layer, index)
         self._content_changed(*layer.get_full_redraw_bbox())
 
@@ -320,6 +445,7 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         index = self._normidx(index)
         oldlayer = self._layers[index]
         self._layers[index] = layer
+        self._invalidate_bbox_cache()
         self._notify_disown(oldlayer, index)
         updates = [oldlayer.get_full_redraw_bbox()]
         self._notify_adopt(layer, index)
@@ -337,12 +463,35 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
     ## Info methods
 
     def get_bbox(self):
-        """Returns the inherent (data) bounding box of the stack"""
+        """Returns the inherent (data) bounding box of the stack
+
+        The result is cached until the stack's structure changes, or
+        any surface's extents change (see `_invalidate_bbox_cache()`).
+
+        """
+        serial = tiledsurface.get_extents_serial()
+        cached = self._bbox_cache
+        if cached is not None and cached[0] == serial:
+            return helpers.Rect(*cached[1])
         result = helpers.Rect()
         for layer in self._layers:
             result.expandToIncludeRect(layer.get_bbox())
+        self._bbox_cache = (serial, tuple(result))
         return result
 
+    def _invalidate_bbox_cache(self):
+        """Discards the cached bbox of the stack and its ancestors
+
+        Surface-backed layers maintain their own bboxes, and changes
+        to them are detected through the extents serial number. Changes
+        to the tree's structure must call this.
+
+        """
+        stack = self
+        while stack is not None:
+            stack._bbox_cache = None
+            stack = stack.group
+
     def get_full_redraw_bbox(self):
         """Returns the full update notification bounding box of the stack"""
         result = super(LayerStack, self).get_full_redraw_bbox()
@@ -369,6 +518,20 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
 
     ## Rendering
 
+    def update_mipmaps(self, max_tiles, priority_bboxes=(),
+                       priority_only=False):
+        """Regenerates a batch of the children's dirty mipmap tiles"""
+        done = 0
+        for layer in self._layers:
+            if done >= max_tiles:
+                break
+            done += layer.update_mipmaps(
+                max_tiles - done,
+                priority_bboxes,
+                priority_only,
+            )
+        return done
+
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
                        **kwargs):
         """Unconditionally copy one tile's data into an array"""
@@ -440,7 +603,8 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
 
     ## Flood fill
 
-    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None):
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None,
+                   progress_cb=None):
         """Fills a point on the surface with a color (into other only!)
 
         See `PaintingLayer.flood_fill() for parameters and semantics. Layer
@@ -451,7 +615,8 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         assert dst_layer is not None
         src = lib.surface.TileRequestWrapper(self)
         dst = dst_layer._surface
-        tiledsurface.flood_fill(src, x, y, color, bbox, tolerance, dst)
+        return tiledsurface.flood_fill(src, x, y, color, bbox, tolerance, dst,
+                                       progress_cb=progress_cb)
 
     def get_fillable(self):
         """False! Stacks can't be filled interactively or directly."""
@@ -528,6 +693,10 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         """Snapshots the state of the layer, for undo purposes"""
         return LayerStackSnapshot(self)
 
+    def get_tiledicts(self):
+        """Returns the tiledicts holding the children's pixel data"""
+        return [d for l in self._layers for d in l.get_tiledicts()]
+
     ## Trimming
 
     def trim(self, rect):
@@ -565,6 +734,10 @@ class LayerStackSnapshot (core.LayerBaseSnapshot):
             child = layer_class()
             child.load_snapshot(snap)
             layer._layers.append(child)
+        layer._invalidate_bbox_cache()
+
+    def get_tiledicts(self):
+        return [d for s in self.layer_snaps for d in s.get_tiledicts()]
 
 
 class LayerStackMove (object):
@@ -592,6 +765,38 @@ class LayerStackMove (object):
         return incomplete
 
 
+## Helper funcs
+
+
+@contextlib.contextmanager
+def _using_load_pool():
+    """Context manager: shuts down the load pool after the outermost load
+
+    Stacks nest, and a stack can be loaded on its own, for example when
+    a group is imported. Whichever load started first stops the pool's
+    threads when it finishes, even if it fails.
+
+    """
+    global _LOAD_POOL_USERS
+    with _LOAD_POOL_LOCK:
+        _LOAD_POOL_USERS += 1
+    try:
+        yield _LOAD_POOL
+    finally:
+        with _LOAD_POOL_LOCK:
+            _LOAD_POOL_USERS -= 1
+            last = (_LOAD_POOL_USERS == 0)
+        if last:
+            _LOAD_POOL.shutdown()
+
+
+def _cancel_load_jobs(children):
+    """Cancels any loader jobs which haven't started yet"""
+    for child in children:
+        if isinstance(child, lib.workerpool.Job):
+            child.cancel()
+
+
 ## Layer factory func
 
 _LAYER_LOADER_CLASS_ORDER = [
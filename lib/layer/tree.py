@@ -16,7 +16,11 @@ from __future__ import division, print_function
 from gi.repository import GdkPixbuf
 
 import re
+import sys
+import threading
 import logging
+import contextlib
+import weakref
 logger = logging.getLogger(__name__)
 from warnings import warn
 from copy import deepcopy
@@ -31,6 +35,8 @@ import lib.helpers as helpers
 from lib.observable import event
 import lib.pixbuf
 import lib.cache
+import lib.workerpool
+import lib.idletask
 from lib.modes import *
 import data
 import group
@@ -96,6 +102,13 @@ class RootLayerStack (group.LayerStack):
     INITIAL_MODE = lib.mypaintlib.CombineNormal
     PERMITTED_MODES = {INITIAL_MODE}
 
+    # Layer properties which affect the rendering of every tile.
+    # Changing any of these causes a full flush of the render cache.
+    _RENDER_CACHE_FLUSHING_PROPERTIES = {"opacity", "mode", "visible"}
+
+    #: Dirty mipmap tiles regenerated per idle task call
+    MIPMAP_UPDATE_BATCH_SIZE = 16
+
 
     ## Initialization
 
@@ -108,6 +121,12 @@ class RootLayerStack (group.LayerStack):
         super(RootLayerStack, self).__init__(**kwargs)
         self.doc = doc
         self._render_cache = lib.cache.LRUCache()
+        self._render_cache_lock = threading.Lock()
+        self._composite_pyramid = _CompositePyramid()
+        self._split_cache = lib.cache.LRUCache(capacity=512)
+        self._split_layers = None
+        self._render_pool = None
+        self._render_threads = 1
         # Background
         default_bg = (255, 255, 255)
         self._default_background = default_bg
@@ -121,14 +140,79 @@ class RootLayerStack (group.LayerStack):
         self._current_layer_previewing = False
         # Current layer
         self._current_path = ()
+        # Background mipmap regeneration
+        self._mipmap_tasks = lib.idletask.Processor(
+            time_budget = lib.idletask.DEFAULT_TIME_BUDGET,
+            adaptive = True,
+        )
+        self._viewport_bboxes = weakref.WeakKeyDictionary()
         # Self-observation
-        self.layer_content_changed += self._clear_render_cache
-        self.layer_properties_changed += self._clear_render_cache
-        self.layer_deleted += self._clear_render_cache
-        self.layer_inserted += self._clear_render_cache
+        self.layer_content_changed += self._render_cache_content_changed_cb
+        self.layer_content_changed += self._mipmap_content_changed_cb
+        self.layer_content_changed += self._split_cache_content_changed_cb
+        self.layer_properties_changed += \
+            self._render_cache_properties_changed_cb
+        self.layer_inserted += self._reset_split_cache
+        self.layer_deleted += self._reset_split_cache
+        self.current_path_updated += self._reset_split_cache
 
     def _clear_render_cache(self, *_ignored):
-        self._render_cache.clear()
+        with self._render_cache_lock:
+            self._render_cache.clear()
+            self._composite_pyramid.clear()
+        self._reset_split_cache()
+
+    def _invalidate_render_cache(self, x, y, w, h):
+        """Invalidates cached render tiles within a model bbox
+
+        :param int x: Bounding box X coordinate, in model pixels
+        :param int y: Bounding box Y coordinate, in model pixels
+        :param int w: Bounding box width
+        :param int h: Bounding box height
+
+        Cached tiles at every mipmap level are discarded if they overlap
+        the bbox, and the overlapping parts of the composite pyramid are
+        marked stale. A zero-sized bbox flushes the entire cache, since
+        that is the conventional signal for a full redraw.
+
+        """
+        if w <= 0 or h <= 0:
+            self._clear_render_cache()
+            return
+        overlaps = _tile_key_overlap_predicate(x, y, w, h)
+        with self._render_cache_lock:
+            self._render_cache.invalidate(overlaps)
+            self._composite_pyramid.invalidate(*_get_tile_range(x, y, w, h))
+
+    def _render_cache_content_changed_cb(self, root, layer, *args):
+        """Discard cached tiles affected by a change to layer pixels
+
+        Insertions and deletions are also handled here: the layer stack
+        issues a content change for each one, covering the full redraw
+        area of the layer being added or removed.
+
+        """
+        if len(args) == 4:
+            self._invalidate_render_cache(*args)
+        else:
+            self._clear_render_cache()
+
+    def _render_cache_properties_changed_cb(self, root, path, layer, changed):
+        """Flush the render cache when layer-wide rendering changes"""
+        if changed & self._RENDER_CACHE_FLUSHING_PROPERTIES:
+            self._clear_render_cache()
+
+    @property
+    def render_cache_stats(self):
+        """Usage statistics for the internal render cache
+
+        :rtype: lib.cache.LRUCacheStats
+
+        Hits and misses are counted since the last full flush.
+
+        """
+        with self._render_cache_lock:
+            return self._render_cache.stats
 
     def clear(self):
         """Clear the layer and set the default background"""
@@ -136,6 +220,7 @@ class RootLayerStack (group.LayerStack):
         self.set_background(self._default_background)
         self.current_path = ()
         self._clear_render_cache()
+        self._mipmap_tasks.stop()
 
     def ensure_populated(self, layer_class=None):
         """Ensures that the stack is non-empty by making a new layer if needed
@@ -187,6 +272,40 @@ class RootLayerStack (group.LayerStack):
 
     ## Rendering: root stack API
 
+    @property
+    def render_threads(self):
+        """Number of threads used by render_into()
+
+        :rtype: int
+
+        The default of 1 renders serially, in the calling thread.
+        Higher values make `render_into()` share its tiles out among
+        a pool of worker threads, each of which composites whole tiles.
+        Zero means one thread per CPU. The output is the same whatever
+        the setting.
+
+        """
+        return self._render_threads
+
+    @render_threads.setter
+    def render_threads(self, n):
+        n = int(n)
+        if n <= 0:
+            n = lib.workerpool.get_default_num_workers()
+        if n == self._render_threads:
+            return
+        self._render_threads = n
+        if self._render_pool is not None:
+            self._render_pool.shutdown(wait=False)
+            self._render_pool = None
+        if n > 1:
+            self._render_pool = lib.workerpool.WorkerPool(
+                # The calling thread helps out, see WorkerPool.map()
+                num_workers = n - 1,
+                name = "render",
+            )
+        logger.debug("Rendering with %d thread(s)", n)
+
     def _get_render_background(self):
         """True if render_into should render the internal background
 
@@ -288,22 +407,65 @@ class RootLayerStack (group.LayerStack):
             previewing = self.current
         if self._current_layer_solo:
             solo = self.current
-        # Blit loop. Could this be done in C++?
-        for tx, ty in tiles:
+
+        def _render_tile(tile):
+            tx, ty = tile
+            # Each worker gets its own copy of the layers set,
+            # because LayerStack.composite_tile() may update it.
+            tile_layers = layers
+            if tile_layers is not None:
+                tile_layers = set(tile_layers)
             with surface.tile_request(tx, ty, readonly=False) as dst:
                 self.composite_tile(
                     dst, dst_has_alpha, tx, ty,
                     mipmap_level,
-                    layers=layers,
+                    layers=tile_layers,
                     render_background=render_background,
                     overlay=overlay,
                     previewing=previewing,
                     solo=solo,
                     opaque_base_tile=opaque_base_tile,
+                    interactive=True,
                 )
                 if filter:
                     filter(dst)
 
+        tiles = list(tiles)
+        # Blit loop. The heavy lifting is done in C++, which releases
+        # the GIL, so tiles can be composited in parallel. Every tile is
+        # independent of the others, and the model isn't changed while
+        # this method runs, so the results are deterministic.
+        pool = self._render_pool
+        if pool is not None and len(tiles) > 1:
+            if mipmap_level > 0:
+                self._update_mipmaps_for_render(tiles, mipmap_level,
+                                                overlay)
+            pool.map(_render_tile, tiles)
+        else:
+            for tile in tiles:
+                _render_tile(tile)
+
+    def _update_mipmaps_for_render(self, tiles, mipmap_level, overlay):
+        """Internal: regenerates the dirty mipmap tiles a render needs
+
+        Reading a dirty mipmap tile regenerates it, which updates the
+        mipmap's tiledict. Tiledicts can't be updated safely by several
+        threads at once, so this is done in the calling thread before
+        parallel renders.
+
+        """
+        size = tiledsurface.N << mipmap_level
+        txs = [tx for (tx, ty) in tiles]
+        tys = [ty for (tx, ty) in tiles]
+        bbox = (
+            min(txs) * size, min(tys) * size,
+            (max(txs) - min(txs) + 1) * size,
+            (max(tys) - min(tys) + 1) * size,
+        )
+        self.update_mipmaps(sys.maxsize, [bbox], priority_only=True)
+        if overlay is not None:
+            overlay.update_mipmaps(sys.maxsize, [bbox], priority_only=True)
+
     def render_thumbnail(self, bbox, **options):
         """Renders a 256x256 thumbnail of the stack
 
@@ -343,7 +505,7 @@ class RootLayerStack (group.LayerStack):
 
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
                        layers=None, render_background=None, overlay=None,
-                       opaque_base_tile=None,
+                       opaque_base_tile=None, interactive=False,
                        **kwargs):
         """Composite a tile's data, respecting flags/layers list
 
@@ -353,6 +515,7 @@ class RootLayerStack (group.LayerStack):
         :param bool render_background: Render the internal bg layer
         :param BaseLayer overlay: Overlay layer
         :param array opaque_base_tile: Fallback base tile
+        :param bool interactive: Rendering for display by `render_into()`
 
         The root layer has flags which ensure it is always visible, so the
         result is generally indistinguishable from `blit_tile_into()`.
@@ -368,6 +531,13 @@ class RootLayerStack (group.LayerStack):
         As a further extension to the base API, `dst` may be an 8bpp
         array. A temporary 15-bit scaled int array is used for
         compositing in this case, and the output is converted to 8bpp.
+        Results for 8bpp output are cached. Zoomed-out tiles with no
+        base tile are taken from a pyramid of downscaled composites,
+        which is updated from the finer levels as they're redrawn.
+        While the current layer is being painted, interactive renders
+        composite the layers below and above it from a cache too, if
+        their modes allow. Other renders, like thumbnails and merged
+        fill sources, wouldn't reuse those cached tiles.
         """
         if render_background is None:
             render_background = self._get_render_background()
@@ -390,9 +560,19 @@ class RootLayerStack (group.LayerStack):
                 and not (kwargs.get("solo") or kwargs.get("previewing"))
             )
             if using_cache:
+                if not dst_has_alpha:
+                    opaque_base_tile = None  # unused without alpha
                 cache_key = (tx, ty, dst_has_alpha, mipmap_level,
                              render_background, id(opaque_base_tile))
-                dst = self._render_cache.get(cache_key)
+                use_pyramid = opaque_base_tile is None
+                if use_pyramid and mipmap_level > 0:
+                    dst = self._get_pyramid_tile(
+                        (dst_has_alpha, render_background),
+                        mipmap_level, tx, ty,
+                    )
+                else:
+                    with self._render_cache_lock:
+                        dst = self._render_cache.get(cache_key)
             if dst is None:
                 dst = np.empty((N, N, 4), dtype='uint16')
             else:
@@ -410,11 +590,20 @@ class RootLayerStack (group.LayerStack):
                 )
                 dst = np.empty((N, N, 4), dtype='uint16')
 
-            background_surface.blit_tile_into(dst, dst_has_alpha, tx, ty,
-                                              mipmap_level)
-            for layer in reversed(self):
-                layer.composite_tile(dst, dst_has_alpha, tx, ty,
-                                     mipmap_level, layers=layers, **kwargs)
+            split = self._split_layers
+            if (split is not None and interactive and layers is None and
+                    not (kwargs.get("solo") or kwargs.get("previewing"))):
+                self._composite_tile_split(
+                    split, dst, dst_has_alpha, tx, ty, mipmap_level,
+                    render_background, background_surface, **kwargs
+                )
+            else:
+                background_surface.blit_tile_into(dst, dst_has_alpha,
+                                                  tx, ty, mipmap_level)
+                for layer in reversed(self):
+                    layer.composite_tile(dst, dst_has_alpha, tx, ty,
+                                         mipmap_level, layers=layers,
+                                         **kwargs)
             if overlay:
                 overlay.composite_tile(dst, dst_has_alpha, tx, ty,
                                        mipmap_level, layers=set([overlay]),
@@ -430,7 +619,13 @@ class RootLayerStack (group.LayerStack):
                 dst = dst_over_opaque_base
 
             if cache_key is not None:
-                self._render_cache[cache_key] = dst
+                with self._render_cache_lock:
+                    self._render_cache[cache_key] = dst
+                    if use_pyramid:
+                        self._composite_pyramid.store(
+                            (dst_has_alpha, render_background),
+                            mipmap_level, tx, ty, dst,
+                        )
 
         if dst_8bit is not None:
             if dst_has_alpha:
@@ -438,6 +633,267 @@ class RootLayerStack (group.LayerStack):
             else:
                 lib.mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
 
+    def _get_pyramid_tile(self, config, level, tx, ty):
+        """Internal: get a tile from the composite pyramid
+
+        :param tuple config: (dst_has_alpha, render_background)
+        :param int level: Mipmap level
+        :param int tx: Tile X coordinate, at that level
+        :param int ty: Tile Y coordinate, at that level
+        :returns: A composited 15-bit tile. It must not be modified.
+        :rtype: numpy.ndarray
+
+        Stale quadrants are patched by downscaling the tiles below them,
+        which may be fetched from the level 0 render cache. Missing
+        tiles are composited at their own mipmap level, and stored.
+
+        """
+        N = tiledsurface.N
+        dst_has_alpha, render_background = config
+        updated = None
+        if level == 0:
+            key = (tx, ty, dst_has_alpha, 0, render_background, id(None))
+            with self._render_cache_lock:
+                rgba = self._render_cache.get(key)
+            if rgba is not None:
+                return rgba
+        else:
+            with self._render_cache_lock:
+                rgba, stale = self._composite_pyramid.lookup(
+                    config, level, tx, ty,
+                )
+            if rgba is not None and not stale:
+                return rgba
+        if rgba is None:
+            rgba = np.empty((N, N, 4), dtype='uint16')
+            self.composite_tile(rgba, dst_has_alpha, tx, ty, level,
+                                render_background=render_background)
+        else:
+            rgba = rgba.copy()
+            for qx, qy in stale:
+                src = self._get_pyramid_tile(
+                    config, level - 1,
+                    (tx << 1) + qx, (ty << 1) + qy,
+                )
+                lib.mypaintlib.tile_downscale_rgba16(
+                    src, rgba, qx * N // 2, qy * N // 2,
+                )
+            updated = stale
+        with self._render_cache_lock:
+            if level == 0:
+                self._render_cache[key] = rgba
+            self._composite_pyramid.store(config, level, tx, ty, rgba,
+                                          updated)
+        return rgba
+
+    ## Split compositing while painting
+
+    def _get_split_layers(self):
+        """Internal: split the stack around the current layer
+
+        :returns: (current, below, above), or None if splitting is
+            not possible.
+        :rtype: tuple
+
+        The `below` and `above` lists are the layers composited directly
+        into the destination before and after the current layer, in
+        compositing order. The layers above must all composite as
+        normal-mode "over" operations, so that they can be flattened
+        into one tile first. Every group containing the current layer
+        must be visible and pass-through, so it isn't isolated.
+
+        """
+        path = self.get_current_path()
+        if not path:
+            return None
+        below = []
+        above = []
+        parent = self
+        for depth, i in enumerate(path):
+            children = list(parent)
+            below.extend(reversed(children[i + 1:]))
+            above[0:0] = reversed(children[:i])
+            layer = children[i]
+            if depth < len(path) - 1:
+                if not layer.visible or layer.mode != PASS_THROUGH_MODE:
+                    return None
+                parent = layer
+        if not all(_composites_as_normal(l) for l in above):
+            return None
+        return (layer, below, above)
+
+    def _composite_tile_split(self, split, dst, dst_has_alpha, tx, ty,
+                              mipmap_level, render_background,
+                              background_surface, **kwargs):
+        """Internal: composite a tile using the split cache
+
+        The flattened backdrop (background and layers below) and the
+        flattened foreground (layers above) are cached for each tile, so
+        only the current layer is composited each time it's redrawn.
+
+        """
+        current, below_layers, above_layers = split
+        key = (tx, ty, dst_has_alpha, mipmap_level, render_background)
+        with self._render_cache_lock:
+            entry = self._split_cache.get(key)
+        if entry is None:
+            N = tiledsurface.N
+            below = np.empty((N, N, 4), dtype='uint16')
+            background_surface.blit_tile_into(below, dst_has_alpha, tx, ty,
+                                              mipmap_level)
+            for layer in below_layers:
+                layer.composite_tile(below, dst_has_alpha, tx, ty,
+                                     mipmap_level, **kwargs)
+            above = None
+            if above_layers:
+                above = np.zeros((N, N, 4), dtype='uint16')
+                for layer in above_layers:
+                    layer.composite_tile(above, True, tx, ty,
+                                         mipmap_level, **kwargs)
+                if not above[..., 3].any():
+                    above = None
+            entry = (below, above)
+            with self._render_cache_lock:
+                self._split_cache[key] = entry
+        below, above = entry
+        lib.mypaintlib.tile_copy_rgba16_into_rgba16(below, dst)
+        current.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level,
+                               **kwargs)
+        if above is not None:
+            lib.mypaintlib.tile_combine(
+                DEFAULT_MODE, above,
+                dst, dst_has_alpha,
+                1.0,
+            )
+
+    def _reset_split_cache(self, *_ignored):
+        """Ends any painting session's split compositing"""
+        self._split_layers = None
+        with self._render_cache_lock:
+            self._split_cache.clear()
+
+    def _split_cache_content_changed_cb(self, root, layer, *args):
+        """Starts or updates split compositing after content changes
+
+        Changes to the current layer begin a painting session. Changes
+        to any other layer discard the affected backdrop and foreground
+        tiles.
+
+        """
+        split = self._split_layers
+        if layer is self.current and layer is not self:
+            if split is None or split[0] is not layer:
+                self._reset_split_cache()
+                self._split_layers = self._get_split_layers()
+            return
+        if split is None:
+            return
+        if len(args) != 4 or args[2] <= 0 or args[3] <= 0:
+            self._reset_split_cache()
+            return
+        overlaps = _tile_key_overlap_predicate(*args)
+        with self._render_cache_lock:
+            self._split_cache.invalidate(overlaps)
+
+    ## Mipmap maintenance
+
+    def set_viewport_bbox(self, view, bbox):
+        """Records the model area shown by a zoomed-out view
+
+        :param view: The view, which is only weakly referenced
+        :param tuple bbox: Visible area in model coords, or None
+
+        Dirty mipmap tiles in the recorded areas are regenerated first
+        by the idle-time mipmap updates. Views should pass None when
+        they're not using mipmaps.
+
+        """
+        if bbox is None:
+            self._viewport_bboxes.pop(view, None)
+        else:
+            self._viewport_bboxes[view] = tuple(bbox)
+            self._queue_mipmap_updates()
+
+    def _mipmap_content_changed_cb(self, root, layer, *args):
+        """Starts regenerating mipmaps after layer content changes"""
+        self._queue_mipmap_updates()
+
+    def _queue_mipmap_updates(self):
+        if not self._mipmap_tasks.has_work():
+            self._mipmap_tasks.add_work(self._update_mipmaps_task)
+
+    def _update_mipmaps_task(self):
+        """Idle task: regenerates a batch of dirty mipmap tiles
+
+        Mipmaps are otherwise regenerated recursively when a zoomed-out
+        view first renders them, which stalls after long edits. Tiles
+        in the areas shown by views are done first.
+
+        """
+        max_tiles = self.MIPMAP_UPDATE_BATCH_SIZE
+        bboxes = self._viewport_bboxes.values()
+        done = 0
+        if bboxes:
+            done = self.update_mipmaps(max_tiles, bboxes, priority_only=True)
+        if done < max_tiles:
+            done += self.update_mipmaps(max_tiles - done)
+        return done > 0
+
+    ## Flood fill
+
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None,
+                   progress_cb=None):
+        """Fills using the composite of all visible layers as the source
+
+        See `PaintingLayer.flood_fill()` for parameters and semantics.
+        The root stack can only be filled into another layer.
+
+        This is the "sample merged" fill. Source tiles are composited
+        only where the fill spreads to, and are shared with the render
+        cache. Tiles already rendered for display are reused if they
+        are cached, as are tiles composited for earlier fills.
+
+        """
+        assert dst_layer is not self
+        assert dst_layer is not None
+        src = _MergedTileSource(self)
+        dst = dst_layer._surface
+        return tiledsurface.flood_fill(src, x, y, color, bbox, tolerance, dst,
+                                       progress_cb=progress_cb)
+
+    def _get_merged_tile(self, tx, ty, render_background):
+        """Internal: get a composited 15-bit RGBA tile, using the cache
+
+        :param int tx: Tile X coordinate
+        :param int ty: Tile Y coordinate
+        :param bool render_background: Include the background layer
+        :returns: A composited tile. It must not be modified.
+        :rtype: numpy.ndarray
+
+        """
+        N = tiledsurface.N
+        # Same keys as composite_tile() uses, with no opaque base tile
+        key = (tx, ty, True, 0, render_background, id(None))
+        display_key = (tx, ty, False, 0, render_background, id(None))
+        display_tile = None
+        with self._render_cache_lock:
+            tile = self._render_cache.get(key)
+            if tile is None and render_background:
+                display_tile = self._render_cache.get(display_key)
+        if tile is not None:
+            return tile
+        if display_tile is not None:
+            # Rendered without alpha, but the background makes it opaque.
+            tile = display_tile.copy()
+            tile[..., 3] = 1 << 15
+        else:
+            tile = np.zeros((N, N, 4), dtype='uint16')
+            self.composite_tile(tile, True, tx, ty,
+                                render_background=render_background)
+        with self._render_cache_lock:
+            self._render_cache[key] = tile
+        return tile
+
     ## Symmetry axis
 
     @property
@@ -1606,6 +2062,7 @@ class RootLayerStack (group.LayerStack):
                 if backdrop_layers:
                     dst[:, :, 3] = 0  # minimize alpha (discard original)
                     lib.mypaintlib.tile_flat2rgba(dst, bd)
+        dstsurf.share_uniform_tiles()
         return dstlayer
 
     def get_merge_down_target(self, path):
@@ -1708,6 +2165,7 @@ class RootLayerStack (group.LayerStack):
             with dstsurf.tile_request(tx, ty, readonly=False) as dst:
                 for layer in merge_layers:
                     layer.composite_tile(dst, True, tx, ty, mipmap_level=0)
+        dstsurf.share_uniform_tiles()
         return dstlayer
 
     def layer_new_merge_visible(self):
@@ -1769,6 +2227,7 @@ class RootLayerStack (group.LayerStack):
                     with bgsurf.tile_request(tx, ty, readonly=True) as bg:
                         dst[:, :, 3] = 0  # minimize alpha (discard original)
                         lib.mypaintlib.tile_flat2rgba(dst, bg)
+        dstsurf.share_uniform_tiles()
         return dstlayer
 
     ## Loading
@@ -1844,9 +2303,22 @@ class RootLayerStack (group.LayerStack):
         logger.debug("Selecting %r after load", selected_path)
         self.set_current_path(selected_path)
 
-    def _load_child_layer_from_orazip(self, orazip, elem, cache_dir,
-                                      feedback_cb, x=0, y=0, **kwargs):
-        """Loads and appends a single child layer from an open .ora file"""
+    def _can_load_child_in_worker(self, elem):
+        """True if a child element can be loaded by a worker thread
+
+        The special background tile element is always loaded by the
+        main thread.
+
+        """
+        for bg_src_attr in [data.BackgroundLayer.ORA_BGTILE_ATTR,
+                            data.BackgroundLayer.ORA_BGTILE_LEGACY_ATTR]:
+            if elem.attrib.get(bg_src_attr, None):
+                return False
+        return super(RootLayerStack, self)._can_load_child_in_worker(elem)
+
+    def _new_child_layer_from_orazip(self, orazip, elem, cache_dir,
+                                     feedback_cb, x=0, y=0, **kwargs):
+        """Loads a single child layer from an open .ora file"""
         attrs = elem.attrib
         # Handle MyPaint's special background tile notation
         # MyPaint will support reading .ora files using the legacy
@@ -1873,10 +2345,10 @@ class RootLayerStack (group.LayerStack):
                 )
                 self.set_background(bg_pixbuf)
                 self._no_background = False
-                return
+                return None
             except tiledsurface.BackgroundError as e:
                 logger.warning('ORA background tile not usable: %r', e)
-        super(RootLayerStack, self)._load_child_layer_from_orazip(
+        return super(RootLayerStack, self)._new_child_layer_from_orazip(
             orazip,
             elem,
             cache_dir,
@@ -1900,9 +2372,9 @@ class RootLayerStack (group.LayerStack):
         del self._no_background
         self._set_current_path_after_ora_load()
 
-    def _load_child_layer_from_oradir(self, oradir, elem, cache_dir,
-                                      feedback_cb, x=0, y=0, **kwargs):
-        """Loads and appends a single child layer from an open .ora file"""
+    def _new_child_layer_from_oradir(self, oradir, elem, cache_dir,
+                                     feedback_cb, x=0, y=0, **kwargs):
+        """Loads a single child layer from an OpenRaster dir"""
         attrs = elem.attrib
         # Handle MyPaint's special background tile notation
         # MyPaint will support reading .ora files using the legacy
@@ -1928,10 +2400,10 @@ class RootLayerStack (group.LayerStack):
                 )
                 self.set_background(bg_pixbuf)
                 self._no_background = False
-                return
+                return None
             except tiledsurface.BackgroundError as e:
                 logger.warning('ORA background tile not usable: %r', e)
-        super(RootLayerStack, self)._load_child_layer_from_oradir(
+        return super(RootLayerStack, self)._new_child_layer_from_oradir(
             oradir,
             elem,
             cache_dir,
@@ -2028,6 +2500,12 @@ class RootLayerStack (group.LayerStack):
         """Snapshots the state of the layer, for undo purposes"""
         return RootLayerStackSnapshot(self)
 
+    def get_tiledicts(self):
+        """Returns the tiledicts of all layers, including the background"""
+        tiledicts = super(RootLayerStack, self).get_tiledicts()
+        tiledicts.extend(self._background_layer.get_tiledicts())
+        return tiledicts
+
 
 class RootLayerStackSnapshot (group.LayerStackSnapshot):
     """Snapshot of a root layer stack's state"""
@@ -2044,6 +2522,246 @@ class RootLayerStackSnapshot (group.LayerStackSnapshot):
         layer.background_visible = self.bg_visible
         layer.current_path = self.current_path
 
+    def get_tiledicts(self):
+        tiledicts = super(RootLayerStackSnapshot, self).get_tiledicts()
+        tiledicts.extend(self.bg_sshot.get_tiledicts())
+        return tiledicts
+
+
+class _MergedTileSource (object):
+    """Readonly tile source: the composite of a RootLayerStack
+
+    Tiles are fetched with `tile_request()`, as for surfaces. They are
+    composited or fetched from the root stack's render cache only when
+    first requested, and are kept for the lifetime of the source.
+
+    """
+
+    def __init__(self, root):
+        """Initialize, ready to fetch tiles from a root layer stack
+
+        :param RootLayerStack root: The layer stack to composite
+
+        """
+        super(_MergedTileSource, self).__init__()
+        self._root = root
+        self._render_background = root._get_render_background()
+        self._tiles = {}
+
+    @contextlib.contextmanager
+    def tile_request(self, tx, ty, readonly):
+        """Context manager that fetches a composited tile
+
+        To be used with the 'with' statement.
+        """
+        if not readonly:
+            raise ValueError("Only readonly tile requests are supported")
+        tile = self._tiles.get((tx, ty))
+        if tile is None:
+            tile = self._root._get_merged_tile(
+                tx, ty,
+                self._render_background,
+            )
+            self._tiles[(tx, ty)] = tile
+        yield tile
+
+
+class _CompositePyramid (object):
+    """Downscaled copies of the flattened root stack, for zoomed-out views
+
+    Each tile at a mipmap level above zero holds a downscale of the four
+    tiles below it, all composited with the same configuration (alpha,
+    background). Level zero is in the root stack's render cache. Edits
+    just mark the quadrants they touch as stale, and up to date tiles
+    are downscaled into their parents' stale quadrants as they're made,
+    so coarse levels are updated from the finer levels being redrawn
+    instead of being composited again from every layer.
+
+    >>> N = tiledsurface.N
+    >>> p = _CompositePyramid()
+    >>> config = (False, True)
+    >>> p.store(config, 1, 0, 0, np.zeros((N, N, 4), dtype='uint16'))
+    >>> p.invalidate(1, 0, 1, 0)
+    >>> rgba, stale = p.lookup(config, 1, 0, 0)
+    >>> sorted(stale)
+    [(1, 0)]
+    >>> p.store(config, 0, 1, 0, np.ones((N, N, 4), dtype='uint16') << 15)
+    >>> rgba, stale = p.lookup(config, 1, 0, 0)
+    >>> stale, int(rgba[0, N-1, 0]), int(rgba[0, 0, 0])
+    (set([]), 32768, 0)
+
+    Instances aren't thread-safe: the root stack serializes access.
+
+    """
+
+    #: Quadrants of a tile, by the offsets of the tiles below them
+    _QUADRANTS = frozenset([(0, 0), (0, 1), (1, 0), (1, 1)])
+
+    def __init__(self, capacity=1024):
+        super(_CompositePyramid, self).__init__()
+        self._tiles = lib.cache.LRUCache(capacity=capacity)
+        self._configs = set()
+
+    def clear(self):
+        self._tiles.clear()
+        self._configs.clear()
+
+    def lookup(self, config, level, tx, ty):
+        """Looks up a tile above level 0
+
+        :returns: (rgba, stale_quadrants), or (None, None) if not stored
+        :rtype: tuple
+
+        The returned array must not be modified.
+
+        """
+        entry = self._tiles.get((config, level, tx, ty))
+        if entry is None:
+            return (None, None)
+        return (entry[0], set(entry[1]))
+
+    def store(self, config, level, tx, ty, rgba, updated=None):
+        """Stores an up to date tile, and updates the levels above it
+
+        :param tuple config: What the tile was composited with
+        :param int level: Its mipmap level
+        :param int tx: Its tile X coordinate, at that level
+        :param int ty: Its tile Y coordinate, at that level
+        :param rgba: The tile's pixels, which must not be modified
+        :param set updated: Quadrants brought up to date, if not all
+
+        Level 0 tiles are only used for updating the levels above them.
+
+        """
+        stale = set()
+        if level > 0:
+            key = (config, level, tx, ty)
+            if updated is not None:
+                entry = self._tiles.get(key)
+                if entry is not None:
+                    stale = entry[1] - updated
+            self._configs.add(config)
+            self._tiles[key] = (rgba, stale)
+        if not stale:
+            self._propagate(config, level, tx, ty, rgba)
+
+    def _propagate(self, config, level, tx, ty, rgba):
+        """Downscales a tile into its parents' stale quadrants"""
+        N = tiledsurface.N
+        while level < tiledsurface.MAX_MIPMAP_LEVEL:
+            quadrant = (tx & 1, ty & 1)
+            level += 1
+            tx >>= 1
+            ty >>= 1
+            key = (config, level, tx, ty)
+            if key not in self._tiles:
+                return
+            parent, stale = self._tiles.get(key)
+            if quadrant not in stale:
+                return
+            # Copy on write: readers may still hold the old array
+            parent = parent.copy()
+            lib.mypaintlib.tile_downscale_rgba16(
+                rgba, parent,
+                quadrant[0] * N // 2,
+                quadrant[1] * N // 2,
+            )
+            stale = stale - set([quadrant])
+            self._tiles[key] = (parent, stale)
+            if stale:
+                return
+            rgba = parent
+
+    def invalidate(self, tx0, ty0, tx1, ty1):
+        """Marks quadrants stale after a change to some level 0 tiles
+
+        :param int tx0: First changed tile column
+        :param int ty0: First changed tile row
+        :param int tx1: Last changed tile column
+        :param int ty1: Last changed tile row
+
+        Tiles are discarded instead if the area is very large.
+
+        """
+        tiles = self._tiles
+        for level in xrange(1, tiledsurface.MAX_MIPMAP_LEVEL + 1):
+            shift = level - 1
+            cx0, cy0 = tx0 >> shift, ty0 >> shift
+            cx1, cy1 = tx1 >> shift, ty1 >> shift
+            area = (cx1 - cx0 + 1) * (cy1 - cy0 + 1)
+            if area * len(self._configs) > len(tiles):
+                px0, py0, px1, py1 = cx0 >> 1, cy0 >> 1, cx1 >> 1, cy1 >> 1
+                tiles.invalidate(
+                    lambda k: (k[1] == level and px0 <= k[2] <= px1
+                               and py0 <= k[3] <= py1)
+                )
+                continue
+            for config in self._configs:
+                for cx in xrange(cx0, cx1 + 1):
+                    for cy in xrange(cy0, cy1 + 1):
+                        key = (config, level, cx >> 1, cy >> 1)
+                        if key in tiles:
+                            tiles.get(key)[1].add((cx & 1, cy & 1))
+
+
+def _composites_as_normal(layer):
+    """True if a layer composites like a normal-mode layer, or not at all
+
+    Pass-through groups composite their children directly, so it
+    depends on them. Other groups are isolated, and only their mode
+    matters.
+
+    """
+    if not layer.visible:
+        return True
+    if isinstance(layer, group.LayerStack) and layer.mode == PASS_THROUGH_MODE:
+        return all(_composites_as_normal(c) for c in layer)
+    return layer.mode == DEFAULT_MODE
+
+
+def _get_tile_range(x, y, w, h):
+    """Returns the tiles overlapping a model bbox, at mipmap level 0
+
+    :returns: (tx0, ty0, tx1, ty1), all inclusive
+    :rtype: tuple
+
+    >>> N = tiledsurface.N
+    >>> _get_tile_range(-1, 0, N + 2, N)
+    (-1, 0, 1, 0)
+
+    """
+    N = tiledsurface.N
+    tx0 = int(x // N)
+    ty0 = int(y // N)
+    tx1 = int((x + w - 1) // N)
+    ty1 = int((y + h - 1) // N)
+    return (tx0, ty0, tx1, ty1)
+
+
+def _tile_key_overlap_predicate(x, y, w, h):
+    """Returns a test for cache keys whose tiles overlap a model bbox
+
+    :returns: A predicate for keys starting ``(tx, ty, _, mipmap_level)``
+    :rtype: callable
+
+    >>> N = tiledsurface.N
+    >>> overlaps = _tile_key_overlap_predicate(2*N, 0, 1, 1)
+    >>> overlaps((2, 0, True, 0)), overlaps((1, 0, True, 1))
+    (True, True)
+    >>> overlaps((1, 0, True, 0)), overlaps((0, 0, True, 1))
+    (False, False)
+
+    """
+    tx0, ty0, tx1, ty1 = _get_tile_range(x, y, w, h)
+
+    def _overlaps(key):
+        tx, ty = key[0:2]
+        mipmap_level = key[3]
+        return ((tx0 >> mipmap_level) <= tx <= (tx1 >> mipmap_level)
+                and (ty0 >> mipmap_level) <= ty <= (ty1 >> mipmap_level))
+
+    return _overlaps
+
 
 ## Layer path tuple functions
 
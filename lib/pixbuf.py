@@ -55,23 +55,45 @@ def save(pixbuf, filename, type='png', **kwargs):
 
     """
     with open(filename, 'wb') as fp:
-        try:
-            save_to_callbackv = pixbuf.save_to_callbackv
-        except AttributeError:
-            # save_to_callbackv disappeared in GdkPixbuf 2.31.2
-            # and returned as of GdkPixbuf 2.31.5
-            # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
-            save_to_callbackv = pixbuf.save_to_callback
-        # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
-        # a.k.a. precise, a.k.a. "what Travis-CI runs")
-        result = save_to_callbackv(
-            lambda buf, size, data: fp.write(buf) or True,  # save_func
-            fp,      # user_data
-            type,      # type
-            kwargs.keys(),   # option_keys
-            kwargs.values(),  # option_values
-        )
-        return result
+        return save_to_stream(pixbuf, fp, type, **kwargs)
+
+
+def save_to_stream(pixbuf, fp, type='png', **kwargs):
+    """Save pixbuf to a file-like object
+
+    :param GdkPixbuf.Pixbuf pixbuf: the pixbuf to save
+    :param fp: file-like object to write to
+    :param str type: type to save as: 'jpeg'/'png'/...
+    :param \*\*kwargs: passed through to GdkPixbuf
+    :rtype: bool
+    :returns: whether the data was saved fully
+
+    >>> import io
+    >>> p = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,True,8,64,64)
+    >>> buf = io.BytesIO()
+    >>> save_to_stream(p, buf, type="png")
+    True
+    >>> buf.getvalue()[1:4] == b"PNG"
+    True
+
+    """
+    try:
+        save_to_callbackv = pixbuf.save_to_callbackv
+    except AttributeError:
+        # save_to_callbackv disappeared in GdkPixbuf 2.31.2
+        # and returned as of GdkPixbuf 2.31.5
+        # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
+        save_to_callbackv = pixbuf.save_to_callback
+    # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
+    # a.k.a. precise, a.k.a. "what Travis-CI runs")
+    result = save_to_callbackv(
+        lambda buf, size, data: fp.write(buf) or True,  # save_func
+        fp,      # user_data
+        type,      # type
+        kwargs.keys(),   # option_keys
+        kwargs.values(),  # option_values
+    )
+    return result
 
 
 def load_from_file(filename, feedback_cb=None):
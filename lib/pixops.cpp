@@ -105,8 +105,11 @@ void tile_copy_rgba16_into_rgba16(PyObject * src, PyObject * dst) {
   }
   */
 
-  tile_copy_rgba16_into_rgba16_c((uint16_t *)PyArray_DATA(src_arr),
-                                 (uint16_t *)PyArray_DATA(dst_arr));
+  uint16_t *src_p = (uint16_t *)PyArray_DATA(src_arr);
+  uint16_t *dst_p = (uint16_t *)PyArray_DATA(dst_arr);
+  Py_BEGIN_ALLOW_THREADS
+  tile_copy_rgba16_into_rgba16_c(src_p, dst_p);
+  Py_END_ALLOW_THREADS
 }
 
 void tile_clear_rgba8(PyObject * dst) {
@@ -296,10 +299,16 @@ tile_convert_rgba16_to_rgba8 (PyObject *src,
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
-  tile_convert_rgba16_to_rgba8_c((uint16_t*)PyArray_DATA(src_arr),
-                                 PyArray_STRIDES(src_arr)[0],
-                                 (uint8_t*)PyArray_DATA(dst_arr),
-                                 PyArray_STRIDES(dst_arr)[0]);
+  // The noise table must be set up while the GIL is still held.
+  precalculate_dithering_noise_if_required();
+
+  const uint16_t *src_p = (uint16_t*)PyArray_DATA(src_arr);
+  const int src_strides = PyArray_STRIDES(src_arr)[0];
+  uint8_t *dst_p = (uint8_t*)PyArray_DATA(dst_arr);
+  const int dst_strides = PyArray_STRIDES(dst_arr)[0];
+  Py_BEGIN_ALLOW_THREADS
+  tile_convert_rgba16_to_rgba8_c(src_p, src_strides, dst_p, dst_strides);
+  Py_END_ALLOW_THREADS
 }
 
 static inline void
@@ -371,8 +380,16 @@ void tile_convert_rgbu16_to_rgbu8(PyObject * src, PyObject * dst) {
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
-  tile_convert_rgbu16_to_rgbu8_c((uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
-                                 (uint8_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0]);
+  // The noise table must be set up while the GIL is still held.
+  precalculate_dithering_noise_if_required();
+
+  const uint16_t *src_p = (uint16_t*)PyArray_DATA(src_arr);
+  const int src_strides = PyArray_STRIDES(src_arr)[0];
+  uint8_t *dst_p = (uint8_t*)PyArray_DATA(dst_arr);
+  const int dst_strides = PyArray_STRIDES(dst_arr)[0];
+  Py_BEGIN_ALLOW_THREADS
+  tile_convert_rgbu16_to_rgbu8_c(src_p, src_strides, dst_p, dst_strides);
+  Py_END_ALLOW_THREADS
 }
 
 
@@ -549,6 +566,8 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
   uint16_t * b_p  = (uint16_t*)PyArray_DATA(b);
   uint8_t * res_p = (uint8_t*)PyArray_DATA(res);
 
+  // Strokemap diffs are computed by worker threads
+  Py_BEGIN_ALLOW_THREADS
   for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
     for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
 
@@ -593,6 +612,7 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
       res_p += 1;
     }
   }
+  Py_END_ALLOW_THREADS
 }
 
 
@@ -746,6 +766,9 @@ tile_combine (enum CombineMode mode,
         return;
     }
     const TileDataCombineOp *op = combine_mode_info[mode];
+    // Pure pixel loops: let other threads composite while this runs.
+    Py_BEGIN_ALLOW_THREADS
     op->combine_data(src_p, dst_p, dst_has_alpha, src_opacity);
+    Py_END_ALLOW_THREADS
 }
 
@@ -25,6 +25,8 @@ void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y);
 // Simple array copying (numpy assignment operator) is about 13 times slower,
 // sadly. The above comment is true when the array is sliced; it's only about
 // two times faster now, in the current use case.
+//
+// Releases the GIL while copying.
 
 void tile_copy_rgba16_into_rgba16(PyObject *src, PyObject *dst);
 
@@ -40,11 +42,13 @@ void tile_clear_rgba8(PyObject *dst);
 
 // Converts a 15ish-bit tile array to 8bpp RGBA.
 // Used mainly for saving layers when alpha must be preserved.
+// Releases the GIL while converting.
 
 void tile_convert_rgba16_to_rgba8(PyObject *src, PyObject *dst);
 
 
 // Converts a 15ish-bit tile array to 8bpp RGB ("ignoring" alpha).
+// Releases the GIL while converting.
 
 void tile_convert_rgbu16_to_rgbu8(PyObject *src, PyObject *dst);
 
@@ -123,6 +127,8 @@ combine_mode_get_info(enum CombineMode mode);
 
 
 // Blend and composite one tile, writing into the destination.
+// Releases the GIL while compositing, so several threads can work on
+// different destination tiles at the same time.
 
 void
 tile_combine (enum CombineMode mode,
@@ -14,6 +14,8 @@ import time
 import struct
 import zlib
 import math
+import collections
+import bisect
 from logging import getLogger
 logger = getLogger(__name__)
 
@@ -23,9 +25,20 @@ import mypaintlib
 
 import tiledsurface
 import idletask
+import workerpool
 
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
+#: How many decompressed strokemap tile bitmaps to keep for picking
+BITMAP_CACHE_SIZE = 64
+
+
+## Module vars
+
+_bitmap_cache = collections.OrderedDict()  # {id(tile): (tile, array)}
+_diff_pool = workerpool.WorkerPool(name="strokemap")
+_shape_changes = 0  # bumped when any shape's tiles are moved or removed
+
 
 ## Class defs
 
@@ -36,11 +49,19 @@ class StrokeShape (object):
     information is stored in compressed memory blocks of the size of a
     tile (for fast lookup).
 
+    Once its queued work is done, a shape's strokemap dict is never
+    changed in place. Moving or trimming the shape replaces it, so that
+    `frozen()` can share it with a saver running in another thread.
+
     """
     def __init__(self):
         """Construct a new, blank StrokeShape."""
         object.__init__(self)
-        self.tasks = idletask.Processor()
+        # Storing a diffed tile is quick, so do several per idle dispatch.
+        self.tasks = idletask.Processor(
+            time_budget = idletask.DEFAULT_TIME_BUDGET,
+            adaptive = True,
+        )
         self.strokemap = {}
         self.brush_string = None
 
@@ -49,30 +70,24 @@ class StrokeShape (object):
         """Build a new StrokeShape from before+after pair of snapshots.
 
         :param before: snapshot of the layer before the stroke
-        :type before: lib.tiledsurface._TiledSurfaceSnapshot
+        :type before: lib.tiledsurface._SurfaceSnapshot
         :param after: snapshot of the layer after the stroke
-        :type after: lib.tiledsurface._TiledSurfaceSnapshot
+        :type after: lib.tiledsurface._SurfaceSnapshot
         :returns: A new StrokeShape, or None.
 
         If the snapshots haven't changed, None is returned. In this
-        case, no StrokeShape should be recorded.
+        case, no StrokeShape should be recorded. Only the tiles logged
+        as replaced between the two snapshots' generations are compared.
 
         """
-        before_dict = before.tiledict
-        after_dict = after.tiledict
-        before_tiles = set(before_dict.iteritems())
-        after_tiles = set(after_dict.iteritems())
-        changed_idxs = set(
-            pos for pos, data
-            in before_tiles.symmetric_difference(after_tiles)
-        )
+        changed_idxs = before.get_changed_positions(after)
         if not changed_idxs:
             return None
         shape = cls()
         assert not shape.strokemap
         shape.tasks.add_work(_TileDiffUpdateTask(
-            before.tiledict,
-            after.tiledict,
+            before,
+            after,
             changed_idxs,
             shape.strokemap,
         ))
@@ -106,18 +121,32 @@ class StrokeShape (object):
         Format: "v2" strokemap format.
 
         """
-        assert translate_x % N == 0
-        assert translate_y % N == 0
-        translate_x /= N
-        translate_y /= N
+        return ''.join(self.get_save_chunks(translate_x, translate_y))
+
+    def get_save_chunks(self, translate_x, translate_y):
+        """Return the pieces of save_to_string()'s output, in order.
+
+        :returns: list of byte strings
+
+        The tiles' bitmaps are stored compressed already, so the list
+        just refers to them. Writing the chunks one by one avoids
+        building the whole string in memory.
+
+        """
         self.tasks.finish_all()
-        data = ''
-        for (tx, ty), tile in self.strokemap.iteritems():
-            compressed_bitmap = tile.to_string()
-            tx, ty = tx + translate_x, ty + translate_y
-            data += struct.pack('>iiI', tx, ty, len(compressed_bitmap))
-            data += compressed_bitmap
-        return data
+        return _get_save_chunks(self.strokemap, translate_x, translate_y)
+
+    def frozen(self):
+        """Returns the shape's current state, for saving in another thread
+
+        :rtype: FrozenStrokeShape
+
+        Any queued work on the shape is completed first. Nothing is
+        copied: later moves and trims replace the strokemap dict.
+
+        """
+        self.tasks.finish_all()
+        return FrozenStrokeShape(self.brush_string, self.strokemap)
 
     def _complete_tile_tasks(self, pred):
         """Complete all queued work on a subset of tiles.
@@ -160,7 +189,7 @@ class StrokeShape (object):
         self._complete_tile_tasks(pred)
         tile = self.strokemap.get(pixel_ti)
         if tile:
-            array = tile.to_array()
+            array = _get_cached_bitmap(tile)
             return bool(array[y % N, x % N])
         return False
 
@@ -197,8 +226,11 @@ class StrokeShape (object):
     def translate(self, dx, dy):
         """Translate the shape by (dx, dy)"""
         self.tasks.finish_all()
+        _note_shape_change()
+        src = self.strokemap.copy()  # the old dict may be being saved
+        self.strokemap = {}
         tmp = {}
-        self.tasks.add_work(_TileTranslateTask(self.strokemap, tmp, dx, dy))
+        self.tasks.add_work(_TileTranslateTask(src, tmp, dx, dy))
         self.tasks.add_work(_TileRecompressTask(tmp, self.strokemap))
 
     def trim(self, rect):
@@ -212,66 +244,236 @@ class StrokeShape (object):
         Only complete tiles are discarded by this method.
         """
         self.tasks.finish_all()
+        _note_shape_change()
         x, y, w, h = rect
         logger.debug("Trimming stroke to %dx%d%+d%+d", w, h, x, y)
-        for tx, ty in list(self.strokemap.keys()):
-            if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
-                self.strokemap.pop((tx, ty))
+        self.strokemap = dict(
+            ((tx, ty), tile)
+            for (tx, ty), tile in self.strokemap.iteritems()
+            if not (tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h)
+        )
         return bool(self.strokemap)
 
 
+class FrozenStrokeShape (
+        collections.namedtuple(
+            "FrozenStrokeShape",
+            ["brush_string", "strokemap"],
+        )):
+    """A stroke shape's state at one time, for saving
+
+    Made by `StrokeShape.frozen()`. It can be written out in another
+    thread, because the strokemap it refers to is never changed.
+
+    >>> shape = StrokeShape()
+    >>> shape.strokemap[(0, 0)] = _Tile()
+    >>> shape.strokemap[(5, 5)] = _Tile()
+    >>> frozen = shape.frozen()
+    >>> shape.trim((0, 0, N, N))
+    True
+    >>> sorted(frozen.strokemap), sorted(shape.strokemap)
+    ([(0, 0), (5, 5)], [(0, 0)])
+
+    """
+
+    __slots__ = ()
+
+    def get_save_chunks(self, translate_x, translate_y):
+        """Same as `StrokeShape.get_save_chunks()`"""
+        return _get_save_chunks(self.strokemap, translate_x, translate_y)
+
+
+def _get_save_chunks(strokemap, translate_x, translate_y):
+    """Returns a strokemap's pieces of the v2 strokemap format"""
+    assert translate_x % N == 0
+    assert translate_y % N == 0
+    translate_x //= N
+    translate_y //= N
+    chunks = []
+    for (tx, ty), tile in strokemap.iteritems():
+        compressed_bitmap = tile.to_string()
+        tx, ty = tx + translate_x, ty + translate_y
+        chunks.append(struct.pack('>iiI', tx, ty, len(compressed_bitmap)))
+        chunks.append(compressed_bitmap)
+    return chunks
+
+
+class StrokeIndex (object):
+    """Spatial index of a stack of stroke shapes, for fast picking
+
+    This maps strokemap tile indexes to the shapes which touch them, so
+    that picking a stroke at a point only needs to look at the few
+    shapes covering that tile, and not at every shape in a layer.
+
+    >>> def shape(*tile_idxs):
+    ...     s = StrokeShape()
+    ...     for ti in tile_idxs:
+    ...         s.strokemap[ti] = _Tile()  # all ones
+    ...     return s
+    >>> a = shape((0, 0), (1, 0))
+    >>> b = shape((1, 0))
+    >>> idx = StrokeIndex([a, b])
+    >>> len(idx)
+    2
+    >>> idx.get_stroke_at(N+1, 1) is b    # newest first
+    True
+    >>> idx.get_stroke_at(1, 1) is a
+    True
+    >>> idx.get_stroke_at(-1, 1) is None
+    True
+
+    Shapes are added on top of the stack. Shapes whose tiles are
+    still being worked out are checked directly until they're ready.
+
+    Moving or trimming any shape makes all indexes stale, because
+    shapes may be shared between layers. Stale indexes must be
+    rebuilt by their owners before they are used again.
+
+    >>> idx.stale
+    False
+    >>> a.trim((0, 0, N, N))
+    True
+    >>> idx.stale
+    True
+
+    """
+
+    def __init__(self, shapes=()):
+        """Initialize, indexing an initial stack of shapes
+
+        :param iterable shapes: StrokeShapes, ordered by depth
+
+        """
+        super(StrokeIndex, self).__init__()
+        self._tiles = {}  # {(tx, ty): [(depth, shape), ...]}, by depth
+        self._pending = []  # [(depth, shape), ...], with queued work
+        self._count = 0
+        self._changes = _shape_changes
+        for shape in shapes:
+            self.add(shape)
+
+    def __len__(self):
+        """The number of shapes added"""
+        return self._count
+
+    @property
+    def stale(self):
+        """True if any shape was moved or trimmed since initialization"""
+        return self._changes != _shape_changes
+
+    def add(self, shape):
+        """Adds a shape to the top of the stack
+
+        :param StrokeShape shape: The shape to add
+
+        """
+        entry = (self._count, shape)
+        self._count += 1
+        if shape.tasks.has_work():
+            self._pending.append(entry)
+        else:
+            self._index(entry)
+
+    def get_stroke_at(self, x, y):
+        """Returns the topmost shape which touches a pixel
+
+        :param int x: Pixel X position.
+        :param int y: Pixel Y position.
+        :returns: The topmost shape touching (x, y), or None.
+        :rtype: StrokeShape
+
+        """
+        x = int(x)
+        y = int(y)
+        self._index_pending()
+        candidates = self._tiles.get((x // N, y // N), [])
+        if self._pending:
+            candidates = sorted(
+                candidates + self._pending,
+                key = lambda e: e[0],
+            )
+        for depth, shape in reversed(candidates):
+            if shape.touches_pixel(x, y):
+                return shape
+        return None
+
+    def _index_pending(self):
+        """Indexes any pending shapes whose work has finished"""
+        pending = []
+        for entry in self._pending:
+            if entry[1].tasks.has_work():
+                pending.append(entry)
+            else:
+                self._index(entry)
+        self._pending = pending
+
+    def _index(self, entry):
+        """Adds a (depth, shape) entry to the lists for its tiles"""
+        depth, shape = entry
+        for ti in shape.strokemap:
+            entries = self._tiles.setdefault(ti, [])
+            if entries and entries[-1][0] > depth:
+                idx = bisect.bisect([e[0] for e in entries], depth)
+                entries.insert(idx, entry)
+            else:
+                entries.append(entry)
+
+
 class _TileDiffUpdateTask:
     """Idle task: update strokemap with tile & pixel diffs of snapshots.
 
-    This task is used during initialization of the StrokeShape.
+    This task is used during initialization of the StrokeShape. The
+    snapshots can't change, so the diffing and compression is done by
+    a pool of worker threads. The task just stores their results in the
+    strokemap, which is only ever changed by the main thread.
 
     """
 
     def __init__(self, before, after, changed_idxs, targ):
         """Initialize, ready to update a target StrokeShape with diffs
 
-        :param dict before: Complete pre-stroke tiledict (RO, {xy:Tile})
-        :param dict after: Complete post-stroke tiledict (RO, {xy:Tile})
-        :param set changed_idxs: RW set of (x,y) tile indexes to process
+        :param before: Pre-stroke snapshot or tiledict (RO, has get())
+        :param after: Post-stroke snapshot or tiledict (RO, has get())
+        :param set changed_idxs: set of (x,y) tile indexes to process
         :param dict targ: Target strokemap (WO, {xy: bytes})
 
+        Work on all the tiles is submitted to the pool immediately.
+
         """
-        self._before_dict = before
-        self._after_dict = after
         self._targ_dict = targ
-        self._remaining = changed_idxs
+        transparent = tiledsurface.transparent_tile
+        self._jobs = collections.OrderedDict()  # {(x,y): Job}
+        for ti in changed_idxs:
+            self._jobs[ti] = _diff_pool.submit(
+                _diff_tiles,
+                before.get(ti, transparent),
+                after.get(ti, transparent),
+            )
 
     def __repr__(self):
         return "<{name} remaining={remaining}>".format(
             name = self.__class__.__name__,
-            remaining = len(self._remaining),
+            remaining = len(self._jobs),
         )
 
     def __call__(self):
-        """Diff and update one queued tile."""
+        """Store the result for one queued tile, waiting if needed."""
         try:
-            ti = self._remaining.pop()
+            ti, job = self._jobs.popitem(last=False)
         except KeyError:
             return False
-        self._update_tile(ti)
-        return bool(self._remaining)
+        self._targ_dict[ti] = job.result()
+        return bool(self._jobs)
 
     def process_tile_subset(self, pred):
-        """Diff and update a subset of queued tiles now."""
-        processed = set()
-        for ti in self._remaining:
-            if not pred(ti):
-                continue
-            self._update_tile(ti)
-            processed.add(ti)
-        self._remaining -= processed
+        """Store results for a subset of queued tiles now.
 
-    def _update_tile(self, ti):
-        """Diff and update the tile at a specified position."""
-        transparent = tiledsurface.transparent_tile
-        data_before = self._before_dict.get(ti, transparent).rgba
-        data_after = self._after_dict.get(ti, transparent).rgba
-        self._targ_dict[ti] = _Tile.new_from_diff(data_before, data_after)
+        This only waits for the tiles matching the predicate.
+
+        """
+        processed = [ti for ti in self._jobs if pred(ti)]
+        for ti in processed:
+            self._targ_dict[ti] = self._jobs.pop(ti).result()
 
 
 class _TileTranslateTask:
@@ -491,6 +693,45 @@ class _Tile:
 ## Helper funcs
 
 
+def _diff_tiles(before, after):
+    """Diffs two surface tiles, returning a new strokemap _Tile
+
+    This is called by worker threads.
+
+    """
+    return _Tile.new_from_diff(before.rgba, after.rgba)
+
+
+def _note_shape_change():
+    """Records that a shape's tiles were moved or removed"""
+    global _shape_changes
+    _shape_changes += 1
+
+
+def _get_cached_bitmap(tile):
+    """Returns a tile's bitmap, decompressing it only if needed
+
+    :param _Tile tile: A strokemap tile
+    :returns: The tile's array of ones and zeros. Do not modify it.
+    :rtype: numpy.ndarray
+
+    Recently used bitmaps are kept in a small cache. Strokemap tiles
+    are never changed once made, so the cache only has to keep the tile
+    alive to be sure that its key stays meaningful. For use by the main
+    thread only.
+
+    """
+    key = id(tile)
+    cached = _bitmap_cache.pop(key, None)
+    if cached is None:
+        cached = (tile, tile.to_array())
+        while len(_bitmap_cache) >= BITMAP_CACHE_SIZE:
+            _bitmap_cache.popitem(last=False)
+    _bitmap_cache[key] = cached
+    return cached[1]
+
+
+
 class _TileIndexPredicate (object):
     """Tile index tester callable for processing subsets of tiles.
 
@@ -14,6 +14,7 @@ from __future__ import division, print_function
 
 import abc
 import contextlib
+import io
 import sys
 import os
 import logging
@@ -272,48 +273,9 @@ def save_as_png(surface, filename, *rect, **kwargs):
     something went wrong.
 
     """
-    # Horrible, dirty argument handling
-    alpha = kwargs.pop('alpha', False)
-    feedback_cb = kwargs.pop('feedback_cb', None)
-    single_tile_pattern = kwargs.pop("single_tile_pattern", False)
-    save_srgb_chunks = kwargs.pop("save_srgb_chunks", True)
-
-    # Sizes. Save at least one tile to allow empty docs to be written
-    if not rect:
-        rect = surface.get_bbox()
-    x, y, w, h = rect
-    if w == 0 or h == 0:
-        x, y, w, h = (0, 0, 1, 1)
-        rect = (x, y, w, h)
-
     try:
-        logger.debug(
-            "Writing %r (%dx%d) alpha=%r srgb=%r",
-            filename,
-            w, h,
-            alpha,
-            save_srgb_chunks,
-        )
         with open(filename, "wb") as writer_fp:
-            pngsave = mypaintlib.ProgressivePNGWriter(
-                writer_fp,
-                w, h,
-                alpha,
-                save_srgb_chunks,
-            )
-            feedback_counter = 0
-            scanline_strips = scanline_strips_iter(
-                surface, rect,
-                alpha=alpha,
-                single_tile_pattern=single_tile_pattern,
-                **kwargs
-            )
-            for scanline_strip in scanline_strips:
-                pngsave.write(scanline_strip)
-                if feedback_cb and feedback_counter % TILES_PER_CALLBACK == 0:
-                    feedback_cb()
-                feedback_counter += 1
-            pngsave.close()
+            write_png(surface, writer_fp, *rect, **kwargs)
         logger.debug("Finished writing %r", filename)
     except (IOError, OSError, RuntimeError) as err:
         logger.exception(
@@ -334,3 +296,93 @@ def save_as_png(surface, filename, *rect, **kwargs):
         # Other possible exceptions include TypeError, ValueError, but
         # those indicate incorrect coding usually; just raise them
         # normally.
+
+
+def encode_png(surface, *rect, **kwargs):
+    """Encodes a tile-blittable surface as PNG data in memory
+
+    :param TileBlittable surface: Surface to encode
+    :param tuple \*rect: Rectangle (x, y, w, h) to encode
+    :param \*\*kwargs: As for `save_as_png()`
+    :returns: the content of a PNG file
+    :rtype: bytes
+
+    Most of the work is done without holding the GIL, so several
+    surfaces can be encoded at once by different threads.
+
+    Raises `lib.errors.FileHandlingError` with a descriptive string if
+    something went wrong.
+
+    """
+    buf = io.BytesIO()
+    try:
+        write_png(surface, buf, *rect, **kwargs)
+    except (IOError, OSError, RuntimeError) as err:
+        logger.exception(
+            "Caught %r from C++ png-writer code, re-raising as a "
+            "FileHandlingError",
+            err,
+        )
+        raise FileHandlingError(C_(
+            "low-level PNG writer failure report (dialog)",
+            u"Failed to encode PNG data.\n\n"
+            u"Reason: {err}"
+        ).format(
+            err = err,
+        ))
+    return buf.getvalue()
+
+
+def write_png(surface, fp, *rect, **kwargs):
+    """Writes a tile-blittable surface to a file object in PNG format
+
+    :param TileBlittable surface: Surface to write
+    :param fp: A builtin file, or any object with a write() method
+    :param tuple \*rect: Rectangle (x, y, w, h) to write
+    :param \*\*kwargs: As for `save_as_png()`
+
+    This is the common implementation of `save_as_png()` and
+    `encode_png()`. Errors from the low-level PNG writer are not
+    translated.
+
+    """
+    # Horrible, dirty argument handling
+    alpha = kwargs.pop('alpha', False)
+    feedback_cb = kwargs.pop('feedback_cb', None)
+    single_tile_pattern = kwargs.pop("single_tile_pattern", False)
+    save_srgb_chunks = kwargs.pop("save_srgb_chunks", True)
+
+    # Sizes. Save at least one tile to allow empty docs to be written
+    if not rect:
+        rect = surface.get_bbox()
+    x, y, w, h = rect
+    if w == 0 or h == 0:
+        x, y, w, h = (0, 0, 1, 1)
+        rect = (x, y, w, h)
+
+    logger.debug(
+        "Writing %r (%dx%d) alpha=%r srgb=%r",
+        getattr(fp, "name", fp),
+        w, h,
+        alpha,
+        save_srgb_chunks,
+    )
+    pngsave = mypaintlib.ProgressivePNGWriter(
+        fp,
+        w, h,
+        alpha,
+        save_srgb_chunks,
+    )
+    feedback_counter = 0
+    scanline_strips = scanline_strips_iter(
+        surface, rect,
+        alpha=alpha,
+        single_tile_pattern=single_tile_pattern,
+        **kwargs
+    )
+    for scanline_strip in scanline_strips:
+        pngsave.write(scanline_strip)
+        if feedback_cb and feedback_counter % TILES_PER_CALLBACK == 0:
+            feedback_cb()
+        feedback_counter += 1
+    pngsave.close()
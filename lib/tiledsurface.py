@@ -16,6 +16,14 @@ import sys
 import os
 import contextlib
 import logging
+import zlib
+import struct
+import threading
+import weakref
+import itertools
+import copy
+from collections import OrderedDict
+from collections import namedtuple
 
 from gettext import gettext as _
 import numpy as np
@@ -36,6 +44,18 @@ logger = logging.getLogger(__name__)
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 MAX_MIPMAP_LEVEL = mypaintlib.MAX_MIPMAP_LEVEL
 
+#: Size of an uncompressed tile's pixel data, in bytes.
+TILE_BYTES = N * N * 4 * np.dtype('uint16').itemsize
+
+#: Default memory budget for uncompressed read-only tiles, in bytes.
+DEFAULT_TILE_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# Fast zlib compression suits mostly flat or mostly empty tiles.
+_TILE_COMPRESSION_LEVEL = 1
+
+# Source of content generation numbers, unique across all surfaces.
+_content_generations = itertools.count(1)
+
 
 ## Tile class and marker tile constants
 
@@ -47,19 +67,604 @@ class _Tile (object):
     (requiring 16 bits). This is to allow many calcuations to divide by
     2**15 instead of (2**16-1).
 
+    Read-only tiles can be compressed in memory by the tile store when
+    they haven't been used for a while. Accessing the `rgba` array of a
+    compressed tile decompresses it transparently.
+
     """
 
     def __init__(self, copy_from=None):
         super(_Tile, self).__init__()
+        self._zdata = None  # compressed pixels (read-only tiles only)
+        self._stored = False  # managed by tile_store
+        self._spill = None  # TileSpillFile with a copy of _zdata
+        self._used = 0  # access stamp for the tile store's LRU order
         if copy_from is None:
-            self.rgba = np.zeros((N, N, 4), 'uint16')
+            self._rgba = np.zeros((N, N, 4), 'uint16')
         else:
-            self.rgba = copy_from.rgba.copy()
+            self._rgba = copy_from.rgba.copy()
         self.readonly = False
 
+    @property
+    def rgba(self):
+        """The tile's pixel data, as an NxNx4 uint16 array"""
+        rgba = self._rgba
+        if rgba is None:
+            rgba = tile_store.decompress(self)
+        elif self._stored:
+            self._used = next(_tile_access_clock)
+            next(_tile_hits)
+        return rgba
+
+    @rgba.setter
+    def rgba(self, rgba):
+        assert not self._stored, "Stored tiles are immutable"
+        self._rgba = rgba
+        self._zdata = None
+
+    @property
+    def compressed(self):
+        """True if the tile's pixels are only held in compressed form"""
+        return self._rgba is None and self._zdata is not None
+
     def copy(self):
         return _Tile(copy_from=self)
 
+    #: The tile's colour if every pixel is the same, or None.
+    #: Only shared uniform tiles set this (see `uniform_tile()`).
+    uniform_color = None
+
+
+class _UniformTile (_Tile):
+    """Read-only tile with every pixel set to the same colour
+
+    Uniform tiles are shared between all the surfaces and snapshots
+    which need them, so large flat areas of paint, flood fills, and
+    solid backgrounds cost nothing per tile. Like any other read-only
+    tile, a uniform tile is copied into a normal private tile before
+    it's written to.
+
+    Get instances via `uniform_tile()`.
+
+    """
+
+    def __init__(self, color):
+        super(_UniformTile, self).__init__()
+        self.uniform_color = color
+        self._rgba[...] = color
+        self.readonly = True
+        self._rgba8 = {}  # {dst_has_alpha: converted 8-bit tile}
+
+    def get_rgba8(self, dst_has_alpha):
+        """Returns the tile converted to 8 bits per channel (cached)
+
+        :param bool dst_has_alpha: Convert to RGBA rather than RGBU
+        :rtype: numpy.ndarray
+
+        Dithering depends only on the pixel position within a tile,
+        so the converted pixels are the same wherever the uniform tile
+        is used.
+
+        """
+        rgba8 = self._rgba8.get(dst_has_alpha)
+        if rgba8 is None:
+            rgba8 = np.empty((N, N, 4), 'uint8')
+            if dst_has_alpha:
+                mypaintlib.tile_convert_rgba16_to_rgba8(self._rgba, rgba8)
+            else:
+                mypaintlib.tile_convert_rgbu16_to_rgbu8(self._rgba, rgba8)
+            self._rgba8[dst_has_alpha] = rgba8
+        return rgba8
+
+
+#: Access stamps for stored tiles. Taking one doesn't need any lock,
+#: so reading tile pixels stays cheap in the compositing loops.
+_tile_access_clock = itertools.count(1)
+
+#: Reads of stored tiles which didn't need decompressing. Like the
+#: access stamps, counting these is lock-free.
+_tile_hits = itertools.count()
+
+_uniform_tiles = weakref.WeakValueDictionary()
+_uniform_tiles_lock = threading.Lock()
+
+
+def uniform_tile(color):
+    """Returns the shared read-only tile for a premultiplied colour
+
+    :param tuple color: premultiplied 15-bit RGBA
+    :rtype: _Tile
+
+    >>> white = uniform_tile((1<<15, 1<<15, 1<<15, 1<<15))
+    >>> white is uniform_tile([1<<15] * 4)
+    True
+    >>> white.readonly, white.uniform_color == (1<<15,) * 4
+    (True, True)
+    >>> bool((white.rgba == (1<<15)).all())
+    True
+
+    Fully transparent colours map to the special transparent tile.
+
+    >>> uniform_tile((0, 0, 0, 0)) is transparent_tile
+    True
+
+    """
+    color = tuple(int(c) for c in color)
+    if color[3] == 0:
+        return transparent_tile
+    with _uniform_tiles_lock:
+        tile = _uniform_tiles.get(color)
+        if tile is None:
+            tile = _UniformTile(color)
+            _uniform_tiles[color] = tile
+        return tile
+
+
+def get_uniform_color(rgba):
+    """Returns the colour of a tile array if all its pixels match
+
+    :param numpy.ndarray rgba: NxNx4 tile array
+    :returns: the colour, as a tuple of ints, or None
+    :rtype: tuple
+
+    >>> rgba = np.zeros((N, N, 4), 'uint16')
+    >>> rgba[...] = (1, 2, 3, 4)
+    >>> get_uniform_color(rgba)
+    (1, 2, 3, 4)
+    >>> rgba[N-1, N-1, 0] = 0
+    >>> get_uniform_color(rgba) is None
+    True
+
+    """
+    first = rgba[0, 0]
+    # Cheap early rejection for the common case of non-uniform tiles
+    if (rgba[-1, -1] != first).any() or (rgba[0, -1] != first).any():
+        return None
+    if (rgba != first).any():
+        return None
+    return tuple(int(c) for c in first)
+
+
+def get_tiles_memory_usage(tiledicts, exclude=()):
+    """Returns the memory used by the tiles in some tiledicts
+
+    :param iterable tiledicts: tiledicts (``{(tx, ty): tile}``) to count
+    :param iterable exclude: tiledicts whose tiles are not counted
+    :returns: pixel memory used, in bytes
+    :rtype: int
+
+    Each distinct tile is counted once, by the size of the data it
+    currently holds. Shared uniform tiles and the marker tiles are
+    free.
+
+    >>> t1, t2 = _Tile(), _Tile()
+    >>> d1 = {(0, 0): t1, (1, 0): t2}
+    >>> get_tiles_memory_usage([d1, {(0, 0): t1}]) == 2 * TILE_BYTES
+    True
+    >>> get_tiles_memory_usage([d1], [{(9, 9): t2}]) == TILE_BYTES
+    True
+    >>> get_tiles_memory_usage([{(0, 0): transparent_tile}])
+    0
+
+    """
+    excluded = set()
+    for tiledict in exclude:
+        excluded.update(id(t) for t in tiledict.itervalues())
+    seen = set()
+    total = 0
+    for tiledict in tiledicts:
+        for t in tiledict.itervalues():
+            key = id(t)
+            if key in excluded or key in seen:
+                continue
+            seen.add(key)
+            if t.uniform_color is not None:
+                continue
+            if t is transparent_tile or t is mipmap_dirty_tile:
+                continue
+            if t._rgba is not None:
+                total += t._rgba.nbytes
+            if t._zdata is not None:
+                total += len(t._zdata)
+    return total
+
+
+TileStoreStats = namedtuple(
+    "TileStoreStats",
+    ["uncompressed", "compressed", "compressed_bytes", "budget",
+     "hits", "misses"],
+)
+
+
+class _TileStore (object):
+    """Keeps recently used read-only tiles uncompressed, within a budget
+
+    Tiles which are shared between a surface and its snapshots are
+    read-only: modifying one requires a copy to be made first. This
+    makes them safe to compress in memory, and because the same `_Tile`
+    object is referenced by each snapshot's tiledict, the undo history
+    automatically shares the compressed form too.
+
+    Read-only tiles are registered with the store via `add()`. When
+    `maintain()` is called, the least recently used ones are compressed
+    until the pixel memory they use fits within the budget. Recency is
+    an unlocked access stamp taken by `_Tile.rgba`, so reads don't
+    contend for the store's lock. Compressed data is retained after
+    decompression since the tile can't change, so subsequent evictions
+    just drop the uncompressed array.
+
+    Compression never happens during an atomic painting operation,
+    because the C++ backend holds raw pointers into tile memory until
+    the end of one. See `MyPaintSurface.begin_atomic()`.
+
+        >>> store = _TileStore(budget=TILE_BYTES)
+        >>> t1, t2 = _Tile(), _Tile()
+        >>> t1.rgba[...] = 1 << 15
+        >>> for t in (t1, t2):
+        ...     t.readonly = True
+        ...     store.add(t)
+        >>> hits = store.stats.hits
+        >>> t2.rgba is t2._rgba  # more recently used
+        True
+        >>> store.stats.hits - hits
+        1
+        >>> store.maintain()
+        >>> t1.compressed, t2.compressed
+        (True, False)
+        >>> (store.decompress(t1) == (1 << 15)).all()
+        True
+        >>> store.stats.misses
+        1
+
+    Hits are counted for all stores together, since tiles don't know
+    which store they were added to.
+
+    """
+
+    def __init__(self, budget=DEFAULT_TILE_MEMORY_BUDGET):
+        super(_TileStore, self).__init__()
+        self._budget = int(budget)
+        self._lock = threading.RLock()
+        self._refs = {}  # {id(tile): weakref}, all stored tiles
+        self._uncompressed = set()  # {id(tile)}
+        self._atomic_depth = 0
+        self._misses = 0
+
+    @property
+    def budget(self):
+        """Memory budget for uncompressed stored tiles, in bytes"""
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        self._budget = max(0, int(budget))
+        self.maintain()
+
+    @property
+    def stats(self):
+        """Usage statistics, as a TileStoreStats tuple"""
+        with self._lock:
+            compressed = 0
+            compressed_bytes = 0
+            for ref in self._refs.itervalues():
+                tile = ref()
+                if tile is None or tile._rgba is not None:
+                    continue
+                if tile._zdata is not None:
+                    compressed += 1
+                    compressed_bytes += len(tile._zdata)
+            return TileStoreStats(
+                len(self._uncompressed),
+                compressed,
+                compressed_bytes,
+                self._budget,
+                next(copy.copy(_tile_hits)),  # peek, don't count
+                self._misses,
+            )
+
+    def add(self, tile):
+        """Starts managing a read-only tile
+
+        Shared uniform tiles are tiny when compressed, but they are
+        never compressed because they're used too often.
+
+        """
+        assert tile.readonly
+        if tile.uniform_color is not None:
+            return
+        key = id(tile)
+        with self._lock:
+            if tile._stored:
+                return
+            tile._stored = True
+            self._refs[key] = weakref.ref(tile, self._forget_cb(key))
+            if tile._rgba is not None:
+                tile._used = next(_tile_access_clock)
+                self._uncompressed.add(key)
+
+    def _forget_cb(self, key):
+        """Returns a weakref callback forgetting a freed tile"""
+        def _forget(ref):
+            with self._lock:
+                self._refs.pop(key, None)
+                self._uncompressed.discard(key)
+        return _forget
+
+    def decompress(self, tile):
+        """Decompresses a stored tile's pixel data, returning it
+
+        :raises AttributeError: if the tile has no data at all
+
+        Tiles spilled to a `TileSpillFile` are read back in first.
+
+        """
+        with self._lock:
+            rgba = tile._rgba
+            if rgba is not None:
+                return rgba
+            if tile._zdata is None:
+                if tile._spill is None:
+                    raise AttributeError("Tile has no pixel data")
+                tile._zdata = tile._spill.read(tile)
+            buf = bytearray(zlib.decompress(tile._zdata))
+            rgba = np.frombuffer(buf, dtype='uint16').reshape((N, N, 4))
+            tile._rgba = rgba
+            tile._used = next(_tile_access_clock)
+            if tile._stored:
+                self._uncompressed.add(id(tile))
+            self._misses += 1
+            return rgba
+
+    def begin_atomic(self):
+        """Suspends compression during a painting operation"""
+        with self._lock:
+            self._atomic_depth += 1
+
+    def end_atomic(self):
+        """Resumes compression after a painting operation"""
+        with self._lock:
+            self._atomic_depth = max(0, self._atomic_depth - 1)
+
+    def maintain(self):
+        """Compresses the least recently used tiles to fit the budget
+
+        Once over budget, tiles are compressed until there's some room
+        to spare, so that finding the least recently used ones doesn't
+        have to be repeated after every painting operation.
+
+        """
+        with self._lock:
+            if self._atomic_depth > 0:
+                return
+            max_tiles = self._budget // TILE_BYTES
+            if len(self._uncompressed) <= max_tiles:
+                return
+            tiles = []
+            for key in list(self._uncompressed):
+                ref = self._refs.get(key)
+                tile = ref and ref()
+                if tile is None or tile._rgba is None:
+                    self._uncompressed.discard(key)
+                else:
+                    tiles.append(tile)
+            keep = max_tiles - max_tiles // 8
+            if len(tiles) <= max_tiles:
+                return
+            tiles.sort(key=lambda t: t._used)
+            for tile in tiles[:len(tiles) - keep]:
+                if tile._zdata is None:
+                    tile._zdata = zlib.compress(
+                        tile._rgba.tostring(),
+                        _TILE_COMPRESSION_LEVEL,
+                    )
+                tile._rgba = None
+                self._uncompressed.discard(id(tile))
+
+
+#: The global store for read-only tiles.
+tile_store = _TileStore()
+
+
+class TileSpillFile (object):
+    """Append-only file of compressed read-only tiles
+
+    Spilling a tile writes its compressed pixels to the file, then
+    frees all the memory the tile used for them. The pixels are read
+    back in transparently when the tile's `rgba` is next accessed.
+    This is used for the undo history's older snapshots (see
+    `lib.command.CommandStack`).
+
+    Space used by freed tiles is reclaimed by rewriting the file when
+    most of it is dead. Spilled tiles which are still alive when the
+    file is closed are read back into memory first.
+
+        >>> import tempfile, shutil
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> spill = TileSpillFile(os.path.join(tmpdir, "spill.bin"))
+        >>> t1 = _Tile()
+        >>> t1.rgba[...] = 42
+        >>> t1.readonly = True
+        >>> tile_store.add(t1)
+        >>> spill.spill_tiles([{(0, 0): t1}]) >= TILE_BYTES
+        True
+        >>> t1._rgba is None, t1._zdata is None
+        (True, True)
+        >>> bool((t1.rgba == 42).all())
+        True
+        >>> spill.close()
+        >>> os.path.exists(spill.path)
+        False
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+    #: Minimum file size in bytes before dead space is reclaimed.
+    COMPACT_MIN_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        """Initialize, without creating the file yet
+
+        :param unicode path: Where to write the file
+
+        """
+        super(TileSpillFile, self).__init__()
+        self._path = path
+        self._fp = None
+        self._size = 0
+        self._live_bytes = 0
+        self._entries = {}  # {id(tile): (offset, length, weakref)}
+
+    @property
+    def path(self):
+        """Location of the file"""
+        return self._path
+
+    @property
+    def size(self):
+        """Size of the file, in bytes"""
+        return self._size
+
+    @property
+    def live_bytes(self):
+        """Bytes in the file belonging to tiles which are still alive"""
+        return self._live_bytes
+
+    def spill_tiles(self, tiledicts, exclude=()):
+        """Spills the stored tiles in some tiledicts
+
+        :param iterable tiledicts: tiledicts whose tiles may be spilled
+        :param set exclude: ids of tiles which must stay in memory
+        :returns: how much memory was freed, in bytes
+        :rtype: int
+
+        Only read-only tiles managed by `tile_store` are spilled.
+        Nothing happens during an atomic painting operation, and None
+        is returned.
+
+        """
+        freed = 0
+        with tile_store._lock:
+            if tile_store._atomic_depth > 0:
+                return None
+            seen = set()
+            for tiledict in tiledicts:
+                for tile in tiledict.itervalues():
+                    key = id(tile)
+                    if key in exclude or key in seen:
+                        continue
+                    seen.add(key)
+                    freed += self._spill(tile)
+            self._maybe_compact()
+        return freed
+
+    def _spill(self, tile):
+        """Spills one tile (lock held), returning the bytes freed"""
+        if not tile._stored:
+            return 0
+        if tile._spill is not None and tile._spill is not self:
+            return 0
+        freed = 0
+        if tile._rgba is not None:
+            freed += tile._rgba.nbytes
+        if tile._zdata is not None:
+            freed += len(tile._zdata)
+        if freed == 0:
+            return 0
+        key = id(tile)
+        if key not in self._entries:
+            zdata = tile._zdata
+            if zdata is None:
+                zdata = zlib.compress(
+                    tile._rgba.tostring(),
+                    _TILE_COMPRESSION_LEVEL,
+                )
+            offset = self._write(zdata)
+            ref = weakref.ref(tile, self._forget_cb(key))
+            self._entries[key] = (offset, len(zdata), ref)
+            self._live_bytes += len(zdata)
+            tile._spill = self
+        tile._rgba = None
+        tile._zdata = None
+        tile_store._uncompressed.discard(key)
+        return freed
+
+    def _write(self, data):
+        """Appends data to the file (lock held), returning its offset"""
+        if self._fp is None:
+            self._fp = open(self._path, "w+b")
+        offset = self._size
+        self._fp.seek(offset)
+        self._fp.write(data)
+        self._size += len(data)
+        return offset
+
+    def _forget_cb(self, key):
+        """Returns a weakref callback forgetting a freed tile's entry"""
+        def _forget(ref):
+            with tile_store._lock:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._live_bytes -= entry[1]
+        return _forget
+
+    def read(self, tile):
+        """Reads back a spilled tile's compressed pixels
+
+        :returns: zlib-compressed pixel data
+        :rtype: str
+
+        """
+        with tile_store._lock:
+            offset, length, ref = self._entries[id(tile)]
+            self._fp.seek(offset)
+            return self._fp.read(length)
+
+    def _maybe_compact(self):
+        """Rewrites the file if most of it is dead space (lock held)"""
+        if self._size < self.COMPACT_MIN_SIZE:
+            return
+        if self._live_bytes * 2 > self._size:
+            return
+        logger.debug(
+            "Compacting %r: %d of %d bytes live",
+            self._path, self._live_bytes, self._size,
+        )
+        tmp_path = self._path + u".tmp"
+        entries = {}
+        size = 0
+        with open(tmp_path, "wb") as tmp_fp:
+            for key, (offset, length, ref) in self._entries.iteritems():
+                self._fp.seek(offset)
+                tmp_fp.write(self._fp.read(length))
+                entries[key] = (size, length, ref)
+                size += length
+        self._fp.close()
+        lib.fileutils.replace(tmp_path, self._path)
+        self._fp = open(self._path, "r+b")
+        self._entries = entries
+        self._size = size
+
+    def close(self):
+        """Reads back any live spilled tiles, and deletes the file"""
+        with tile_store._lock:
+            for key, (offset, length, ref) in self._entries.items():
+                tile = ref()
+                if tile is None or tile._spill is not self:
+                    continue
+                if tile._rgba is None and tile._zdata is None:
+                    tile._zdata = self.read(tile)
+                tile._spill = None
+            self._entries.clear()
+            self._live_bytes = 0
+            self._size = 0
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+                try:
+                    os.remove(self._path)
+                except OSError:
+                    logger.exception("Failed to remove %r", self._path)
+
 
 # tile for read-only operations on empty spots
 transparent_tile = _Tile()
@@ -67,13 +672,286 @@ transparent_tile.readonly = True
 
 # tile with invalid pixel memory (needs refresh)
 mipmap_dirty_tile = _Tile()
-del mipmap_dirty_tile.rgba
+mipmap_dirty_tile._rgba = None
 
 
 ## Class defs: surfaces
 
+class _TileDict (dict):
+    """A surface's tiledict, tracking its extents and replaced tiles
+
+    The extents of the tile positions are maintained as tiles are added
+    and removed. Removing a tile from the edge just marks them for
+    recalculation, which is done when they're next asked for. Any change
+    also changes the number returned by `get_extents_serial()`.
+
+    >>> d = _TileDict({(0, 0): "a"})
+    >>> d[(1, 1)] = "x"
+    >>> d.get_extents()
+    (0, 0, 1, 1)
+    >>> serial = get_extents_serial()
+    >>> d[(1, 0)] = "y"
+    >>> d.get_extents(), get_extents_serial() == serial
+    ((0, 0, 1, 1), True)
+    >>> del d[(1, 1)]
+    >>> d.get_extents(), get_extents_serial() == serial
+    ((0, 0, 1, 0), False)
+
+    While a log dict is attached, the first change to each position
+    records the tile which was there before (or None if there wasn't
+    one). Surfaces keep one log per snapshot generation, so older
+    states can be looked up without ever copying the tiledict.
+
+    >>> d = _TileDict({(0, 0): "a"})
+    >>> d[(1, 1)] = "x"
+    >>> d._log = {}
+    >>> d[(0, 0)] = "b"
+    >>> d[(1, 0)] = "c"
+    >>> d.pop((0, 0))
+    'b'
+    >>> sorted(d._log.items())
+    [((0, 0), 'a'), ((1, 0), None)]
+    >>> d.clear()
+    >>> sorted(d._log.items())
+    [((0, 0), 'a'), ((1, 0), None), ((1, 1), 'x')]
+    >>> d.get_extents()
+    ()
+
+    """
+
+    __slots__ = ["_log", "_extents"]
+
+    #: Incremented whenever the extents of any instance change
+    extents_serial = 0
+
+    def __init__(self, *args, **kwargs):
+        super(_TileDict, self).__init__(*args, **kwargs)
+        self._log = None
+        self._extents = None  # [tx0, ty0, tx1, ty1], [], or None: unknown
+
+    def get_extents(self):
+        """Returns the extents of the tile positions
+
+        :returns: (tx0, ty0, tx1, ty1) inclusive, or () if empty
+        :rtype: tuple
+
+        """
+        extents = self._extents
+        if extents is None:
+            if self:
+                xs, ys = zip(*self.iterkeys())
+                extents = [min(xs), min(ys), max(xs), max(ys)]
+            else:
+                extents = []
+            self._extents = extents
+        return tuple(extents)
+
+    def _extents_changed(self):
+        _TileDict.extents_serial += 1
+
+    def _note_added(self, pos):
+        extents = self._extents
+        if extents is None:
+            return
+        tx, ty = pos
+        if not extents:
+            self._extents = [tx, ty, tx, ty]
+        elif (extents[0] <= tx <= extents[2] and
+              extents[1] <= ty <= extents[3]):
+            return
+        else:
+            extents[0] = min(extents[0], tx)
+            extents[1] = min(extents[1], ty)
+            extents[2] = max(extents[2], tx)
+            extents[3] = max(extents[3], ty)
+        self._extents_changed()
+
+    def _note_removed(self, pos):
+        extents = self._extents
+        if not extents:
+            return
+        tx, ty = pos
+        if tx in (extents[0], extents[2]) or ty in (extents[1], extents[3]):
+            self._extents = None
+            self._extents_changed()
+
+    def _note_change(self, pos):
+        log = self._log
+        if log is not None and pos not in log:
+            log[pos] = dict.get(self, pos)
+
+    def __setitem__(self, pos, tile):
+        self._note_change(pos)
+        if pos not in self:
+            self._note_added(pos)
+        dict.__setitem__(self, pos, tile)
+
+    def __delitem__(self, pos):
+        self._note_change(pos)
+        dict.__delitem__(self, pos)
+        self._note_removed(pos)
+
+    def pop(self, pos, *default):
+        if pos not in self:
+            return dict.pop(self, pos, *default)
+        self._note_change(pos)
+        tile = dict.pop(self, pos)
+        self._note_removed(pos)
+        return tile
+
+    def popitem(self):
+        pos, tile = dict.popitem(self)
+        log = self._log
+        if log is not None and pos not in log:
+            log[pos] = tile
+        self._note_removed(pos)
+        return pos, tile
+
+    def setdefault(self, pos, tile=None):
+        if pos not in self:
+            self[pos] = tile
+        return dict.__getitem__(self, pos)
+
+    def update(self, *args, **kwargs):
+        for pos, tile in dict(*args, **kwargs).iteritems():
+            self[pos] = tile
+
+    def clear(self):
+        if not self:
+            return
+        log = self._log
+        if log is not None:
+            for pos, tile in self.iteritems():
+                log.setdefault(pos, tile)
+        dict.clear(self)
+        self._extents = []
+        self._extents_changed()
+
+
+def get_extents_serial():
+    """Returns a number which changes when any tiledict's extents change
+
+    :rtype: int
+
+    Callers caching bounding boxes calculated from surfaces can compare
+    it with the value from when they calculated them, to tell if they
+    need to be calculated again. See `MyPaintSurface.get_bbox()`.
+
+    """
+    return _TileDict.extents_serial
+
+
 class _SurfaceSnapshot (object):
-    pass
+    """Constant-time snapshot of a surface's tiles
+
+    Snapshots don't copy anything. They record the generation number
+    which their surface moved on to when they were taken. The surface
+    logs the tiles it replaces after that, one log per generation, and
+    the snapshot reconstructs its `tiledict` from the live tiledict and
+    the logs when it's first needed. `get()` and
+    `get_changed_positions()` work from the logs directly.
+
+    >>> s = MyPaintSurface()
+    >>> with s.tile_request(0, 0, readonly=False) as rgba:
+    ...     rgba[...] = 1
+    >>> s1 = s.save_snapshot()
+    >>> with s.tile_request(1, 0, readonly=False) as rgba:
+    ...     rgba[...] = 1
+    >>> with s.tile_request(0, 0, readonly=False) as rgba:
+    ...     rgba[...] = 2
+    >>> s2 = s.save_snapshot()
+    >>> sorted(s1.get_changed_positions(s2))
+    [(0, 0), (1, 0)]
+    >>> s1.get((1, 0)) is None, int(s1.get((0, 0)).rgba[0, 0, 0])
+    (True, 1)
+    >>> sorted(s1.tiledict.keys()), sorted(s2.tiledict.keys())
+    ([(0, 0)], [(0, 0), (1, 0)])
+    >>> s.load_snapshot(s1)
+    >>> int(s.tiledict[(0, 0)].rgba[0, 0, 0]), len(s.tiledict)
+    (1, 1)
+
+    """
+
+    def __init__(self, surface, generation):
+        super(_SurfaceSnapshot, self).__init__()
+        self._surface = surface
+        self._generation = generation
+        self._tiledict = None
+
+    @property
+    def generation(self):
+        """The surface generation which the snapshot begins"""
+        return self._generation
+
+    @property
+    def tiledict(self):
+        """The snapshot's tiles, as a dict (reconstructed on first use)"""
+        if self._tiledict is None:
+            surface = self._surface
+            self._tiledict = surface._get_snapshot_tiledict(self._generation)
+            self._surface = None
+            surface._release_snapshot_logs(self)
+        return self._tiledict
+
+    def get(self, pos, default=None):
+        """Returns the tile at a position, like dict.get()"""
+        if self._tiledict is not None:
+            return self._tiledict.get(pos, default)
+        tile = self._surface._get_snapshot_tile(self._generation, pos)
+        if tile is None:
+            return default
+        return tile
+
+    def get_changed_positions(self, other):
+        """Returns the positions whose tiles differ in another state
+
+        :param other: Another snapshot, or a surface's current state
+        :type other: _SurfaceSnapshot or MyPaintSurface
+        :rtype: set
+
+        For another snapshot of the same surface, or for the surface
+        itself, only the positions logged in between are examined.
+
+        >>> s = MyPaintSurface()
+        >>> s1 = s.save_snapshot()
+        >>> with s.tile_request(2, 0, readonly=False) as rgba:
+        ...     rgba[...] = 1
+        >>> sorted(s1.get_changed_positions(s))
+        [(2, 0)]
+
+        """
+        surface = self._surface
+        if surface is not None and other is surface:
+            gens = (self._generation, surface._generation + 1)
+            get_other = surface.tiledict.get
+        elif (surface is not None and isinstance(other, _SurfaceSnapshot)
+              and other._surface is surface):
+            gens = sorted([self._generation, other._generation])
+            get_other = other.get
+        else:
+            tiles = set(self.tiledict.iteritems())
+            other_tiles = set(other.tiledict.iteritems())
+            changed = tiles.symmetric_difference(other_tiles)
+            return set(pos for pos, tile in changed)
+        return set(
+            pos for pos in surface._get_logged_positions(*gens)
+            if self.get(pos) is not get_other(pos)
+        )
+
+    def get_changed_tiles(self, other):
+        """Returns the snapshot's tiles which another state doesn't share
+
+        :param other: As for `get_changed_positions()`
+        :returns: A tiledict, ``{(tx, ty): tile}``
+        :rtype: dict
+
+        """
+        changed = {}
+        for pos in self.get_changed_positions(other):
+            tile = self.get(pos)
+            if tile is not None:
+                changed[pos] = tile
+        return changed
 
 
 # TODO:
@@ -90,8 +968,17 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
-        self.tiledict = {}
+        self.tiledict = _TileDict()
         self.observers = []
+        self._content_generation = next(_content_generations)
+
+        # Snapshot generations: {generation: {(tx, ty): replaced_tile}}
+        self._generation = 0
+        self._generation_logs = OrderedDict()
+        self._live_snapshots = weakref.WeakValueDictionary()
+
+        # Level 1 positions of dirty mipmap tiles, for update_mipmaps()
+        self._mipmap_dirty_tiles = set()
 
         # Used to implement repeating surfaces, like Background
         if looped_size[0] % N or looped_size[1] % N:
@@ -109,7 +996,6 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         # Forwarding API
         self.set_symmetry_state = self._backend.set_symmetry_state
-        self.begin_atomic = self._backend.begin_atomic
 
         self.get_color = self._backend.get_color
         self.get_alpha = self._backend.get_alpha
@@ -139,8 +1025,14 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                 s.mipmap = None
         return mipmaps
 
+    def begin_atomic(self):
+        tile_store.begin_atomic()
+        self._backend.begin_atomic()
+
     def end_atomic(self):
         bbox = self._backend.end_atomic()
+        tile_store.end_atomic()
+        tile_store.maintain()
         if (bbox[2] > 0 and bbox[3] > 0):
             self.notify_observers(*bbox)
 
@@ -148,13 +1040,33 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
     def backend(self):
         return self._backend
 
+    @property
+    def content_generation(self):
+        """Number identifying the current state of the surface's content
+
+        >>> s = MyPaintSurface()
+        >>> g0 = s.content_generation
+        >>> with s.tile_request(0, 0, readonly=False) as rgba:
+        ...     rgba[...] = 1
+        >>> s.notify_observers(0, 0, N, N)
+        >>> s.content_generation == g0
+        False
+
+        The number changes whenever the observers are notified of a
+        change. Numbers are never reused, even by other surfaces, so
+        if it's the same as it was earlier, nothing has changed since.
+
+        """
+        return self._content_generation
+
     def notify_observers(self, *args):
+        self._content_generation = next(_content_generations)
         for f in self.observers:
             f(*args)
 
     def clear(self):
         tiles = self.tiledict.keys()
-        self.tiledict = {}
+        self.tiledict.clear()
         self.notify_observers(*lib.surface.get_tiles_bbox(tiles))
         if self.mipmap:
             self.mipmap.clear()
@@ -247,24 +1159,46 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         self._set_tile_numpy(tx, ty, numpy_tile, readonly)
 
     def _regenerate_mipmap(self, t, tx, ty):
-        t = _Tile()
-        self.tiledict[(tx, ty)] = t
-        empty = True
-
+        # This updates the tiledict, so it mustn't run in several threads
+        # at once: RootLayerStack.render_into() regenerates the tiles it
+        # needs before rendering in parallel.
+        srcs = []
         for x in xrange(2):
             for y in xrange(2):
                 src = self.parent.tiledict.get((tx*2 + x, ty*2 + y), transparent_tile)
                 if src is mipmap_dirty_tile:
                     src = self.parent._regenerate_mipmap(src, tx*2 + x, ty*2 + y)
-                mypaintlib.tile_downscale_rgba16(src.rgba, t.rgba,
-                                                 x * N // 2,
-                                                 y * N // 2)
-                if src.rgba is not transparent_tile.rgba:
-                    empty = False
+                srcs.append(src)
+
+        # Flat areas downscale to flat areas: the result has the same
+        # value as tile_downscale_rgba16() would compute, but no work.
+        color = srcs[0].uniform_color
+        if color is not None and all(s is srcs[0] for s in srcs):
+            t = uniform_tile([(c // 4) * 4 for c in color])
+            if t is transparent_tile:
+                self.tiledict.pop((tx, ty), None)
+            else:
+                self.tiledict[(tx, ty)] = t
+            return t
+
+        t = _Tile()
+        empty = True
+        for i, src in enumerate(srcs):
+            x, y = divmod(i, 2)
+            mypaintlib.tile_downscale_rgba16(src.rgba, t.rgba,
+                                             x * N // 2,
+                                             y * N // 2)
+            if src is not transparent_tile:
+                empty = False
         if empty:
             # rare case, no need to speed it up
-            del self.tiledict[(tx, ty)]
+            self.tiledict.pop((tx, ty), None)
             t = transparent_tile
+        else:
+            # Mipmap tiles are only ever replaced, never written to
+            t.readonly = True
+            tile_store.add(t)
+            self.tiledict[(tx, ty)] = t
         return t
 
     def _get_tile_numpy(self, tx, ty, readonly):
@@ -272,7 +1206,10 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         #           yes it is
         # Note: we must return memory that stays valid for writing until the
         # last end_atomic(), because of the caching in tiledsurface.hpp.
+        return self._get_tile(tx, ty, readonly).rgba
 
+    def _get_tile(self, tx, ty, readonly):
+        """Get the _Tile object for a tile_request()"""
         if self.looped:
             tx = tx % (self.looped_size[0] // N)
             ty = ty % (self.looped_size[1] // N)
@@ -293,7 +1230,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         if not readonly:
             # assert self.mipmap_level == 0
             self._mark_mipmap_dirty(tx, ty)
-        return t.rgba
+        return t
 
     def _set_tile_numpy(self, tx, ty, obj, readonly):
         pass  # Data can be modified directly, no action needed
@@ -310,6 +1247,91 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                                    None) == mipmap_dirty_tile:
                 break
             mipmap.tiledict[(tx // fac, ty // fac)] = mipmap_dirty_tile
+            if level == 1:
+                self._mipmap_dirty_tiles.add((tx // 2, ty // 2))
+
+    def has_dirty_mipmaps(self):
+        """True if update_mipmaps() has work to do"""
+        return bool(self._mipmap_dirty_tiles)
+
+    def update_mipmaps(self, max_tiles=32, priority_bboxes=(),
+                       priority_only=False):
+        """Regenerates a batch of dirty mipmap tiles
+
+        :param int max_tiles: Maximum number of level 1 tiles to build
+        :param iterable priority_bboxes: Model areas to do first
+        :param bool priority_only: Only do tiles in priority_bboxes
+        :returns: the number of level 1 tiles in the batch
+        :rtype: int
+
+        Mipmaps are otherwise regenerated when they're first rendered,
+        and one tile at a time. This builds a batch of dirty tiles at
+        level 1 from the surface's tiles, then every dirty level above
+        them which can be built from the new tiles, in the same pass.
+        Parents with other dirty children are left for a later batch,
+        so the work done in each call stays bounded.
+
+        >>> s = MyPaintSurface()
+        >>> for tx in xrange(4):
+        ...     with s.tile_request(tx, 0, readonly=False) as rgba:
+        ...         rgba[...] = 1<<15
+        >>> s.has_dirty_mipmaps()
+        True
+        >>> s.update_mipmaps(max_tiles=1, priority_bboxes=[(2*N, 0, 1, 1)])
+        1
+        >>> s._mipmaps[1].tiledict[(1, 0)] is mipmap_dirty_tile
+        False
+        >>> s._mipmaps[2].tiledict[(0, 0)] is mipmap_dirty_tile
+        True
+        >>> s.update_mipmaps(priority_bboxes=[(2*N, 0, 1, 1)],
+        ...                  priority_only=True)
+        0
+        >>> s.update_mipmaps(), s.has_dirty_mipmaps()
+        (1, False)
+        >>> any(t is mipmap_dirty_tile for m in s._mipmaps
+        ...     for t in m.tiledict.itervalues())
+        False
+
+        """
+        dirty = self._mipmap_dirty_tiles
+        batch = []
+        for x, y, w, h in priority_bboxes:
+            if len(batch) >= max_tiles or not dirty:
+                break
+            fac = 2 * N
+            tx0, ty0 = x // fac, y // fac
+            tx1, ty1 = (x + w - 1) // fac, (y + h - 1) // fac
+            for pos in list(dirty):
+                if len(batch) >= max_tiles:
+                    break
+                if tx0 <= pos[0] <= tx1 and ty0 <= pos[1] <= ty1:
+                    dirty.remove(pos)
+                    batch.append(pos)
+        while dirty and len(batch) < max_tiles and not priority_only:
+            batch.append(dirty.pop())
+
+        positions = batch
+        for level in xrange(1, len(self._mipmaps)):
+            mipmap = self._mipmaps[level]
+            parents = set()
+            for tx, ty in positions:
+                if mipmap.tiledict.get((tx, ty)) is mipmap_dirty_tile:
+                    if mipmap._has_dirty_sources(tx, ty):
+                        continue
+                    mipmap._regenerate_mipmap(mipmap_dirty_tile, tx, ty)
+                parents.add((tx // 2, ty // 2))
+            positions = parents
+        return len(batch)
+
+    def _has_dirty_sources(self, tx, ty):
+        """True if a mipmap tile can't be built from clean tiles yet"""
+        if self.mipmap_level <= 1:
+            return False
+        get = self.parent.tiledict.get
+        return any(
+            get((tx*2 + x, ty*2 + y)) is mipmap_dirty_tile
+            for x in xrange(2) for y in xrange(2)
+        )
 
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
                        *args, **kwargs):
@@ -333,6 +1355,16 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             raise ValueError('Unsupported destination buffer type %r', dst.dtype)
         dst_is_uint16 = (dst.dtype == 'uint16')
 
+        src_tile = self._get_tile(tx, ty, readonly=True)
+        if src_tile.uniform_color is not None:
+            # Shared constant-colour tile: a plain fill, or a copy of
+            # its cached 8-bit conversion.
+            if dst_is_uint16:
+                dst[...] = src_tile.uniform_color
+            else:
+                dst[...] = src_tile.get_rgba8(dst_has_alpha)
+            return
+
         with self.tile_request(tx, ty, readonly=True) as src:
             if src is transparent_tile.rgba:
                 #dst[:] = 0 # <-- notably slower than memset()
@@ -380,6 +1412,16 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                                        mipmap_level, opacity, mode)
             return
 
+        # Opaque constant-colour tiles composited normally at full
+        # opacity replace the backdrop entirely, so just fill it.
+        src_tile = self._get_tile(tx, ty, readonly=True)
+        color = src_tile.uniform_color
+        if color is not None:
+            if (color[3] == 1<<15 and opacity == 1.0
+                    and mode == mypaintlib.CombineNormal):
+                dst[...] = color
+                return
+
         # Tile request at the required level.
         # Try optimizations again if we got the special marker tile
         with self.tile_request(tx, ty, readonly=True) as src:
@@ -397,17 +1439,76 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
     def save_snapshot(self):
         """Creates and returns a snapshot of the surface
 
-        Snapshotting marks all the tiles of the surface as read-only,
-        then just shallow-copes the tiledict. It's quick. See
-        tile_request() for how new read/write tiles can be unlocked.
+        Snapshotting doesn't copy the tiledict. The surface just starts
+        a new generation, with a new log for the tiles it replaces from
+        then on (see _SurfaceSnapshot). The tiles written since the
+        previous snapshot are marked read-only, so that tile_request()
+        gives out private copies of them for writing. That's proportional
+        to the amount of painting done since, not to the surface's size.
 
         """
-        sshot = _SurfaceSnapshot()
-        for t in self.tiledict.itervalues():
-            t.readonly = True
-        sshot.tiledict = self.tiledict.copy()
+        tiledict = self.tiledict
+        if tiledict._log is None:
+            written = tiledict.values()
+        else:
+            written = [tiledict.get(pos) for pos in tiledict._log]
+        for t in written:
+            if t is not None and not t.readonly:
+                t.readonly = True
+                tile_store.add(t)
+        self._generation += 1
+        sshot = _SurfaceSnapshot(self, self._generation)
+        self._live_snapshots[self._generation] = sshot
+        tiledict._log = {}
+        self._generation_logs[self._generation] = tiledict._log
+        self._trim_generation_logs()
+        tile_store.maintain()
         return sshot
 
+    def _trim_generation_logs(self):
+        """Drops the logs which no unreconstructed snapshot needs"""
+        logs = self._generation_logs
+        oldest = min(self._live_snapshots.keys() or [self._generation])
+        while logs:
+            gen = next(iter(logs))
+            if gen >= oldest:
+                break
+            del logs[gen]
+
+    def _release_snapshot_logs(self, sshot):
+        """Called by a snapshot which no longer needs the logs"""
+        self._live_snapshots.pop(sshot.generation, None)
+        self._trim_generation_logs()
+
+    def _get_snapshot_tile(self, generation, pos):
+        """The tile at a position when a generation began, or None"""
+        for gen, log in self._generation_logs.iteritems():
+            if gen >= generation and pos in log:
+                return log[pos]
+        return self.tiledict.get(pos)
+
+    def _get_snapshot_tiledict(self, generation):
+        """The tiledict as it was when a generation began"""
+        tiledict = dict(self.tiledict)
+        # Older logs hold older tiles, so they're applied last.
+        for gen in reversed(self._generation_logs.keys()):
+            if gen < generation:
+                break
+            for pos, tile in self._generation_logs[gen].iteritems():
+                if tile is None:
+                    tiledict.pop(pos, None)
+                else:
+                    tiledict[pos] = tile
+        return tiledict
+
+    def _get_logged_positions(self, first, last):
+        """Positions changed from generation `first` until `last` began"""
+        positions = set()
+        for gen, log in self._generation_logs.iteritems():
+            if first <= gen < last:
+                positions.update(log)
+        return positions
+
     def load_snapshot(self, sshot):
         """Loads a saved snapshot, replacing the internal tiledict"""
         self._load_tiledict(sshot.tiledict)
@@ -418,9 +1519,14 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             # common case optimization, called via stroke.redo()
             # testcase: comparison above (if equal) takes 0.6ms, code below 30ms
             return
-        old = set(self.tiledict.iteritems())
-        self.tiledict = d.copy()
-        new = set(self.tiledict.iteritems())
+        tiledict = self.tiledict
+        old = set(tiledict.iteritems())
+        new = set(d.iteritems())
+        # Update in place, so the changes are logged for snapshots
+        for pos, tile in old - new:
+            tiledict.pop(pos, None)
+        for pos, tile in new - old:
+            tiledict[pos] = tile
         dirty = old.symmetric_difference(new)
         for pos, tile in dirty:
             self._mark_mipmap_dirty(*pos)
@@ -436,11 +1542,12 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict.clear()
 
         for tx, ty in s.get_tiles():
             with self.tile_request(tx, ty, readonly=False) as dst:
                 s.blit_tile_into(dst, True, tx, ty)
+        self.share_uniform_tiles()
 
         dirty_tiles.update(self.tiledict.keys())
         bbox = lib.surface.get_tiles_bbox(dirty_tiles)
@@ -483,9 +1590,58 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         Raises a `lib.errors.FileHandlingError` with a descriptive
         string when conversion or PNG reading fails.
 
+        """
+        if sys.platform == 'win32':
+            filename_sys = filename.encode("utf-8")
+        else:
+            filename_sys = filename.encode(sys.getfilesystemencoding())  # FIXME: should not do that, should use open(unicode_object)
+        return self._load_png_progressive(
+            lambda get_buffer: mypaintlib.load_png_fast_progressive(
+                filename_sys,
+                get_buffer,
+                convert_to_srgb,
+            ),
+            x, y,
+            feedback_cb,
+        )
+
+    def load_from_png_stream(self, fp, x, y, feedback_cb=None,
+                             convert_to_srgb=True,
+                             **kwargs):
+        """Load from a PNG file-like object, one tilerow at a time.
+
+        :param fp: Readable file-like object, e.g. an open zipfile member
+        :param int x: X-coordinate at which to load the replacement data
+        :param int y: Y-coordinate at which to load the replacement data
+        :param bool convert_to_srgb: If True, convert to sRGB
+        :param callable feedback_cb: Called every few tile rows
+        :param dict \*\*kwargs: Ignored
+
+        This works like `load_from_png()`: only a strip of one tile row
+        is held in memory at a time besides the tiles themselves, and
+        empty tiles are discarded. The file is not closed afterwards.
+
+        """
+        return self._load_png_progressive(
+            lambda get_buffer: mypaintlib.load_png_fast_progressive_from_file(
+                fp,
+                get_buffer,
+                convert_to_srgb,
+            ),
+            x, y,
+            feedback_cb,
+        )
+
+    def _load_png_progressive(self, load_func, x, y, feedback_cb):
+        """Internal: load PNG data strip by strip, discarding empty tiles
+
+        :param callable load_func: Calls the mypaintlib loader function
+          with the get_buffer callback passed to it, and returns flags.
+        :returns: the bbox of the loaded image
+
         """
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict.clear()
 
         state = {}
         state['buf'] = None   # array of height N, width depends on image
@@ -511,40 +1667,40 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
             png_x0 = x
             png_x1 = x+png_w
-            subbuf = state['buf'][:, png_x0-buf_x0:png_x1-buf_x0]
-            if 1:  # optimize: only needed for first and last
+            png_y0 = max(buf_y0, y)
+            png_y1 = min(buf_y0+buf_h, y+png_h)
+            assert png_y1 > png_y0
+            # Only strips which aren't completely covered by PNG data
+            # need clearing: the first, the last, and any unaligned ones.
+            covered = (png_x0 == buf_x0 and png_x1 == buf_x1 and
+                       png_y0 == buf_y0 and png_y1 == buf_y1)
+            if not covered:
                 state['buf'].fill(0)
-                png_y0 = max(buf_y0, y)
-                png_y1 = min(buf_y0+buf_h, y+png_h)
-                assert png_y1 > png_y0
-                subbuf = subbuf[png_y0-buf_y0:png_y1-buf_y0, :]
+            subbuf = state['buf'][:, png_x0-buf_x0:png_x1-buf_x0]
+            subbuf = subbuf[png_y0-buf_y0:png_y1-buf_y0, :]
 
             state['ty'] += 1
             return subbuf
 
         def consume_buf():
             ty = state['ty']-1
-            for i in xrange(state['buf'].shape[1] // N):
-                tx = x // N + i
-                src = state['buf'][:, i*N:(i+1)*N, :]
-                if src[:, :, 3].any():
-                    with self.tile_request(tx, ty, readonly=False) as dst:
-                        mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
+            buf = state['buf']
+            # Find the non-empty tiles in one pass over the alpha channel
+            alpha = buf[:, :, 3].reshape(N, buf.shape[1] // N, N)
+            nonempty = alpha.any(axis=2).any(axis=0)
+            for i in np.flatnonzero(nonempty):
+                tx = x // N + int(i)
+                src = buf[:, i*N:(i+1)*N, :]
+                with self.tile_request(tx, ty, readonly=False) as dst:
+                    mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
 
-        if sys.platform == 'win32':
-            filename_sys = filename.encode("utf-8")
-        else:
-            filename_sys = filename.encode(sys.getfilesystemencoding())  # FIXME: should not do that, should use open(unicode_object)
         try:
-            flags = mypaintlib.load_png_fast_progressive(
-                filename_sys,
-                get_buffer,
-                convert_to_srgb,
-            )
+            flags = load_func(get_buffer)
         except (IOError, OSError, RuntimeError) as ex:
             raise FileHandlingError(_("PNG reader failed: %s") % str(ex))
         consume_buf()  # also process the final chunk of data
         logger.debug("PNG loader flags: %r", flags)
+        self.share_uniform_tiles()
 
         dirty_tiles.update(self.tiledict.keys())
         bbox = lib.surface.get_tiles_bbox(dirty_tiles)
@@ -553,6 +1709,62 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         # return the bbox of the loaded image
         return state['frame_size']
 
+    def load_tile_log(self, filename, x, y):
+        """Replaces tiles with the ones recorded in a tile log
+
+        :param unicode filename: The log file (see `TileLog`)
+        :param int x: X coordinate of where the log's PNG was loaded
+        :param int y: Y coordinate of where the log's PNG was loaded
+
+        Tiles are loaded in their compressed form if they line up with
+        the surface's own tiles, and decompressed as they are used.
+
+        """
+        records = _read_tile_log(filename)
+        updated = set()
+        if x % N == 0 and y % N == 0:
+            dtx = x // N
+            dty = y // N
+            for (tx, ty), zdata in records.iteritems():
+                pos = (tx + dtx, ty + dty)
+                if zdata is None:
+                    self.tiledict.pop(pos, None)
+                else:
+                    tile = _Tile()
+                    tile._rgba = None
+                    tile._zdata = zdata
+                    tile.readonly = True
+                    tile_store.add(tile)
+                    self.tiledict[pos] = tile
+                self._mark_mipmap_dirty(*pos)
+                updated.add(pos)
+        else:
+            slices_x = calc_translation_slices(x)
+            slices_y = calc_translation_slices(y)
+            for (tx, ty), zdata in records.iteritems():
+                src = None
+                if zdata is not None:
+                    buf = bytearray(zlib.decompress(zdata))
+                    src = np.frombuffer(buf, dtype='uint16')
+                    src = src.reshape((N, N, 4))
+                for (sx0, sx1), (tdx, dx0, dx1) in slices_x:
+                    for (sy0, sy1), (tdy, dy0, dy1) in slices_y:
+                        pos = (tx + tdx, ty + tdy)
+                        with self.tile_request(*pos, readonly=False) as dst:
+                            if src is None:
+                                dst[dy0:dy1, dx0:dx1] = 0
+                            else:
+                                dst[dy0:dy1, dx0:dx1] = \
+                                    src[sy0:sy1, sx0:sx1]
+                        updated.add(pos)
+            for pos in updated:
+                tile = self.tiledict.get(pos)
+                if tile is not None and not tile.rgba.any():
+                    self.tiledict.pop(pos)
+        bbox = lib.surface.get_tiles_bbox(updated)
+        if not bbox.empty():
+            self.notify_observers(*bbox)
+
     def render_as_pixbuf(self, *args, **kwargs):
         if not self.tiledict:
             logger.warning('empty surface')
@@ -570,8 +1782,39 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             kwargs['single_tile_pattern'] = True
         lib.surface.save_as_png(self, filename, *args, **kwargs)
 
+    def encode_png(self, *args, **kwargs):
+        """Returns PNG data for a rectangle (see lib.surface.encode_png)"""
+        if 'alpha' not in kwargs:
+            kwargs['alpha'] = True
+
+        if len(self.tiledict) == 1 and self.looped:
+            kwargs['single_tile_pattern'] = True
+        return lib.surface.encode_png(self, *args, **kwargs)
+
     def get_bbox(self):
-        return lib.surface.get_tiles_bbox(self.tiledict)
+        """Returns the tile-aligned bounding box of the surface
+
+        This is maintained as tiles are added and removed, so it's
+        cheap to call repeatedly.
+
+        >>> s = MyPaintSurface()
+        >>> s.get_bbox().empty()
+        True
+        >>> for tx, ty in [(1, 2), (3, -1)]:
+        ...     with s.tile_request(tx, ty, readonly=False) as rgba:
+        ...         pass
+        >>> s.get_bbox() == helpers.Rect(N, -N, 3*N, 4*N)
+        True
+
+        """
+        extents = self.tiledict.get_extents()
+        if not extents:
+            return helpers.Rect()
+        tx0, ty0, tx1, ty1 = extents
+        return helpers.Rect(
+            N*tx0, N*ty0,
+            N*(tx1 - tx0 + 1), N*(ty1 - ty0 + 1),
+        )
 
     def get_tiles(self):
         return self.tiledict
@@ -585,6 +1828,50 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             if not data.rgba.any():
                 self.tiledict.pop(pos)
 
+    def share_uniform_tiles(self, tiles=None):
+        """Replaces constant-colour tiles with shared uniform ones
+
+        :param iterable tiles: tile positions to check (default: all)
+
+        Tiles whose pixels are all the same are swapped for the shared
+        read-only tile for that colour, and fully transparent ones are
+        dropped. This doesn't change what the surface looks like, so
+        no observers are notified. It must not be called during an
+        atomic painting operation.
+
+        >>> surf = MyPaintSurface()
+        >>> for tx in xrange(3):
+        ...     with surf.tile_request(tx, 0, readonly=False) as t:
+        ...         t[...] = (0, 1<<14, 0, 1<<15)
+        >>> with surf.tile_request(3, 0, readonly=False) as t:
+        ...     pass
+        >>> with surf.tile_request(4, 0, readonly=False) as t:
+        ...     t[0, 0, 3] = 1
+        >>> surf.share_uniform_tiles()
+        >>> tiles = [surf.tiledict.get((tx, 0)) for tx in xrange(5)]
+        >>> tiles[0] is tiles[1] is tiles[2], tiles[0].readonly
+        (True, True)
+        >>> tiles[3] is None, tiles[4].uniform_color is None
+        (True, True)
+
+        """
+        if tiles is None:
+            tiles = list(self.tiledict.keys())
+        for pos in tiles:
+            t = self.tiledict.get(pos)
+            if t is None or t is mipmap_dirty_tile:
+                continue
+            if t.uniform_color is not None:
+                continue
+            color = get_uniform_color(t.rgba)
+            if color is None:
+                continue
+            t = uniform_tile(color)
+            if t is transparent_tile:
+                self.tiledict.pop(pos)
+            else:
+                self.tiledict[pos] = t
+
     def get_move(self, x, y, sort=True):
         """Returns a move object for this surface
 
@@ -598,7 +1885,8 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         """
         return _TiledSurfaceMove(self, x, y, sort=sort)
 
-    def flood_fill(self, x, y, color, bbox, tolerance, dst_surface):
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_surface,
+                   progress_cb=None):
         """Fills connected areas of this surface into another
 
         :param x: Starting point X coordinate
@@ -611,10 +1899,13 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         :type tolerance: float [0.0, 1.0]
         :param dst: Target surface
         :type dst: lib.tiledsurface.MyPaintSurface
+        :param callable progress_cb: Progress/cancellation callback
+        :returns: False if the fill was cancelled, True otherwise
 
         See also `lib.layer.Layer.flood_fill()` and `fill.flood_fill()`.
         """
-        flood_fill(self, x, y, color, bbox, tolerance, dst_surface)
+        return flood_fill(self, x, y, color, bbox, tolerance, dst_surface,
+                          progress_cb=progress_cb)
 
 
 class _TiledSurfaceMove (object):
@@ -712,11 +2003,14 @@ class _TiledSurfaceMove (object):
         # High water mark of chunks processed so far.
         # This is reset on every call to update().
         self.chunks_i = 0
+        # Whether the whole move was finished by process_all()
+        self._bulk_processed = False
         # Tile state tracking for individual update cycles
         self.written = set()
-        self.blank_queue = []
+        self.blank_queue = []  # popped from the end
         # Tile offsets which we'll be applying,
         # initially the move is zero.
+        self.offset = (0, 0)
         self.slices_x = calc_translation_slices(0)
         self.slices_y = calc_translation_slices(0)
 
@@ -728,18 +2022,22 @@ class _TiledSurfaceMove (object):
 
         This causes all the move's work to be re-queued.
         """
-        # Nothing has been written in this pass yet
-        self.written = set()
-        # Tile indices to be cleared during processing,
-        # unless they've been written to
-        self.blank_queue = self.surface.tiledict.keys()  # fresh!
+        # Tile indices to be cleared during processing, unless they've
+        # been written to. Source tiles are removed when they're moved,
+        # so only tiles written by earlier passes can be left over.
+        blanks = set(self.blank_queue)
+        blanks.update(self.written)
+        self.blank_queue = list(blanks)
         if self.sort:
             x, y = self.start_pos
             tx = (x + dx) // N
             ty = (y + dy) // N
             manhattan_dist = lambda p: abs(tx - p[0]) + abs(ty - p[1])
-            self.blank_queue.sort(key=manhattan_dist)
+            self.blank_queue.sort(key=manhattan_dist, reverse=True)
+        # Nothing has been written in this pass yet
+        self.written = set()
         # Calculate offsets
+        self.offset = (int(dx), int(dy))
         self.slices_x = calc_translation_slices(int(dx))
         self.slices_y = calc_translation_slices(int(dy))
         # Need to process every source chunk
@@ -763,8 +2061,10 @@ class _TiledSurfaceMove (object):
             self.process(n=-1)
         assert self.chunks_i >= len(self.chunks)
         assert len(self.blank_queue) == 0
-        # Remove empty tiles created by Layer Move
-        self.surface.remove_empty_tiles()
+        # Remove empty tiles created by Layer Move.
+        # Bulk translations never make any.
+        if not self._bulk_processed:
+            self.surface.remove_empty_tiles()
 
     def process(self, n=200):
         """Process a number of pending tile moves
@@ -774,8 +2074,12 @@ class _TiledSurfaceMove (object):
         :rtype: bool
 
         Specify zero or negative `n` to process all remaining tiles.
+        This is done in bulk by `process_all()`, which is much faster.
 
         """
+        if n <= 0:
+            self.process_all()
+            return False
         updated = set()
         moves_remaining = self._process_moves(n, updated)
         blanks_remaining = self._process_blanks(n, updated)
@@ -785,6 +2089,23 @@ class _TiledSurfaceMove (object):
         self.surface.notify_observers(*bbox)
         return blanks_remaining or moves_remaining
 
+    def process_all(self):
+        """Finishes the move in bulk
+
+        The whole translated tile set is calculated at once from the
+        snapshot taken at the start of the move, using
+        `translate_tiledict()`. Any work done by `process()` since the
+        last update is discarded.
+
+        """
+        dx, dy = self.offset
+        tiledict = translate_tiledict(self.snapshot.tiledict, dx, dy)
+        self.surface._load_tiledict(tiledict)
+        self.chunks_i = len(self.chunks)
+        self.blank_queue = []
+        self.written = set(tiledict)
+        self._bulk_processed = True
+
     def _process_moves(self, n, updated):
         """Internal: process pending tile moves
 
@@ -811,7 +2132,11 @@ class _TiledSurfaceMove (object):
                     targ_t = targ_tx, targ_ty
                     if is_integral:
                         # We're lucky. Perform a straight data copy.
-                        self.surface.tiledict[targ_t] = src_tile.copy()
+                        # Shared uniform tiles can just be reused.
+                        targ_tile = src_tile
+                        if targ_tile.uniform_color is None:
+                            targ_tile = targ_tile.copy()
+                        self.surface.tiledict[targ_t] = targ_tile
                         updated.add(targ_t)
                         self.written.add(targ_t)
                         continue
@@ -853,7 +2178,7 @@ class _TiledSurfaceMove (object):
         if n <= 0:
             n = len(self.blank_queue)
         while len(self.blank_queue) > 0 and n > 0:
-            t = self.blank_queue.pop(0)
+            t = self.blank_queue.pop()
             if t not in self.written:
                 self.surface.tiledict.pop(t, None)
                 updated.add(t)
@@ -907,6 +2232,101 @@ def calc_translation_slices(dc):
         ]
 
 
+def translate_tiledict(tiledict, dx, dy, batch_size=256):
+    """Returns a translated copy of a tiledict
+
+    :param dict tiledict: Source tiles, which must not change {(tx,ty): _Tile}
+    :param int dx: Horizontal offset, in pixels
+    :param int dy: Vertical offset, in pixels
+    :param int batch_size: How many output tiles to slice at once
+    :returns: A new tiledict, without any fully transparent tiles
+    :rtype: dict
+
+    All the output tile positions are worked out first. Whole-tile
+    offsets just reuse the source tiles under their new positions.
+    Otherwise, each output tile is built from up to four source
+    slices, with the slicing done by numpy for a batch of output tiles
+    at a time. Output tiles made entirely from one uniform tile reuse
+    that tile.
+
+    >>> src = {(0, 0): uniform_tile((1, 2, 3, 1<<15))}
+    >>> sorted(translate_tiledict(src, -N, 2*N).keys())
+    [(-1, 2)]
+    >>> dst = translate_tiledict(src, N//2, 0)
+    >>> sorted(dst.keys())
+    [(0, 0), (1, 0)]
+    >>> int(dst[0, 0].rgba[0, N//2 - 1, 3]), int(dst[0, 0].rgba[0, N//2, 3])
+    (0, 32768)
+
+    Source tiles should be read-only, as they are in snapshots, since
+    they may be shared with the output.
+
+    """
+    dx = int(dx)
+    dy = int(dy)
+    slices_x = calc_translation_slices(dx)
+    slices_y = calc_translation_slices(dy)
+    if len(slices_x) == 1 and len(slices_y) == 1:
+        tdx = slices_x[0][1][0]
+        tdy = slices_y[0][1][0]
+        return dict(
+            ((tx + tdx, ty + tdy), tile)
+            for (tx, ty), tile in tiledict.iteritems()
+        )
+    # Each output tile is made from the source slices in each quadrant.
+    quadrants = []
+    for (src_x0, src_x1), (tdx, targ_x0, targ_x1) in slices_x:
+        for (src_y0, src_y1), (tdy, targ_y0, targ_y1) in slices_y:
+            quadrants.append((
+                (tdx, tdy),
+                (slice(src_y0, src_y1), slice(src_x0, src_x1)),
+                (slice(targ_y0, targ_y1), slice(targ_x0, targ_x1)),
+            ))
+    targ_positions = set()
+    for tdx, tdy in (q[0] for q in quadrants):
+        targ_positions.update(
+            (tx + tdx, ty + tdy)
+            for (tx, ty) in tiledict
+        )
+    result = {}
+    pending = []
+    for (tx, ty) in targ_positions:
+        srcs = [
+            tiledict.get((tx - tdx, ty - tdy))
+            for (tdx, tdy), src_sl, targ_sl in quadrants
+        ]
+        first = srcs[0]
+        if first is not None and first.uniform_color is not None:
+            if all(t is first for t in srcs):
+                result[(tx, ty)] = first
+                continue
+        pending.append(((tx, ty), srcs))
+    # Slice everything else in batches
+    for i in xrange(0, len(pending), batch_size):
+        batch = pending[i:i+batch_size]
+        out = np.zeros((len(batch), N, N, 4), 'uint16')
+        for qi, (tdxy, src_sl, targ_sl) in enumerate(quadrants):
+            rows = []
+            arrays = []
+            for row, (targ_pos, srcs) in enumerate(batch):
+                src_tile = srcs[qi]
+                if src_tile is not None:
+                    rows.append(row)
+                    arrays.append(src_tile.rgba[src_sl])
+            if not rows:
+                continue
+            targ_y_sl, targ_x_sl = targ_sl
+            out[rows, targ_y_sl, targ_x_sl] = np.array(arrays)
+        nonempty = out.reshape((len(batch), -1)).any(axis=1)
+        for row, (targ_pos, srcs) in enumerate(batch):
+            if not nonempty[row]:
+                continue
+            tile = _Tile()
+            tile.rgba = out[row].copy()
+            result[targ_pos] = tile
+    return result
+
+
 # Set which surface backend to use
 Surface = MyPaintSurface
 
@@ -987,12 +2407,13 @@ class Background (Surface):
                 for tx in range(w // N):
                     with self.tile_request(tx, ty, readonly=False) as dst:
                         dst[:, :, :] = arr[ty*N:(ty+1)*N, tx*N:(tx+1)*N, :]
+            self.share_uniform_tiles()
             return (x, y, w, h)
         else:
             return super(Background, self).load_from_numpy(arr, x, y)
 
 
-def flood_fill(src, x, y, color, bbox, tolerance, dst):
+def flood_fill(src, x, y, color, bbox, tolerance, dst, progress_cb=None):
     """Fills connected areas of one surface into another
 
     :param src: Source surface-like object
@@ -1007,6 +2428,15 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
     :type tolerance: float [0.0, 1.0]
     :param dst: Target surface
     :type dst: lib.tiledsurface.MyPaintSurface
+    :param callable progress_cb: Progress/cancellation callback
+    :returns: False if the fill was cancelled, True otherwise
+    :rtype: bool
+
+    The traversal of the tiles is done by mypaintlib. If `progress_cb`
+    is given, it is called every so often during the fill as
+    ``progress_cb(tiles_done, tiles_queued)``. If it returns false, the
+    fill is abandoned, and the target surface is left unchanged. The
+    callback can be used to keep a user interface responsive.
 
     See also `lib.layer.Layer.flood_fill()`.
     """
@@ -1016,26 +2446,15 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
     # Limits
     tolerance = helpers.clamp(tolerance, 0.0, 1.0)
 
-    # Maximum area to fill: tile and in-tile pixel extents
-    bbx, bby, bbw, bbh = bbox
+    # Maximum area to fill
+    bbx, bby, bbw, bbh = [int(c) for c in bbox]
     if bbh <= 0 or bbw <= 0:
-        return
-    bbbrx = bbx + bbw - 1
-    bbbry = bby + bbh - 1
-    min_tx = int(bbx // N)
-    min_ty = int(bby // N)
-    max_tx = int(bbbrx // N)
-    max_ty = int(bbbry // N)
-    min_px = int(bbx % N)
-    min_py = int(bby % N)
-    max_px = int(bbbrx % N)
-    max_py = int(bbbry % N)
-
-    # Tile and pixel addressing for the seed point
+        return True
+
+    # Sample the pixel color at the seed point to obtain the target color
+    x, y = int(x), int(y)
     tx, ty = int(x // N), int(y // N)
     px, py = int(x % N), int(y % N)
-
-    # Sample the pixel color there to obtain the target color
     with src.tile_request(tx, ty, readonly=True) as start:
         targ_r, targ_g, targ_b, targ_a = [int(c) for c in start[py][px]]
     if targ_a == 0:
@@ -1044,60 +2463,25 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
         targ_b = 0
         targ_a = 0
 
-    # Flood-fill loop
-    filled = {}
-    tileq = [
-        ((tx, ty),
-         [(px, py)])
-    ]
-    while len(tileq) > 0:
-        (tx, ty), seeds = tileq.pop(0)
-        # Bbox-derived limits
-        if tx > max_tx or ty > max_ty:
-            continue
-        if tx < min_tx or ty < min_ty:
-            continue
-        # Pixel limits within this tile...
-        min_x = 0
-        min_y = 0
-        max_x = N-1
-        max_y = N-1
-        # ... vary at the edges
-        if tx == min_tx:
-            min_x = min_px
-        if ty == min_ty:
-            min_y = min_py
-        if tx == max_tx:
-            max_x = max_px
-        if ty == max_ty:
-            max_y = max_py
-        # Flood-fill one tile
+    # Flood-fill across all the tiles it needs
+    def _get_src_tile(tx, ty):
         with src.tile_request(tx, ty, readonly=True) as src_tile:
-            dst_tile = filled.get((tx, ty), None)
-            if dst_tile is None:
-                dst_tile = np.zeros((N, N, 4), 'uint16')
-                filled[(tx, ty)] = dst_tile
-            overflows = mypaintlib.tile_flood_fill(
-                src_tile, dst_tile, seeds,
-                targ_r, targ_g, targ_b, targ_a,
-                fill_r, fill_g, fill_b,
-                min_x, min_y, max_x, max_y,
-                tolerance
-            )
-            seeds_n, seeds_e, seeds_s, seeds_w = overflows
-        # Enqueue overflows in each cardinal direction
-        if seeds_n and ty > min_ty:
-            tpos = (tx, ty-1)
-            tileq.append((tpos, seeds_n))
-        if seeds_w and tx > min_tx:
-            tpos = (tx-1, ty)
-            tileq.append((tpos, seeds_w))
-        if seeds_s and ty < max_ty:
-            tpos = (tx, ty+1)
-            tileq.append((tpos, seeds_s))
-        if seeds_e and tx < max_tx:
-            tpos = (tx+1, ty)
-            tileq.append((tpos, seeds_e))
+            return src_tile
+
+    filled = mypaintlib.flood_fill_tiles(
+        _get_src_tile,
+        x, y,
+        targ_r, targ_g, targ_b, targ_a,
+        fill_r, fill_g, fill_b,
+        bbx, bby, bbw, bbh,
+        tolerance,
+        progress_cb,
+    )
+    if filled is None:
+        logger.info("Flood fill cancelled")
+        return False
+    if not filled:
+        return True
 
     # Composite filled tiles into the destination surface
     mode = mypaintlib.CombineNormal
@@ -1105,8 +2489,11 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
         with dst.tile_request(tx, ty, readonly=False) as dst_tile:
             mypaintlib.tile_combine(mode, src_tile, dst_tile, True, 1.0)
         dst._mark_mipmap_dirty(tx, ty)
+    # Fills of large areas mostly produce solid tiles
+    dst.share_uniform_tiles(filled.keys())
     bbox = lib.surface.get_tiles_bbox(filled)
     dst.notify_observers(*bbox)
+    return True
 
 
 class PNGFileUpdateTask (object):
@@ -1182,6 +2569,290 @@ class PNGFileUpdateTask (object):
                 os.unlink(self._tmp_filename)
             raise
 
+## Autosave tile logs
+
+#: Identifies a tile log file, and its format version.
+TILE_LOG_MAGIC = b"MyPaint tile log v1\n"
+
+# Tile log record header: tile X, tile Y, and data length. The data is
+# the tile's zlib-compressed pixels. No data means the tile was removed.
+_TILE_LOG_RECORD = struct.Struct("<iiI")
+
+
+class TileLog (object):
+    """Changes to a surface's tiles since a PNG of it was written
+
+    Autosaving a big layer by rewriting all of its PNG every time is
+    slow. Instead, the PNG is only written now and then, and the tiles
+    which changed since are appended to a log file beside it. The log's
+    tile positions are relative to the PNG's origin, which is always
+    tile-aligned. See `MyPaintSurface.load_tile_log()`.
+
+    The log keeps the snapshot of the surface which it was last brought
+    up to date with. Changes are found from the surface's generation
+    logs, so only the tiles which were replaced since are examined.
+    This keeps the tiles replaced since the last update in memory.
+
+        >>> import tempfile, shutil
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> log = TileLog(
+        ...     os.path.join(tmpdir, "test.tilelog"),
+        ...     os.path.join(tmpdir, "test.png"),
+        ...     (N, N, N, N),
+        ... )
+        >>> log.needs_new_base()
+        True
+        >>> s = MyPaintSurface()
+        >>> with s.tile_request(1, 1, readonly=False) as rgba:
+        ...     rgba[...] = 1 << 15
+        >>> sshot = s.save_snapshot()
+        >>> open(log.base_filename, "wb").close()  # the PNG, really
+        >>> log.set_base(sshot)
+        >>> log.needs_new_base(), log.get_changes(sshot)
+        (False, [])
+
+    Only the changed tiles are written when updating the log.
+
+        >>> with s.tile_request(2, 1, readonly=False) as rgba:
+        ...     rgba[...] = 1 << 14
+        >>> sshot = s.save_snapshot()
+        >>> log.get_changes(sshot)
+        [(2, 1)]
+        >>> task = TileLogUpdateTask(log, sshot, [(2, 1)])
+        >>> while task():
+        ...     pass
+        >>> log.get_changes(sshot)
+        []
+        >>> s2 = MyPaintSurface()
+        >>> s2.load_tile_log(log.filename, N, N)  # where the PNG went
+        >>> s2.tiledict.keys()
+        [(2, 1)]
+        >>> int(s2.tiledict[(2, 1)].rgba[0, 0, 0])
+        16384
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+    #: Minimum log size in bytes before the PNG is worth rewriting.
+    #: Logs bigger than their PNG are always rewritten into a new one.
+    COMPACT_MIN_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, filename, base_filename, base_rect):
+        """Initialize, before the PNG has been written
+
+        :param unicode filename: The log file to append to
+        :param unicode base_filename: The PNG which the log is based on
+        :param tuple base_rect: Where the PNG is, as (x, y, w, h)
+
+        """
+        super(TileLog, self).__init__()
+        self._filename = filename
+        self._base_filename = base_filename
+        self._base_rect = tuple(base_rect)
+        self._sshot = None  # what's been written, once the PNG is done
+        self._size = 0
+
+    @property
+    def filename(self):
+        """The log file"""
+        return self._filename
+
+    @property
+    def base_filename(self):
+        """The PNG file which the log is based on"""
+        return self._base_filename
+
+    @property
+    def base_rect(self):
+        """Position and size of the PNG, as (x, y, w, h)"""
+        return self._base_rect
+
+    @property
+    def size(self):
+        """Size of the log file after its last update, in bytes"""
+        return self._size
+
+    def set_base(self, sshot):
+        """Records the state written to the PNG, once it's been written
+
+        :param _SurfaceSnapshot sshot: Snapshot of what was written
+
+        This can be queued as a task after the PNG writing task.
+
+        """
+        self._sshot = sshot
+        self._size = 0
+
+    def invalidate(self):
+        """Marks the log as unusable, so a new PNG must be written"""
+        self._sshot = None
+
+    def needs_new_base(self):
+        """True if a new PNG and log should be written instead"""
+        if self._sshot is None:
+            return True
+        if not os.path.exists(self._base_filename):
+            return True
+        if self._size > 0 and not os.path.exists(self._filename):
+            return True
+        base_size = os.path.getsize(self._base_filename)
+        return self._size > max(self.COMPACT_MIN_SIZE, base_size)
+
+    def get_changes(self, sshot):
+        """Returns the positions of tiles changed since the last update
+
+        :param _SurfaceSnapshot sshot: A later snapshot of the surface
+        :rtype: list
+
+        """
+        return sorted(self._sshot.get_changed_positions(sshot))
+
+    def _commit(self, sshot, size):
+        """Internal: records that the log is up to date with a snapshot"""
+        self._sshot = sshot
+        self._size = size
+
+
+class TileLogUpdateTask (object):
+    """Piecemeal callable: appends changed tiles to a TileLog's file
+
+    See lib.autosave.Autosaveable.
+    """
+
+    #: How many tiles to write per call.
+    TILES_PER_CALL = 64
+
+    def __init__(self, tilelog, sshot, positions):
+        """Initialize, without writing anything yet
+
+        :param TileLog tilelog: The log to update
+        :param _SurfaceSnapshot sshot: Snapshot with the tiles to write
+        :param list positions: Positions of the tiles to write
+
+        Data written by any earlier update which didn't complete is
+        overwritten. The tiles are looked up when the task is made,
+        so that the rest can be run in a worker thread.
+
+        """
+        super(TileLogUpdateTask, self).__init__()
+        self._tilelog = tilelog
+        self._sshot = sshot
+        self._positions = list(positions)
+        self._tiledict = dict((pos, sshot.get(pos)) for pos in positions)
+        self._i = 0
+        self._fp = None
+        self._size = 0
+        bx, by = tilelog.base_rect[0:2]
+        self._base_tx = bx // N
+        self._base_ty = by // N
+        logger.debug(
+            "autosave: scheduled update of %d tiles in %r",
+            len(self._positions),
+            tilelog.filename,
+        )
+
+    def __call__(self, *args, **kwargs):
+        if self._positions is None:
+            raise RuntimeError("Called too many times")
+        try:
+            if self._fp is None:
+                self._open()
+            i0 = self._i
+            i1 = i0 + self.TILES_PER_CALL
+            for pos in self._positions[i0:i1]:
+                self._write_record(pos)
+            self._i = i1
+            if i1 < len(self._positions):
+                return True
+            self._fp.close()
+            self._tilelog._commit(self._sshot, self._size)
+            logger.debug("autosave: updated %r", self._tilelog.filename)
+            self._positions = None
+            self._tiledict = None
+            self._sshot = None
+            return False
+        except:
+            if self._fp is not None:
+                self._fp.close()
+            self._positions = None
+            self._tiledict = None
+            self._sshot = None
+            self._tilelog.invalidate()
+            raise
+
+    def _open(self):
+        """Internal: opens the log file, ready for appending"""
+        filename = self._tilelog.filename
+        size = self._tilelog.size
+        if size > 0:
+            fp = open(filename, "r+b")
+            fp.seek(size)
+            fp.truncate()
+        else:
+            fp = open(filename, "wb")
+            fp.write(TILE_LOG_MAGIC)
+            size = len(TILE_LOG_MAGIC)
+        self._fp = fp
+        self._size = size
+
+    def _write_record(self, pos):
+        """Internal: appends one tile's record to the log file"""
+        tile = self._tiledict.get(pos)
+        if tile is None:
+            zdata = b""
+        else:
+            zdata = tile._zdata
+            if zdata is None:
+                rgba = tile.rgba  # reads back spilled tiles
+                zdata = tile._zdata
+                if zdata is None:
+                    zdata = zlib.compress(
+                        rgba.tostring(),
+                        _TILE_COMPRESSION_LEVEL,
+                    )
+        tx, ty = pos
+        header = _TILE_LOG_RECORD.pack(
+            tx - self._base_tx,
+            ty - self._base_ty,
+            len(zdata),
+        )
+        self._fp.write(header)
+        self._fp.write(zdata)
+        self._size += len(header) + len(zdata)
+
+
+def _read_tile_log(filename):
+    """Reads a tile log file's records
+
+    :param unicode filename: The file to read
+    :returns: {(tx, ty): zdata}, with None for removed tiles
+    :rtype: dict
+
+    Later records replace earlier ones for the same tile. A truncated
+    record at the end, left by an update which was interrupted, is
+    ignored.
+
+    """
+    records = {}
+    with open(filename, "rb") as fp:
+        magic = fp.read(len(TILE_LOG_MAGIC))
+        if magic != TILE_LOG_MAGIC:
+            raise FileHandlingError(_("Not a tile log: %r") % (filename,))
+        while True:
+            header = fp.read(_TILE_LOG_RECORD.size)
+            if len(header) < _TILE_LOG_RECORD.size:
+                break
+            tx, ty, length = _TILE_LOG_RECORD.unpack(header)
+            zdata = fp.read(length)
+            if len(zdata) < length:
+                break
+            records[(tx, ty)] = zdata or None
+        if header:
+            logger.warning("Ignored truncated record at the end of %r",
+                           filename)
+    return records
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
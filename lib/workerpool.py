@@ -0,0 +1,417 @@
+# This file is part of MyPaint.
+# Copyright (C) 2016 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Threaded worker pools for parallelizable background processing."""
+
+from __future__ import division, print_function
+
+import threading
+import Queue
+import collections
+import multiprocessing
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+## Helper funcs
+
+def get_default_num_workers():
+    """Returns a sensible default number of worker threads
+
+    :rtype: int
+
+    This is the number of CPUs in the system, or 1 if that cannot
+    be determined.
+
+    """
+    try:
+        return max(1, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
+
+## Class defs
+
+
+class Job (object):
+    """A unit of work submitted to a WorkerPool
+
+    Jobs are created by `WorkerPool.submit()`. The submitting thread
+    can wait for one to complete, and retrieve its result.
+
+    >>> job = Job(sum, ([1, 2, 3],), {})
+    >>> job.done()
+    False
+    >>> job.run()
+    >>> job.done(), job.result()
+    (True, 6)
+
+    Exceptions raised by the work function are re-raised in the
+    thread which asks for the result.
+
+    >>> job = Job(int, ("x",), {})
+    >>> job.run()
+    >>> job.result()
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'x'
+
+    Jobs which have not started running can be cancelled.
+
+    >>> job = Job(sum, ([1, 2, 3],), {})
+    >>> job.cancel()
+    True
+    >>> job.done(), job.cancelled()
+    (True, True)
+
+    """
+
+    def __init__(self, func, args, kwargs):
+        super(Job, self).__init__()
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._started = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+
+    def run(self):
+        """Runs the job in the calling thread, unless it was cancelled"""
+        with self._lock:
+            if self._started or self._cancelled:
+                return
+            self._started = True
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except Exception as ex:
+            logger.debug("Job %r raised %r", self._func, ex)
+            self._exception = ex
+        finally:
+            self._func = self._args = self._kwargs = None
+            self._finished.set()
+
+    def cancel(self):
+        """Cancels the job if it hasn't started yet
+
+        :returns: True if the job was cancelled
+        :rtype: bool
+
+        """
+        with self._lock:
+            if self._started:
+                return False
+            self._cancelled = True
+            self._func = self._args = self._kwargs = None
+        self._finished.set()
+        return True
+
+    def cancelled(self):
+        """True if the job was cancelled before it started"""
+        return self._cancelled
+
+    def done(self):
+        """True if the job has finished running, or was cancelled"""
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish
+
+        :param float timeout: Maximum time to wait, in seconds
+        :returns: True if the job finished in time
+        :rtype: bool
+
+        """
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    def result(self):
+        """Waits for the job to finish, and returns its result
+
+        :raises: whatever the job raised when it ran
+
+        Cancelled jobs return None.
+
+        """
+        self.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class WorkerPool (object):
+    """Fixed-size pool of daemon threads processing queued jobs
+
+    Worker threads are only useful for work which spends most of its
+    time outside the Python interpreter, in code which releases the
+    global interpreter lock. MyPaint's tile operations in mypaintlib
+    do that for the pixel loops of the most expensive operations.
+
+    >>> pool = WorkerPool(num_workers=3, name="doctest")
+    >>> pool.map(lambda x: x*x, range(10))
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81]
+    >>> job = pool.submit(sum, [1, 2, 3])
+    >>> job.result()
+    6
+    >>> pool.shutdown()
+
+    The results of `map()` are always returned in the order of its
+    input, regardless of which worker processed each item.
+
+    """
+
+    def __init__(self, num_workers=None, name="worker"):
+        """Initialize, without starting any threads
+
+        :param int num_workers: Number of threads. None or 0 means auto.
+        :param str name: Name prefix for the worker threads
+
+        Threads are started lazily when work is first submitted.
+
+        """
+        super(WorkerPool, self).__init__()
+        if not num_workers:
+            num_workers = get_default_num_workers()
+        self._num_workers = max(1, int(num_workers))
+        self._name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._threads_lock = threading.Lock()
+
+    @property
+    def num_workers(self):
+        """The number of worker threads in the pool"""
+        return self._num_workers
+
+    def _start_threads(self):
+        """Start the worker threads if they aren't running"""
+        with self._threads_lock:
+            if self._threads:
+                return
+            for i in xrange(self._num_workers):
+                thread = threading.Thread(
+                    target = self._worker_run,
+                    name = "%s-%d" % (self._name, i),
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker_run(self):
+        """Worker thread main loop"""
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                job.run()
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """Queues a function call to be run by a worker
+
+        :param callable func: The function to call
+        :param \*args: Positional args for `func`
+        :param \*\*kwargs: Keyword args for `func`
+        :returns: The queued job
+        :rtype: Job
+
+        """
+        self._start_threads()
+        job = Job(func, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def map(self, func, items):
+        """Calls a function on each item in parallel, returning results
+
+        :param callable func: Function to call with each item
+        :param iterable items: The items to process
+        :returns: list of results, in the same order as `items`
+        :rtype: list
+
+        The calling thread processes jobs too, and blocks until every
+        item has been processed. The first exception raised by any
+        call is re-raised here, after the other calls have finished.
+
+        """
+        jobs = [self.submit(func, item) for item in items]
+        # Help out while waiting, rather than just sleeping
+        for job in jobs:
+            job.run()
+        return [job.result() for job in jobs]
+
+    def shutdown(self, wait=True):
+        """Stops the worker threads
+
+        :param bool wait: Wait for queued work to complete first
+
+        Jobs already queued are processed before the threads exit.
+        The pool can be reused afterwards: new threads are started
+        when more work is submitted.
+
+        """
+        with self._threads_lock:
+            threads = self._threads
+            self._threads = []
+            for thread in threads:
+                self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class ThreadedProcessor (object):
+    """Queue of piecemeal tasks, run in order by one worker thread
+
+    This has the same interface as `lib.idletask.Processor`, so the same
+    kinds of task can be queued. Each is called repeatedly until it
+    returns false, but in a background thread rather than in the GUI's
+    idle time. Tasks must only work on snapshots of anything which the
+    main thread can change.
+
+    >>> done = threading.Event()
+    >>> results = []
+    >>> proc = ThreadedProcessor(
+    ...     name = "doctest",
+    ...     finished_cb = lambda ok: done.set(),
+    ... )
+    >>> items = [1, 2, 3]
+    >>> proc.add_work(lambda: results.append(items.pop()) or items)
+    >>> proc.add_work(results.append, "last")
+    >>> done.wait(10)
+    True
+    >>> results
+    [3, 2, 1, 'last']
+    >>> proc.has_work()
+    False
+
+    `stop()` is the cancellation hook. It discards the queued work, and
+    waits for the call in progress, if any, to return.
+
+    """
+
+    def __init__(self, name="processor", finished_cb=None):
+        """Initialize, without starting the thread
+
+        :param str name: Name for the worker thread
+        :param callable finished_cb: Called as finished_cb(ok) when
+            the queue runs out of work (see below)
+
+        The finished callback is called in the worker thread, with True
+        if all the queued tasks completed, or False if one of them
+        raised an exception. Any remaining tasks are discarded in that
+        case. It is not called for work which was cancelled by
+        `stop()`. GUI code can pass the result on to the main thread
+        with ``GLib.idle_add()``.
+
+        """
+        super(ThreadedProcessor, self).__init__()
+        self._name = name
+        self._finished_cb = finished_cb
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._busy = False  # a task call is in progress
+        self._thread = None
+
+    def has_work(self):
+        """True if tasks are queued or running"""
+        with self._cond:
+            return bool(self._queue) or self._busy
+
+    def add_work(self, func, *args, **kwargs):
+        """Adds work
+
+        :param func: a task callable.
+        :param \*args: passed to func
+        :param \*\*kwargs: passed to func
+
+        This starts the worker thread if it isn't already running.
+
+        """
+        with self._cond:
+            self._queue.append((func, args, kwargs))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target = self._run,
+                    name = self._name,
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def finish_all(self):
+        """Waits for all queued tasks to complete"""
+        with self._cond:
+            while self._queue or self._busy:
+                self._cond.wait()
+
+    def iter_work(self):
+        """Iterate across (a copy of) the queued tasks"""
+        with self._cond:
+            return iter(list(self._queue))
+
+    def stop(self):
+        """Cancels all queued tasks
+
+        This waits for the task call in progress, if any, to return.
+        Tasks are never called again after it returns.
+
+        """
+        with self._cond:
+            self._queue.clear()
+            while self._busy:
+                self._cond.wait()
+
+    def _run(self):
+        """Worker thread main loop"""
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                entry = self._queue[0]
+                self._busy = True
+            func, args, kwargs = entry
+            ok = True
+            try:
+                more = bool(func(*args, **kwargs))
+            except Exception:
+                logger.exception("%s: task %r failed", self._name, func)
+                ok = False
+            finished = False
+            with self._cond:
+                self._busy = False
+                # Cancelled work may have been replaced by new work.
+                if self._queue and self._queue[0] is entry:
+                    if not ok:
+                        self._queue.clear()
+                    elif not more:
+                        self._queue.popleft()
+                    finished = not self._queue
+                self._cond.notify_all()
+            if finished and self._finished_cb:
+                self._finished_cb(ok)
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
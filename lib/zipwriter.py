@@ -0,0 +1,309 @@
+# This file is part of MyPaint.
+# Copyright (C) 2016 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Zipfile writing, with member data generated in parallel."""
+
+from __future__ import division, print_function
+
+import os
+import time
+import zipfile
+import tempfile
+import logging
+
+import lib.workerpool
+
+logger = logging.getLogger(__name__)
+
+
+## Class defs
+
+
+class ParallelZipWriter (object):
+    """Adds members to a zipfile in order, generating some in parallel
+
+    This wraps a `zipfile.ZipFile` open for writing. Members can be
+    added with `write()` and `writestr()`, as for a ZipFile, or their
+    data can be generated by calls run in worker threads via
+    `submit()`. Members are written to the zipfile in the order they
+    were added, so the resulting archive is the same regardless of
+    which worker finished first.
+
+    >>> import io
+    >>> buf = io.BytesIO()
+    >>> z = ParallelZipWriter(zipfile.ZipFile(buf, "w"), num_workers=2)
+    >>> z.writestr("mimetype", b"text/plain")
+    >>> for i in xrange(5):
+    ...     z.submit("data/%d.txt" % (i,), str, i * 111)
+    >>> z.close()
+    >>> zf = zipfile.ZipFile(buf)
+    >>> zf.namelist()
+    ['mimetype', 'data/0.txt', 'data/1.txt', 'data/2.txt', 'data/3.txt', 'data/4.txt']
+    >>> zf.read("data/3.txt")
+    '333'
+
+    Large members can be written to a temporary file by the worker
+    instead, with `submit_stream()`. They are copied into the zipfile
+    from there in chunks, so their data is never all in memory at once.
+
+    >>> def write_lines(fp, n):
+    ...     for i in xrange(n):
+    ...         fp.write(b"line %d\\n" % (i,))
+    >>> buf = io.BytesIO()
+    >>> z = ParallelZipWriter(zipfile.ZipFile(buf, "w"))
+    >>> z.submit_stream("lines.txt", write_lines, 3)
+    >>> z.close()
+    >>> zipfile.ZipFile(buf).read("lines.txt")
+    'line 0\\nline 1\\nline 2\\n'
+
+    Exceptions raised by submitted calls are re-raised by `flush()` or
+    `close()`.
+
+    An existing zipfile can be given as a source, so that members which
+    haven't changed since it was written can be copied across instead
+    of being generated again.
+
+    >>> z2buf = io.BytesIO()
+    >>> z2 = ParallelZipWriter(
+    ...     zipfile.ZipFile(z2buf, "w"),
+    ...     source = zf,
+    ...     source_ref = "old",
+    ...     ref = "new",
+    ... )
+    >>> z2.source_ref, z2.ref
+    ('old', 'new')
+    >>> z2.copy_from_source("data/3.txt", "data/three.txt")
+    >>> z2.close()
+    >>> zipfile.ZipFile(z2buf).read("data/three.txt")
+    '333'
+
+    """
+
+    #: How often to call feedback_cb while waiting, in seconds
+    FEEDBACK_INTERVAL = 0.1
+
+    def __init__(self, zf, num_workers=None, feedback_cb=None,
+                 source=None, source_ref=None, ref=None):
+        """Initialize, wrapping a ZipFile
+
+        :param zipfile.ZipFile zf: Zipfile, open for writing
+        :param int num_workers: Worker threads to use. None means auto.
+        :param callable feedback_cb: Called every so often while waiting
+        :param zipfile.ZipFile source: Zipfile to copy members from
+        :param source_ref: Identifies the source, for callers
+        :param ref: Identifies the file being written, for callers
+
+        The source zipfile must have been opened by name, so that its
+        members can be read by several threads at once.
+
+        """
+        super(ParallelZipWriter, self).__init__()
+        self._zipfile = zf
+        self._source = source
+        self._source_ref = (source is not None) and source_ref or None
+        self._ref = ref
+        self._pool = lib.workerpool.WorkerPool(
+            num_workers = num_workers,
+            name = "zipwriter",
+        )
+        self._feedback_cb = feedback_cb
+        self._pending = []  # [(zinfo_or_arcname, data_or_job)]
+
+    @property
+    def zipfile(self):
+        """The wrapped zipfile"""
+        return self._zipfile
+
+    @property
+    def source_ref(self):
+        """Identifies the source zipfile (None if there isn't one)"""
+        return self._source_ref
+
+    @property
+    def ref(self):
+        """Identifies the file being written (opaque, set by the caller)"""
+        return self._ref
+
+    def write(self, filename, arcname=None):
+        """Adds a file's content as a member
+
+        :param unicode filename: File to read
+        :param unicode arcname: Name to store it as
+
+        The file is read immediately, and can be removed afterwards.
+
+        """
+        if arcname is None:
+            arcname = os.path.basename(filename)
+        st = os.stat(filename)
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        zinfo.compress_type = self._zipfile.compression
+        with open(filename, "rb") as fp:
+            data = fp.read()
+        self._pending.append((zinfo, data))
+
+    def writestr(self, zinfo_or_arcname, data):
+        """Adds a member with the given data (see ZipFile.writestr)"""
+        self._pending.append((zinfo_or_arcname, data))
+
+    def submit(self, zinfo_or_arcname, func, *args, **kwargs):
+        """Adds a member whose data will be returned by a function call
+
+        :param zinfo_or_arcname: Name or ZipInfo for the new member
+        :param callable func: Function returning the member's data
+        :param \*args: Positional args for `func`
+        :param \*\*kwargs: Keyword args for `func`
+
+        The call is made in a worker thread, so it must not touch
+        anything which isn't thread-safe, such as the GUI.
+
+        """
+        job = self._pool.submit(func, *args, **kwargs)
+        self._pending.append((zinfo_or_arcname, job))
+
+    def submit_stream(self, zinfo_or_arcname, func, *args, **kwargs):
+        """Adds a member whose data will be written by a function call
+
+        :param zinfo_or_arcname: Name or ZipInfo for the new member
+        :param callable func: Function writing the member's data
+        :param \*args: Positional args for `func`, after the file
+        :param \*\*kwargs: Keyword args for `func`
+
+        The call is made in a worker thread as ``func(fp, *args,
+        **kwargs)``, where `fp` is a temporary file open for writing.
+        The file is removed after it has been copied into the zipfile.
+
+        """
+        job = self._pool.submit(
+            _write_tempfile,
+            func, args, kwargs,
+        )
+        self._pending.append((zinfo_or_arcname, _StreamedData(job)))
+
+    def copy_from_source(self, name, zinfo_or_arcname):
+        """Adds a member with the data of a member of the source zipfile
+
+        :param unicode name: Member of the source zipfile to copy
+        :param zinfo_or_arcname: Name or ZipInfo for the new member
+
+        The data is read by a worker thread. It's copied as it is,
+        without being decoded or re-encoded in any way.
+
+        """
+        assert self._source is not None, "no source zipfile"
+        self.submit(zinfo_or_arcname, self._source.read, name)
+
+    def flush(self):
+        """Writes all pending members, waiting for their data if needed"""
+        pending = self._pending
+        self._pending = []
+        try:
+            for zinfo_or_arcname, data in pending:
+                if isinstance(data, _StreamedData):
+                    self._write_streamed(zinfo_or_arcname, data)
+                    continue
+                if isinstance(data, lib.workerpool.Job):
+                    data = self._wait(data)
+                if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+                    zinfo = zipfile.ZipInfo(zinfo_or_arcname)
+                    zinfo.external_attr = 0o644 << 16  # like zipfile_writestr
+                    zinfo.external_attr |= 0o100000 << 16
+                    zinfo.compress_type = self._zipfile.compression
+                    zinfo_or_arcname = zinfo
+                self._zipfile.writestr(zinfo_or_arcname, data)
+        except:
+            for zinfo_or_arcname, data in pending:
+                if isinstance(data, _StreamedData):
+                    data.discard()
+                elif isinstance(data, lib.workerpool.Job):
+                    data.cancel()
+            raise
+
+    def _write_streamed(self, zinfo_or_arcname, data):
+        """Copies a streamed member's temporary file into the zipfile"""
+        filename = self._wait(data.job)
+        try:
+            if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+                arcname = zinfo_or_arcname.filename
+            else:
+                arcname = zinfo_or_arcname
+            os.chmod(filename, 0o644)  # like zipfile_writestr
+            self._zipfile.write(filename, arcname)
+        finally:
+            os.unlink(filename)
+
+    def _wait(self, job):
+        """Waits for a job's result, calling feedback_cb periodically"""
+        while not job.wait(self.FEEDBACK_INTERVAL):
+            if self._feedback_cb:
+                self._feedback_cb()
+        if self._feedback_cb:
+            self._feedback_cb()
+        return job.result()
+
+    def close(self):
+        """Writes all pending members, then closes the zipfile"""
+        try:
+            self.flush()
+            self._zipfile.close()
+        finally:
+            self._pool.shutdown()
+
+
+class _StreamedData (object):
+    """Pending member data written to a temp file by a Job"""
+
+    def __init__(self, job):
+        super(_StreamedData, self).__init__()
+        self.job = job
+
+    def discard(self):
+        """Cancels the job, or removes the file it wrote"""
+        if self.job.cancel():
+            return
+        try:
+            filename = self.job.result()
+        except Exception:
+            return
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+## Helper funcs
+
+
+def _write_tempfile(func, args, kwargs):
+    """Calls func(fp, *args, **kwargs) on a new temp file; returns its name
+
+    The file is removed again if the call fails.
+
+    """
+    fd, filename = tempfile.mkstemp(prefix="zipwriter", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            func(fp, *args, **kwargs)
+    except:
+        os.unlink(filename)
+        raise
+    return filename
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+
+import paths
+from lib import tiledsurface
+from lib import helpers
+import lib.layer
+
+
+N = tiledsurface.N
+RED = (1 << 15, 0, 0, 1 << 15)
+
+
+# Helpers:
+
+def _paint(surface, tx, ty, value):
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = value
+
+
+def _erase(surface, tx, ty):
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = 0
+    surface.remove_empty_tiles()
+
+
+def _paint_layer(layer, tx, ty, value):
+    _paint(layer._surface, tx, ty, value)
+    layer._surface.notify_observers(tx*N, ty*N, N, N)
+
+
+def _erase_layer(layer, tx, ty):
+    _erase(layer._surface, tx, ty)
+    layer._surface.notify_observers(tx*N, ty*N, N, N)
+
+
+# Test cases:
+
+class SurfaceBBox (unittest.TestCase):
+    """Tests the incrementally maintained surface bbox"""
+
+    def setUp(self):
+        self.surface = tiledsurface.MyPaintSurface()
+        for tx in range(-1, 3):
+            for ty in range(0, 3):
+                _paint(self.surface, tx, ty, 1000)
+
+    def assertBBoxTiles(self, tx0, ty0, tx1, ty1):
+        bbox = self.surface.get_bbox()
+        expected = helpers.Rect(
+            N*tx0, N*ty0,
+            N*(tx1 - tx0 + 1), N*(ty1 - ty0 + 1),
+        )
+        self.assertEqual(tuple(bbox), tuple(expected))
+
+    def test_initial(self):
+        self.assertBBoxTiles(-1, 0, 2, 2)
+
+    def test_erase_edges(self):
+        """Erasing whole edges shrinks the bbox"""
+        for ty in range(0, 3):
+            _erase(self.surface, -1, ty)
+        self.assertBBoxTiles(0, 0, 2, 2)
+        for tx in range(0, 3):
+            _erase(self.surface, tx, 2)
+        self.assertBBoxTiles(0, 0, 2, 1)
+
+    def test_erase_partial_edge(self):
+        """Erasing part of an edge, or a corner, keeps the bbox"""
+        _erase(self.surface, -1, 0)
+        _erase(self.surface, 2, 2)
+        self.assertBBoxTiles(-1, 0, 2, 2)
+        _erase(self.surface, -1, 1)
+        _erase(self.surface, -1, 2)
+        self.assertBBoxTiles(0, 0, 2, 2)
+
+    def test_erase_everything(self):
+        for tx in range(-1, 3):
+            for ty in range(0, 3):
+                _erase(self.surface, tx, ty)
+        self.assertTrue(self.surface.get_bbox().empty())
+        _paint(self.surface, 5, 5, 1000)
+        self.assertBBoxTiles(5, 5, 5, 5)
+
+    def test_snapshot_restore(self):
+        """The bbox follows restored snapshots"""
+        sshot = self.surface.save_snapshot()
+        for ty in range(0, 3):
+            _erase(self.surface, 2, ty)
+        _paint(self.surface, 1, -3, 1000)
+        self.assertBBoxTiles(-1, -3, 1, 2)
+        self.surface.load_snapshot(sshot)
+        self.assertBBoxTiles(-1, 0, 2, 2)
+
+    def test_clear(self):
+        self.surface.clear()
+        self.assertTrue(self.surface.get_bbox().empty())
+
+    def test_extents_serial(self):
+        """Only changes to the extents bump the serial"""
+        serial = tiledsurface.get_extents_serial()
+        _paint(self.surface, 0, 0, 2000)
+        self.assertEqual(tiledsurface.get_extents_serial(), serial)
+        _erase(self.surface, -1, 0)
+        self.assertNotEqual(tiledsurface.get_extents_serial(), serial)
+
+
+class LayerStackBBox (unittest.TestCase):
+    """Tests the cached bboxes of layer stacks"""
+
+    def setUp(self):
+        self.root = lib.layer.RootLayerStack(doc=None)
+        self.group = lib.layer.LayerStack()
+        self.layer1 = lib.layer.PaintingLayer()
+        self.layer2 = lib.layer.PaintingLayer()
+        self.root.deepinsert([0], self.layer1)
+        self.root.deepinsert([1], self.group)
+        self.root.deepinsert([1, 0], self.layer2)
+        _paint_layer(self.layer1, 0, 0, RED)
+        _paint_layer(self.layer2, 3, 2, RED)
+
+    def assertBBox(self, stack, x, y, w, h):
+        self.assertEqual(tuple(stack.get_bbox()), (x, y, w, h))
+
+    def test_union(self):
+        self.assertBBox(self.root, 0, 0, 4*N, 3*N)
+        self.assertBBox(self.group, 3*N, 2*N, N, N)
+
+    def test_erase_edge(self):
+        """Erasing tiles at the edges shrinks the cached bboxes"""
+        self.root.get_bbox()
+        _erase_layer(self.layer2, 3, 2)
+        self.assertTrue(self.group.get_bbox().empty())
+        self.assertBBox(self.root, 0, 0, N, N)
+
+    def test_grow(self):
+        _paint_layer(self.layer2, -2, 1, RED)
+        self.assertBBox(self.root, -2*N, 0, 6*N, 3*N)
+
+    def test_structure_change(self):
+        """Removing layers updates the cached bboxes"""
+        self.root.get_bbox()
+        self.root.deepremove(self.group)
+        self.assertBBox(self.root, 0, 0, N, N)
+        self.root.deepinsert([0], self.group)
+        self.assertBBox(self.root, 0, 0, 4*N, 3*N)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+
+import numpy as np
+
+import paths
+from lib import mypaintlib
+
+
+N = mypaintlib.TILE_SIZE
+OPAQUE = 1 << 15
+
+
+# Helpers:
+
+def _make_canvas(w_tiles, h_tiles, seed=0):
+    """Returns a canvas array with walls and gaps crossing tile edges"""
+    w = w_tiles * N
+    h = h_tiles * N
+    canvas = np.zeros((h, w, 4), 'uint16')
+    # Walls which don't line up with tile edges, with gaps in them
+    for x in range(N // 3, w, N + 7):
+        canvas[:, x:x+3] = (0, 0, 0, OPAQUE)
+        canvas[N // 2 + x % 5:N // 2 + x % 5 + 9, x:x+3] = 0
+    for y in range(N // 5, h, N - 5):
+        canvas[y:y+2, :] = (0, 0, 0, OPAQUE)
+        canvas[y:y+2, N + y % 11:N + y % 11 + 6] = 0
+    # Translucent noise, for testing tolerances
+    rand = np.random.RandomState(seed)
+    noise = rand.randint(0, OPAQUE // 8, (h, w))
+    blank = (canvas[..., 3] == 0)
+    for c in range(4):
+        canvas[..., c][blank] = noise[blank] // (4 - c)
+    return canvas
+
+
+def _split_tiles(canvas, tx0, ty0):
+    """Splits a canvas into a tiledict, with its top left at (tx0, ty0)"""
+    h, w = canvas.shape[0:2]
+    tiles = {}
+    for ty in range(h // N):
+        for tx in range(w // N):
+            tile = canvas[ty*N:(ty+1)*N, tx*N:(tx+1)*N].copy()
+            tiles[(tx0 + tx, ty0 + ty)] = tile
+    return tiles
+
+
+def _tile_getter(tiles):
+    empty = np.zeros((N, N, 4), 'uint16')
+    return lambda tx, ty: tiles.get((tx, ty), empty)
+
+
+def _target_color(get_tile, x, y):
+    """Premultiplied colour at a point, as flood_fill() samples it"""
+    tile = get_tile(x // N, y // N)
+    r, g, b, a = [int(c) for c in tile[y % N][x % N]]
+    if a == 0:
+        return (0, 0, 0, 0)
+    return (r, g, b, a)
+
+
+def _fill_per_tile(get_tile, x, y, fill, bbox, tolerance):
+    """Reference fill: one tile_flood_fill() call per tile visited
+
+    This is how lib.tiledsurface.flood_fill() worked before the
+    traversal was moved into mypaintlib.
+    """
+    targ = _target_color(get_tile, x, y)
+    bbx, bby, bbw, bbh = bbox
+    bbbrx = bbx + bbw - 1
+    bbbry = bby + bbh - 1
+    min_tx, min_ty = bbx // N, bby // N
+    max_tx, max_ty = bbbrx // N, bbbry // N
+    filled = {}
+    tileq = [((x // N, y // N), [(x % N, y % N)])]
+    while tileq:
+        (tx, ty), seeds = tileq.pop(0)
+        if not (min_tx <= tx <= max_tx and min_ty <= ty <= max_ty):
+            continue
+        min_x = (bbx % N) if (tx == min_tx) else 0
+        min_y = (bby % N) if (ty == min_ty) else 0
+        max_x = (bbbrx % N) if (tx == max_tx) else (N - 1)
+        max_y = (bbbry % N) if (ty == max_ty) else (N - 1)
+        dst = filled.get((tx, ty))
+        if dst is None:
+            dst = np.zeros((N, N, 4), 'uint16')
+            filled[(tx, ty)] = dst
+        overflows = mypaintlib.tile_flood_fill(
+            get_tile(tx, ty), dst, seeds,
+            targ[0], targ[1], targ[2], targ[3],
+            fill[0], fill[1], fill[2],
+            min_x, min_y, max_x, max_y,
+            tolerance,
+        )
+        seeds_n, seeds_e, seeds_s, seeds_w = overflows
+        if seeds_n and ty > min_ty:
+            tileq.append(((tx, ty - 1), seeds_n))
+        if seeds_w and tx > min_tx:
+            tileq.append(((tx - 1, ty), seeds_w))
+        if seeds_s and ty < max_ty:
+            tileq.append(((tx, ty + 1), seeds_s))
+        if seeds_e and tx < max_tx:
+            tileq.append(((tx + 1, ty), seeds_e))
+    return dict((k, t) for (k, t) in filled.items() if t.any())
+
+
+def _fill_tiles(get_tile, x, y, fill, bbox, tolerance, progress_cb=None):
+    """Fill using mypaintlib.flood_fill_tiles()"""
+    targ = _target_color(get_tile, x, y)
+    bbx, bby, bbw, bbh = bbox
+    return mypaintlib.flood_fill_tiles(
+        get_tile,
+        x, y,
+        targ[0], targ[1], targ[2], targ[3],
+        fill[0], fill[1], fill[2],
+        bbx, bby, bbw, bbh,
+        tolerance,
+        progress_cb,
+    )
+
+
+# Test cases:
+
+class FloodFillTiles (unittest.TestCase):
+    """Compares flood_fill_tiles() with per-tile tile_flood_fill()"""
+
+    FILL = (0.25, 0.5, 1.0)
+
+    def setUp(self):
+        canvas = _make_canvas(6, 5)
+        self.tiles = _split_tiles(canvas, -2, -1)
+        self.get_tile = _tile_getter(self.tiles)
+
+    def assert_fills_match(self, x, y, bbox, tolerance=0.0):
+        expected = _fill_per_tile(self.get_tile, x, y, self.FILL,
+                                  bbox, tolerance)
+        actual = _fill_tiles(self.get_tile, x, y, self.FILL,
+                             bbox, tolerance)
+        self.assertTrue(expected, msg="Reference fill did nothing")
+        self.assertEqual(sorted(actual.keys()), sorted(expected.keys()))
+        for pos, tile in expected.items():
+            self.assertTrue(
+                (actual[pos] == tile).all(),
+                msg="Tile %r differs" % (pos,),
+            )
+        return actual
+
+    def test_crosses_tile_edges(self):
+        """Fills spreading across many tiles match"""
+        filled = self.assert_fills_match(
+            N + 5, N // 2,
+            (-2*N, -N, 6*N, 5*N),
+            tolerance=0.2,
+        )
+        self.assertGreater(len(filled), 4)
+
+    def test_negative_coords(self):
+        """Fills seeded in tiles at negative coordinates match"""
+        self.assert_fills_match(
+            -N - 3, -N // 2,
+            (-2*N, -N, 6*N, 5*N),
+            tolerance=0.2,
+        )
+
+    def test_exact_match(self):
+        """Zero-tolerance fills match"""
+        self.tiles.clear()
+        self.assert_fills_match(3, 3, (-N, -N, 3*N, 3*N))
+
+    def test_bbox_clipping(self):
+        """Bboxes not aligned with tiles limit the fill identically"""
+        bbox = (-N - 13, -7, 3*N + 29, 2*N + 3)
+        filled = self.assert_fills_match(
+            N // 2, N // 2,
+            bbox,
+            tolerance=0.3,
+        )
+        bbx, bby, bbw, bbh = bbox
+        for (tx, ty), tile in filled.items():
+            ys, xs = np.nonzero(tile[..., 3])
+            xs = xs + tx*N
+            ys = ys + ty*N
+            self.assertTrue(xs.min() >= bbx and xs.max() < bbx + bbw)
+            self.assertTrue(ys.min() >= bby and ys.max() < bby + bbh)
+
+    def test_seed_outside_bbox(self):
+        """Nothing is filled if the seed is outside the bbox"""
+        filled = _fill_tiles(self.get_tile, 5*N, 5*N, self.FILL,
+                             (0, 0, N, N), 0.5)
+        self.assertEqual(filled, {})
+
+    def test_cancel(self):
+        """Returning false from the progress callback cancels the fill"""
+        self.tiles.clear()
+        calls = []
+
+        def _progress_cb(done, queued):
+            calls.append((done, queued))
+            return len(calls) < 2
+
+        filled = _fill_tiles(self.get_tile, 0, 0, self.FILL,
+                             (-10*N, -10*N, 20*N, 20*N), 0.0,
+                             progress_cb=_progress_cb)
+        self.assertIsNone(filled)
+        self.assertEqual(len(calls), 2)
+        done, queued = calls[0]
+        self.assertTrue(done > 0 and queued > 0)
+
+    def test_progress_without_cancel(self):
+        """The progress callback doesn't change the results"""
+        self.tiles.clear()
+        calls = []
+        bbox = (-5*N, -5*N, 10*N, 10*N)
+        filled = _fill_tiles(self.get_tile, 0, 0, self.FILL, bbox, 0.0,
+                             progress_cb=lambda *a: calls.append(a) or True)
+        self.assertTrue(calls)
+        self.assertEqual(len(filled), 100)
+
+    def test_progress_exception(self):
+        """Exceptions raised by the progress callback propagate"""
+        self.tiles.clear()
+
+        def _progress_cb(done, queued):
+            raise RuntimeError("stop")
+
+        self.assertRaises(
+            RuntimeError,
+            _fill_tiles, self.get_tile, 0, 0, self.FILL,
+            (-10*N, -10*N, 20*N, 20*N), 0.0,
+            progress_cb=_progress_cb,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+import os
+import tempfile
+import shutil
+import zipfile
+import xml.etree.ElementTree as ET
+
+import paths
+from lib import tiledsurface
+from lib import document
+import lib.zipwriter
+import lib.layer
+
+
+N = tiledsurface.N
+RED = (1 << 15, 0, 0, 1 << 15)
+BGTILE_ATTR = lib.layer.BackgroundLayer.ORA_BGTILE_LEGACY_ATTR
+STROKEMAP_ATTR = lib.layer.PaintingLayer._ORA_STROKEMAP_LEGACY_ATTR
+
+
+# Helpers:
+
+def _layer_members(filename):
+    """Returns the (png, strokemap) members of each layer, in order"""
+    with zipfile.ZipFile(filename) as orazip:
+        image = ET.fromstring(orazip.read("stack.xml"))
+    members = []
+    for elem in image.find("stack").findall("layer"):
+        if BGTILE_ATTR in elem.attrib:
+            continue
+        members.append((elem.attrib["src"], elem.attrib.get(STROKEMAP_ATTR)))
+    return members
+
+
+def _read(filename, name):
+    with zipfile.ZipFile(filename) as orazip:
+        return orazip.read(name)
+
+
+# Test cases:
+
+class CopyUnchangedLayers (unittest.TestCase):
+    """Tests copying unchanged layer data when saving OpenRaster files"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.copied = []
+        cls = lib.zipwriter.ParallelZipWriter
+        copy_from_source = cls.copy_from_source
+        copied = self.copied
+
+        def _copy_from_source(writer, name, zinfo_or_arcname):
+            copied.append(zinfo_or_arcname)
+            return copy_from_source(writer, name, zinfo_or_arcname)
+
+        self._copy_from_source = copy_from_source
+        cls.copy_from_source = _copy_from_source
+        self.doc = document.Document(painting_only=True)
+        self.doc.load(os.path.join(paths.TESTS_DIR, "smallimage.ora"))
+
+    def tearDown(self):
+        lib.zipwriter.ParallelZipWriter.copy_from_source = \
+            self._copy_from_source
+        self.doc.cleanup()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _save(self, basename):
+        filename = os.path.join(self.tmpdir, basename)
+        del self.copied[:]
+        self.doc.save(filename)
+        return filename
+
+    def test_resave_after_change(self):
+        """Only a changed layer's data is encoded again"""
+        first = self._save("first.ora")
+        layer = self.doc.layer_stack.deepget((0,))
+        with layer._surface.tile_request(0, 0, readonly=False) as rgba:
+            rgba[...] = RED
+        layer._surface.notify_observers(0, 0, N, N)
+        second = self._save("second.ora")
+
+        members = _layer_members(second)
+        self.assertEqual(members, _layer_members(first))
+        self.assertEqual(len(members), 2)
+        (changed_png, changed_strokemap), unchanged = members
+
+        # The unchanged layer's members are copied across as they are
+        for name in unchanged:
+            self.assertIn(name, self.copied)
+            self.assertEqual(_read(second, name), _read(first, name))
+
+        # The changed layer is encoded from its new pixels
+        self.assertNotIn(changed_png, self.copied)
+        self.assertNotIn(changed_strokemap, self.copied)
+        self.assertNotEqual(_read(second, changed_png),
+                            _read(first, changed_png))
+
+    def test_resave_unchanged(self):
+        """Saving again without changes copies every layer"""
+        first = self._save("first.ora")
+        second = self._save("second.ora")
+        for members in _layer_members(second):
+            for name in members:
+                self.assertIn(name, self.copied)
+                self.assertEqual(_read(second, name), _read(first, name))
+
+
+if __name__ == "__main__":
+    unittest.main()
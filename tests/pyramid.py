@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+
+import numpy as np
+
+import paths
+from lib import tiledsurface
+import lib.layer
+
+
+N = tiledsurface.N
+RED = (1 << 15, 0, 0, 1 << 15)
+
+
+# Helpers:
+
+def _paint(layer, tx, ty, value):
+    surface = layer._surface
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = value
+    surface.notify_observers(tx*N, ty*N, N, N)
+
+
+def _erase(layer, tx, ty):
+    surface = layer._surface
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = 0
+    surface.remove_empty_tiles()
+    surface.notify_observers(tx*N, ty*N, N, N)
+
+
+# Test cases:
+
+class CompositePyramid (unittest.TestCase):
+    """Tests the root stack's downscaled composites"""
+
+    CONFIG = (False, True)  # (dst_has_alpha, render_background)
+
+    def setUp(self):
+        self.root = lib.layer.RootLayerStack(doc=None)
+        self.root.set_background((0, 0, 0))
+        self.layer = lib.layer.PaintingLayer()
+        self.root.deepinsert([0], self.layer)
+        self.dst = np.zeros((N, N, 4), 'uint8')
+
+    def _render(self, tx, ty, level):
+        self.root.composite_tile(
+            self.dst, False, tx, ty,
+            mipmap_level = level,
+            render_background = True,
+        )
+
+    def _lookup(self, tx, ty, level):
+        return self.root._composite_pyramid.lookup(
+            self.CONFIG, level, tx, ty,
+        )
+
+    def test_stored(self):
+        """Zoomed-out renders are kept in the pyramid"""
+        self._render(1, 0, 1)
+        rgba, stale = self._lookup(1, 0, 1)
+        self.assertIsNotNone(rgba)
+        self.assertEqual(stale, set())
+
+    def test_stroke_marks_stale(self):
+        """Painting marks only the quadrants above the stroke stale"""
+        self._render(0, 0, 1)
+        self._render(1, 0, 1)
+        self._render(0, 0, 2)
+        _paint(self.layer, 2, 0, RED)
+        self.assertEqual(self._lookup(0, 0, 1)[1], set())
+        self.assertEqual(self._lookup(1, 0, 1)[1], set([(0, 0)]))
+        self.assertEqual(self._lookup(0, 0, 2)[1], set([(1, 0)]))
+
+    def test_stroke_redrawn(self):
+        """Renders after a stroke at a coarse level show the stroke"""
+        self._render(1, 0, 1)
+        rgba, stale = self._lookup(1, 0, 1)
+        self.assertFalse(rgba[..., 0].any())
+        _paint(self.layer, 2, 0, RED)
+        self._render(1, 0, 1)
+        rgba, stale = self._lookup(1, 0, 1)
+        self.assertEqual(stale, set())
+        self.assertTrue((rgba[:N//2, :N//2, 0] == RED[0]).all())
+        self.assertFalse(rgba[N//2:, :, 0].any())
+        self.assertFalse(rgba[:, N//2:, 0].any())
+        self.assertTrue((self.dst[:N//2, :N//2, 0] > 250).all())
+        self.assertTrue((self.dst[N//2:, N//2:, 0] < 5).all())
+
+    def test_erase_redrawn(self):
+        """Erasing at level 0 is reflected at coarser levels"""
+        _paint(self.layer, 2, 0, RED)
+        self._render(1, 0, 1)
+        _erase(self.layer, 2, 0)
+        self._render(1, 0, 1)
+        rgba, stale = self._lookup(1, 0, 1)
+        self.assertFalse(rgba[..., 0].any())
+
+    def test_level_0_updates_parents(self):
+        """Redrawing level 0 tiles patches their stale parents"""
+        self._render(1, 0, 1)
+        _paint(self.layer, 2, 0, RED)
+        self._render(2, 0, 0)
+        rgba, stale = self._lookup(1, 0, 1)
+        self.assertEqual(stale, set())
+        self.assertTrue((rgba[:N//2, :N//2, 0] == RED[0]).all())
+
+    def test_flushed(self):
+        """Layer-wide changes discard the whole pyramid"""
+        self._render(1, 0, 1)
+        self.root.set_background((255, 255, 255))
+        self.assertEqual(self._lookup(1, 0, 1), (None, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+
+import numpy as np
+
+import paths
+from lib import tiledsurface
+from lib import mypaintlib
+from lib.modes import PASS_THROUGH_MODE
+import lib.layer
+
+
+N = tiledsurface.N
+
+# Half-opaque colours whose composites are exact in 15-bit fixed point,
+# so split and full compositing must agree to the last bit.
+RED = (1 << 13, 0, 0, 1 << 14)
+GREEN = (0, 1 << 13, 0, 1 << 14)
+BLUE = (0, 0, 1 << 13, 1 << 14)
+GREY = (1 << 12, 1 << 12, 1 << 12, 1 << 14)
+
+
+# Helpers:
+
+def _paint(layer, tx, ty, value):
+    surface = layer._surface
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = value
+    surface.notify_observers(tx*N, ty*N, N, N)
+
+
+# Test cases:
+
+class SplitCompositing (unittest.TestCase):
+    """Tests compositing around the current layer while it's painted"""
+
+    def setUp(self):
+        self.root = lib.layer.RootLayerStack(doc=None)
+        self.root.set_background((0, 0, 0))
+        self.above = lib.layer.PaintingLayer()
+        self.group = lib.layer.LayerStack()
+        self.group.mode = PASS_THROUGH_MODE
+        self.current = lib.layer.PaintingLayer()
+        self.inner_below = lib.layer.PaintingLayer()
+        self.below = lib.layer.PaintingLayer()
+        self.root.deepinsert([0], self.above)
+        self.root.deepinsert([1], self.group)
+        self.root.deepinsert([1, 0], self.current)
+        self.root.deepinsert([1, 1], self.inner_below)
+        self.root.deepinsert([2], self.below)
+        for tx in range(4):
+            _paint(self.above, tx, 0, RED)
+            _paint(self.inner_below, tx, 0, GREY)
+            _paint(self.below, tx, 0, BLUE)
+        self.root.current_path = (1, 0)
+
+    def _render(self, tx, ty, interactive):
+        dst = np.zeros((N, N, 4), 'uint16')
+        self.root.composite_tile(
+            dst, False, tx, ty,
+            render_background = True,
+            interactive = interactive,
+        )
+        return dst
+
+    def assertSplitMatchesFull(self, tx, ty):
+        split = self._render(tx, ty, True)
+        full = self._render(tx, ty, False)
+        self.assertTrue((split == full).all(),
+                        msg="Tile %r differs" % ((tx, ty),))
+
+    def _split_key(self, tx, ty):
+        return (tx, ty, False, 0, True)
+
+    def test_pass_through_group(self):
+        """Layers in pass-through groups are split, and match"""
+        _paint(self.current, 0, 0, GREEN)
+        self.assertEqual(
+            self.root._split_layers,
+            (self.current, [self.below, self.inner_below], [self.above]),
+        )
+        self.assertSplitMatchesFull(0, 0)
+        self.assertIn(self._split_key(0, 0), self.root._split_cache)
+        # Only the current layer is composited again for new paint
+        _paint(self.current, 0, 0, RED)
+        self.assertIn(self._split_key(0, 0), self.root._split_cache)
+        self.assertSplitMatchesFull(0, 0)
+
+    def test_isolated_group_refused(self):
+        """Layers in isolated groups aren't split"""
+        self.group.mode = mypaintlib.CombineNormal
+        _paint(self.current, 0, 0, GREEN)
+        self.assertIsNone(self.root._split_layers)
+        self.assertSplitMatchesFull(0, 0)
+
+    def test_non_normal_above_refused(self):
+        """Non-normal modes above the current layer prevent splitting"""
+        self.above.mode = mypaintlib.CombineMultiply
+        _paint(self.current, 0, 0, GREEN)
+        self.assertIsNone(self.root._split_layers)
+        self.assertSplitMatchesFull(0, 0)
+        self.assertEqual(len(self.root._split_cache), 0)
+
+    def test_other_layer_changes(self):
+        """Changes to other layers discard just the tiles they touch"""
+        _paint(self.current, 0, 0, GREEN)
+        self.assertSplitMatchesFull(0, 0)
+        self.assertSplitMatchesFull(3, 0)
+        _paint(self.below, 0, 0, GREY)
+        _paint(self.above, 0, 0, GREEN)
+        self.assertIsNotNone(self.root._split_layers)
+        self.assertNotIn(self._split_key(0, 0), self.root._split_cache)
+        self.assertIn(self._split_key(3, 0), self.root._split_cache)
+        self.assertSplitMatchesFull(0, 0)
+        self.assertSplitMatchesFull(3, 0)
+
+    def test_current_path_change(self):
+        """Selecting another layer ends the painting session"""
+        _paint(self.current, 0, 0, GREEN)
+        self.assertSplitMatchesFull(0, 0)
+        self.root.current_path = (2,)
+        self.assertIsNone(self.root._split_layers)
+        self.assertEqual(len(self.root._split_cache), 0)
+        _paint(self.below, 0, 0, GREEN)
+        self.assertEqual(
+            self.root._split_layers,
+            (self.below, [], [self.group, self.above]),
+        )
+        self.assertSplitMatchesFull(0, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
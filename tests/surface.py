@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+import gc
+
+import paths
+from lib import tiledsurface
+
+
+# Helpers:
+
+def _paint(surface, tx, ty, value):
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = value
+
+
+def _erase(surface, tx, ty):
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = 0
+    surface.remove_empty_tiles()
+
+
+def _contents(surface):
+    """Returns a copy of a surface's pixels, as {(tx, ty): array}"""
+    contents = {}
+    for pos in surface.tiledict.keys():
+        with surface.tile_request(pos[0], pos[1], readonly=True) as rgba:
+            contents[pos] = rgba.copy()
+    return contents
+
+
+def _sshot_contents(sshot):
+    """Returns a copy of a snapshot's pixels, as {(tx, ty): array}"""
+    return dict(
+        (pos, tile.rgba.copy())
+        for pos, tile in sshot.tiledict.items()
+    )
+
+
+# Test cases:
+
+class SurfaceSnapshots (unittest.TestCase):
+    """Tests snapshotting surfaces, and restoring the snapshots"""
+
+    def setUp(self):
+        self.surface = tiledsurface.MyPaintSurface()
+        for tx in range(4):
+            _paint(self.surface, tx, 0, 1000 + tx)
+
+    def assertContentsEqual(self, a, b):
+        self.assertEqual(sorted(a.keys()), sorted(b.keys()))
+        for pos in a:
+            self.assertTrue((a[pos] == b[pos]).all(),
+                            msg="Tile %r differs" % (pos,))
+
+    def _paint_erase(self):
+        _paint(self.surface, 1, 0, 2000)
+        _paint(self.surface, 1, 1, 3000)
+        _erase(self.surface, 3, 0)
+
+    def test_round_trip(self):
+        """Restoring snapshots brings back what was snapshotted"""
+        before = _contents(self.surface)
+        sshot1 = self.surface.save_snapshot()
+        self._paint_erase()
+        after = _contents(self.surface)
+        sshot2 = self.surface.save_snapshot()
+        self.surface.load_snapshot(sshot1)
+        self.assertContentsEqual(_contents(self.surface), before)
+        self.surface.load_snapshot(sshot2)
+        self.assertContentsEqual(_contents(self.surface), after)
+        self.surface.load_snapshot(sshot1)
+        self.assertContentsEqual(_contents(self.surface), before)
+
+    def test_snapshots_unaffected_by_painting(self):
+        """Painting after a snapshot doesn't change the snapshot"""
+        before = _contents(self.surface)
+        sshot = self.surface.save_snapshot()
+        self._paint_erase()
+        self.assertContentsEqual(_sshot_contents(sshot), before)
+
+    def test_many_generations(self):
+        """Each of a series of snapshots keeps its own state"""
+        expected = []
+        sshots = []
+        for i in range(6):
+            _paint(self.surface, i % 3, i // 3, 5000 + i)
+            if i == 4:
+                _erase(self.surface, 0, 0)
+            expected.append(_contents(self.surface))
+            sshots.append(self.surface.save_snapshot())
+        # Freeing some trims the generation logs the others use
+        del sshots[1], expected[1]
+        del sshots[2], expected[2]
+        gc.collect()
+        for sshot, contents in reversed(zip(sshots, expected)):
+            self.assertContentsEqual(_sshot_contents(sshot), contents)
+        for sshot, contents in zip(sshots, expected):
+            self.surface.load_snapshot(sshot)
+            self.assertContentsEqual(_contents(self.surface), contents)
+
+    def test_paint_after_restore(self):
+        """Painting after restoring an old state branches cleanly"""
+        sshot1 = self.surface.save_snapshot()
+        self._paint_erase()
+        sshot2 = self.surface.save_snapshot()
+        after = _sshot_contents(sshot2)
+        self.surface.load_snapshot(sshot1)
+        _paint(self.surface, 2, 0, 4000)
+        branched = _contents(self.surface)
+        sshot3 = self.surface.save_snapshot()
+        self.assertContentsEqual(_sshot_contents(sshot2), after)
+        self.assertContentsEqual(_sshot_contents(sshot3), branched)
+        self.assertEqual(
+            sorted(sshot1.get_changed_positions(sshot3)),
+            [(2, 0)],
+        )
+
+    def test_changed_positions(self):
+        """Changes are found between snapshots, and up to the surface"""
+        sshot1 = self.surface.save_snapshot()
+        self.assertEqual(sshot1.get_changed_positions(self.surface), set())
+        self._paint_erase()
+        expected = [(1, 0), (1, 1), (3, 0)]
+        self.assertEqual(
+            sorted(sshot1.get_changed_positions(self.surface)),
+            expected,
+        )
+        sshot2 = self.surface.save_snapshot()
+        self.assertEqual(sorted(sshot1.get_changed_positions(sshot2)),
+                         expected)
+        self.assertEqual(sorted(sshot2.get_changed_positions(sshot1)),
+                         expected)
+        self.assertEqual(sshot2.get_changed_positions(self.surface), set())
+
+    def test_changed_tiles(self):
+        """Only a snapshot's own replaced tiles are reported"""
+        sshot1 = self.surface.save_snapshot()
+        self._paint_erase()
+        changed = sshot1.get_changed_tiles(self.surface)
+        self.assertEqual(sorted(changed.keys()), [(1, 0), (3, 0)])
+        self.assertIs(changed[(1, 0)], sshot1.tiledict[(1, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
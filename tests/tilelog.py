@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+import os
+import tempfile
+import shutil
+import zlib
+
+import numpy as np
+
+import paths
+from lib import tiledsurface
+
+
+N = tiledsurface.N
+
+
+# Helpers:
+
+def _paint(surface, tx, ty, value):
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = value
+
+
+def _erase(surface, tx, ty):
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = 0
+    surface.remove_empty_tiles()
+
+
+def _run(task):
+    while task():
+        pass
+
+
+def _pixels(surface, x, y, w, h):
+    """Returns a surface's pixels in a rectangle as one array"""
+    tx0, ty0 = x // N, y // N
+    tx1, ty1 = (x + w - 1) // N, (y + h - 1) // N
+    out = np.zeros(((ty1 - ty0 + 1) * N, (tx1 - tx0 + 1) * N, 4), 'uint16')
+    for ty in range(ty0, ty1 + 1):
+        for tx in range(tx0, tx1 + 1):
+            with surface.tile_request(tx, ty, readonly=True) as rgba:
+                out[(ty-ty0)*N:(ty-ty0+1)*N, (tx-tx0)*N:(tx-tx0+1)*N] = rgba
+    ox = x - tx0 * N
+    oy = y - ty0 * N
+    return out[oy:oy+h, ox:ox+w]
+
+
+# Test cases:
+
+class TileLogFiles (unittest.TestCase):
+    """Tests writing tile logs, reading them back, and replaying them"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.surface = tiledsurface.MyPaintSurface()
+        for tx in range(3):
+            _paint(self.surface, tx, 0, 1000 + tx)
+        self.tilelog = tiledsurface.TileLog(
+            os.path.join(self.tmpdir, u"layer.tilelog"),
+            os.path.join(self.tmpdir, u"layer.png"),
+            (0, 0, 3*N, N),
+        )
+        open(self.tilelog.base_filename, "wb").close()  # the PNG, really
+        self.base = self.surface.save_snapshot()
+        self.tilelog.set_base(self.base)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _update(self):
+        """Appends the surface's changes to the log, like autosave"""
+        sshot = self.surface.save_snapshot()
+        changes = self.tilelog.get_changes(sshot)
+        if changes:
+            _run(tiledsurface.TileLogUpdateTask(self.tilelog, sshot, changes))
+        return changes
+
+    def _make_changes(self):
+        _paint(self.surface, 1, 0, 2000)
+        _paint(self.surface, 1, 1, 3000)
+        _erase(self.surface, 2, 0)
+        return self._update()
+
+    def test_changes(self):
+        """Only the painted and erased tiles are logged"""
+        self.assertEqual(self._make_changes(), [(1, 0), (1, 1), (2, 0)])
+        self.assertEqual(self._update(), [])
+        self.assertGreater(self.tilelog.size, 0)
+        self.assertFalse(self.tilelog.needs_new_base())
+
+    def test_read_back(self):
+        """Records read back hold the logged tiles' data"""
+        self._make_changes()
+        records = tiledsurface._read_tile_log(self.tilelog.filename)
+        self.assertEqual(sorted(records.keys()), [(1, 0), (1, 1), (2, 0)])
+        self.assertIsNone(records[(2, 0)])
+        data = np.frombuffer(zlib.decompress(records[(1, 1)]), 'uint16')
+        self.assertTrue((data == 3000).all())
+
+    def test_later_records_win(self):
+        """Tiles logged more than once read back as their last state"""
+        self._make_changes()
+        _paint(self.surface, 1, 0, 2500)
+        self.assertEqual(self._update(), [(1, 0)])
+        records = tiledsurface._read_tile_log(self.tilelog.filename)
+        data = np.frombuffer(zlib.decompress(records[(1, 0)]), 'uint16')
+        self.assertTrue((data == 2500).all())
+
+    def test_truncated_record_ignored(self):
+        """An interrupted update's partial record is ignored"""
+        self._make_changes()
+        size = os.path.getsize(self.tilelog.filename)
+        with open(self.tilelog.filename, "ab") as fp:
+            fp.write(b"\0" * 5)
+        records = tiledsurface._read_tile_log(self.tilelog.filename)
+        self.assertEqual(len(records), 3)
+        with open(self.tilelog.filename, "r+b") as fp:
+            fp.truncate(size - 3)
+        records = tiledsurface._read_tile_log(self.tilelog.filename)
+        self.assertEqual(sorted(records.keys()), [(1, 0), (1, 1)])
+
+    def _replay(self, x, y):
+        """Replays the log over a copy of the base PNG loaded at (x, y)"""
+        replayed = self._translated(self.base, x, y)
+        replayed.load_tile_log(self.tilelog.filename, x, y)
+        return replayed
+
+    def _translated(self, sshot, x, y):
+        """Returns a new surface with a snapshot's pixels moved by x, y"""
+        src = tiledsurface.MyPaintSurface()
+        src.load_snapshot(sshot)
+        pixels = _pixels(src, 0, 0, 3*N, 2*N)
+        dst = tiledsurface.MyPaintSurface()
+        tx0, ty0 = x // N, y // N
+        tx1, ty1 = (x + 3*N - 1) // N + 1, (y + 2*N - 1) // N + 1
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                with dst.tile_request(tx, ty, readonly=False) as rgba:
+                    for py in range(N):
+                        sy = ty*N + py - y
+                        if not 0 <= sy < 2*N:
+                            continue
+                        sx0 = tx*N - x
+                        dx0 = max(0, -sx0)
+                        dx1 = min(N, 3*N - sx0)
+                        if dx0 < dx1:
+                            rgba[py, dx0:dx1] = pixels[sy, sx0+dx0:sx0+dx1]
+        dst.remove_empty_tiles()
+        return dst
+
+    def test_replay_aligned(self):
+        """Replaying at a tile-aligned offset reproduces the surface"""
+        self._make_changes()
+        replayed = self._replay(0, 0)
+        self.assertEqual(
+            sorted(replayed.tiledict.keys()),
+            sorted(self.surface.tiledict.keys()),
+        )
+        expected = _pixels(self.surface, 0, 0, 3*N, 2*N)
+        actual = _pixels(replayed, 0, 0, 3*N, 2*N)
+        self.assertTrue((expected == actual).all())
+
+    def test_replay_unaligned(self):
+        """Replaying at an unaligned offset reproduces the surface"""
+        self._make_changes()
+        x, y = 13, -7
+        replayed = self._replay(x, y)
+        expected = _pixels(self.surface, 0, 0, 3*N, 2*N)
+        actual = _pixels(replayed, x, y, 3*N, 2*N)
+        self.assertTrue((expected == actual).all())
+
+
+class TileLogNeedsNewBase (unittest.TestCase):
+    """Tests when a new PNG and log must be written"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.surface = tiledsurface.MyPaintSurface()
+        _paint(self.surface, 0, 0, 1000)
+        self.tilelog = tiledsurface.TileLog(
+            os.path.join(self.tmpdir, u"layer.tilelog"),
+            os.path.join(self.tmpdir, u"layer.png"),
+            (0, 0, N, N),
+        )
+        open(self.tilelog.base_filename, "wb").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _log_change(self):
+        self.tilelog.set_base(self.surface.save_snapshot())
+        _paint(self.surface, 0, 0, 2000)
+        sshot = self.surface.save_snapshot()
+        changes = self.tilelog.get_changes(sshot)
+        _run(tiledsurface.TileLogUpdateTask(self.tilelog, sshot, changes))
+
+    def test_no_base(self):
+        """Logs need a base before they can be used"""
+        self.assertTrue(self.tilelog.needs_new_base())
+        self.tilelog.set_base(self.surface.save_snapshot())
+        self.assertFalse(self.tilelog.needs_new_base())
+        self.tilelog.invalidate()
+        self.assertTrue(self.tilelog.needs_new_base())
+
+    def test_missing_png(self):
+        """A deleted PNG needs rewriting"""
+        self.tilelog.set_base(self.surface.save_snapshot())
+        os.unlink(self.tilelog.base_filename)
+        self.assertTrue(self.tilelog.needs_new_base())
+
+    def test_missing_log(self):
+        """A deleted log needs a new base, but only if it had records"""
+        self.tilelog.set_base(self.surface.save_snapshot())
+        self.assertFalse(os.path.exists(self.tilelog.filename))
+        self.assertFalse(self.tilelog.needs_new_base())
+        self._log_change()
+        self.assertFalse(self.tilelog.needs_new_base())
+        os.unlink(self.tilelog.filename)
+        self.assertTrue(self.tilelog.needs_new_base())
+
+    def test_log_bigger_than_png(self):
+        """Logs which outgrow their PNG are compacted"""
+        self.tilelog.COMPACT_MIN_SIZE = 0
+        self._log_change()
+        self.assertTrue(self.tilelog.needs_new_base())
+
+
+if __name__ == "__main__":
+    unittest.main()
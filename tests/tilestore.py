@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+
+import numpy as np
+
+import paths
+from lib import tiledsurface
+
+
+N = tiledsurface.N
+TILE_BYTES = tiledsurface.TILE_BYTES
+
+
+# Helpers:
+
+def _paint(surface, tx, ty, value):
+    with surface.tile_request(tx, ty, readonly=False) as rgba:
+        rgba[...] = value
+
+
+def _contents(surface):
+    """Returns a copy of a surface's pixels, as {(tx, ty): array}"""
+    contents = {}
+    for pos in surface.tiledict.keys():
+        with surface.tile_request(pos[0], pos[1], readonly=True) as rgba:
+            contents[pos] = rgba.copy()
+    return contents
+
+
+# Test cases:
+
+class TileCompression (unittest.TestCase):
+    """Tests compressing read-only tiles in memory"""
+
+    def setUp(self):
+        self.budget = tiledsurface.tile_store.budget
+
+    def tearDown(self):
+        tiledsurface.tile_store.budget = self.budget
+
+    def _new_tiles(self, store, n):
+        tiles = []
+        for i in range(n):
+            tile = tiledsurface._Tile()
+            tile.rgba[...] = np.arange(N*N*4).reshape((N, N, 4)) + i
+            tile.readonly = True
+            store.add(tile)
+            tiles.append(tile)
+        return tiles
+
+    def test_least_recently_used(self):
+        """The least recently used tiles are compressed first"""
+        store = tiledsurface._TileStore(budget=2 * TILE_BYTES)
+        tiles = self._new_tiles(store, 4)
+        hits = store.stats.hits
+        tiles[0].rgba
+        tiles[2].rgba
+        self.assertEqual(store.stats.hits - hits, 2)
+        store.maintain()
+        self.assertEqual(
+            [t.compressed for t in tiles],
+            [False, True, False, True],
+        )
+        self.assertEqual(store.stats.uncompressed, 2)
+        self.assertEqual(store.stats.compressed, 2)
+
+    def test_round_trip(self):
+        """Compressed tiles read back unchanged"""
+        store = tiledsurface._TileStore(budget=0)
+        tiles = self._new_tiles(store, 3)
+        expected = [t.rgba.copy() for t in tiles]
+        store.maintain()
+        self.assertTrue(all(t.compressed for t in tiles))
+        for tile, rgba in zip(tiles, expected):
+            self.assertTrue((store.decompress(tile) == rgba).all())
+        self.assertEqual(store.stats.misses, 3)
+
+    def test_not_during_atomic(self):
+        """Nothing is compressed during a painting operation"""
+        store = tiledsurface._TileStore(budget=0)
+        tiles = self._new_tiles(store, 2)
+        store.begin_atomic()
+        store.maintain()
+        self.assertFalse(any(t.compressed for t in tiles))
+        store.end_atomic()
+        store.maintain()
+        self.assertTrue(all(t.compressed for t in tiles))
+
+    def test_surface_tiles(self):
+        """Snapshotted surface tiles can be compressed and restored"""
+        surface = tiledsurface.MyPaintSurface()
+        for tx in range(3):
+            _paint(surface, tx, 0, 1000 + tx)
+        before = _contents(surface)
+        sshot = surface.save_snapshot()
+        tiledsurface.tile_store.budget = 0
+        self.assertTrue(all(t.compressed for t in sshot.tiledict.values()))
+        _paint(surface, 1, 0, 2000)
+        self.assertFalse(surface.tiledict[(1, 0)].compressed)
+        surface.load_snapshot(sshot)
+        after = _contents(surface)
+        self.assertEqual(sorted(after.keys()), sorted(before.keys()))
+        for pos in before:
+            self.assertTrue((after[pos] == before[pos]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# Imports:
+
+from __future__ import division, print_function
+import unittest
+import os
+import tempfile
+import shutil
+
+import paths
+from lib import tiledsurface
+from lib import command
+import lib.layer
+
+
+N = tiledsurface.N
+TILE_BYTES = tiledsurface.TILE_BYTES
+
+
+# Helpers:
+
+def _new_stored_tile(value):
+    """Returns a read-only tile registered with the tile store"""
+    tile = tiledsurface._Tile()
+    tile.rgba[...] = value
+    tile.readonly = True
+    tiledsurface.tile_store.add(tile)
+    return tile
+
+
+class _Held (object):
+    """Stand-in for a layer snapshot holding one tile"""
+
+    def __init__(self, tile):
+        self.tile = tile
+
+    def get_tiledicts(self):
+        return [{(0, 0): self.tile}]
+
+
+class _LayerStack (object):
+    """Stand-in for the root layer stack"""
+
+    def __init__(self):
+        self.tiles = {}
+
+    def get_tiledicts(self):
+        return [self.tiles]
+
+
+class _Document (object):
+    """Stand-in for the document model"""
+
+    def __init__(self):
+        self.layer_stack = _LayerStack()
+
+
+class _Step (command.Command):
+    """Command retaining one tile's worth of pixels"""
+
+    def __init__(self, doc, value, **kwds):
+        super(_Step, self).__init__(doc, **kwds)
+        self.held = _Held(_new_stored_tile(value))
+
+    def redo(self):
+        self._update_memory_usage([self.held])
+
+    def undo(self):
+        pass
+
+
+# Test cases:
+
+class UndoHistoryLimits (unittest.TestCase):
+    """Tests trimming the undo history by memory use"""
+
+    def setUp(self):
+        self.doc = _Document()
+        self.stack = command.CommandStack(
+            memory_budget = 4 * TILE_BYTES,
+            min_steps = 2,
+        )
+
+    def _do_steps(self, n):
+        steps = [_Step(self.doc, i + 1) for i in range(n)]
+        for step in steps:
+            self.stack.do(step)
+        return steps
+
+    def test_memory_usage(self):
+        """Steps report the memory their held tiles use"""
+        steps = self._do_steps(3)
+        self.assertEqual(steps[0].get_memory_usage(), TILE_BYTES)
+        self.assertEqual(self.stack.memory_usage, 3 * TILE_BYTES)
+
+    def test_trim_to_budget(self):
+        """The oldest steps are discarded when over budget"""
+        steps = self._do_steps(10)
+        self.assertEqual(self.stack.undo_stack, steps[-4:])
+        self.assertEqual(self.stack.memory_usage, 4 * TILE_BYTES)
+
+    def test_min_steps(self):
+        """The newest steps are kept even when over budget"""
+        self.stack.memory_budget = 0
+        steps = self._do_steps(5)
+        self.assertEqual(self.stack.undo_stack, steps[-2:])
+
+    def test_maxlen(self):
+        """No more than MAXLEN steps are kept, whatever they use"""
+        self.stack.MAXLEN = 3
+        self.stack.memory_budget = 100 * TILE_BYTES
+        steps = self._do_steps(5)
+        self.assertEqual(self.stack.undo_stack, steps[-3:])
+
+    def test_budget_change_trims(self):
+        """Lowering the budget trims the existing history"""
+        updates = []
+        self.stack.stack_updated += lambda *a: updates.append(a)
+        steps = self._do_steps(4)
+        del updates[:]
+        self.stack.memory_budget = 3 * TILE_BYTES
+        self.assertEqual(self.stack.undo_stack, steps[-3:])
+        self.assertEqual(len(updates), 1)
+
+
+class _CancelledStep (_Step):
+    """Command abandoned while it's being performed"""
+
+    def redo(self):
+        self.cancelled = True
+
+
+class CancelledCommands (unittest.TestCase):
+    """Tests commands abandoned while being performed"""
+
+    def test_not_pushed(self):
+        """Cancelled commands don't become undo steps"""
+        doc = _Document()
+        stack = command.CommandStack()
+        first = _Step(doc, 1)
+        stack.do(first)
+        stack.undo()
+        stack.do(_CancelledStep(doc, 2))
+        self.assertEqual(stack.undo_stack, [])
+        self.assertEqual(stack.redo_stack, [first])
+
+
+class _CountedSpillStep (_Step):
+    """Command counting how many times it's been spilled"""
+
+    spill_count = 0
+
+    def spill(self, spill_file, exclude=()):
+        self.spill_count += 1
+        super(_CountedSpillStep, self).spill(spill_file, exclude)
+
+
+class UndoHistorySpilling (unittest.TestCase):
+    """Tests spilling older undo steps to a file"""
+
+    def setUp(self):
+        self.doc = _Document()
+        self.stack = command.CommandStack(
+            memory_budget = 2 * TILE_BYTES,
+            min_steps = 1,
+        )
+        self.tmpdir = tempfile.mkdtemp()
+        self.spill_file = tiledsurface.TileSpillFile(
+            os.path.join(self.tmpdir, u"spill.bin"),
+        )
+        self.stack.spill_file = self.spill_file
+
+    def tearDown(self):
+        self.spill_file.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_spill_instead_of_trim(self):
+        """Older steps are spilled, not discarded, and read back"""
+        steps = [_Step(self.doc, i + 1) for i in range(6)]
+        for step in steps:
+            self.stack.do(step)
+        self.assertEqual(self.stack.undo_stack, steps)
+        self.assertEqual(self.stack.memory_usage, 2 * TILE_BYTES)
+        self.assertGreater(self.spill_file.live_bytes, 0)
+        oldest = steps[0].held.tile
+        self.assertIsNone(oldest._rgba)
+        self.assertTrue((oldest.rgba == 1).all())
+
+    def test_live_tiles_stay_in_memory(self):
+        """Tiles the document still uses are never spilled"""
+        steps = [_Step(self.doc, i + 1) for i in range(4)]
+        live = steps[0].held.tile
+        self.doc.layer_stack.tiles[(0, 0)] = live
+        for step in steps:
+            self.stack.do(step)
+        self.assertEqual(self.stack.undo_stack, steps)
+        self.assertIsNotNone(live._rgba)
+        self.assertEqual(steps[0].get_memory_usage(), TILE_BYTES)
+        self.assertIsNone(steps[1].held.tile._rgba)
+
+    def test_spilled_steps_kept_over_budget(self):
+        """Spilled steps are kept while live tiles hold the budget"""
+        steps = [_Step(self.doc, i + 1) for i in range(5)]
+        self.doc.layer_stack.tiles[(0, 0)] = steps[2].held.tile
+        for step in steps:
+            self.stack.do(step)
+        self.assertEqual(self.stack.undo_stack, steps)
+        self.assertEqual(steps[0].get_memory_usage(), 0)
+        self.assertTrue((steps[0].held.tile.rgba == 1).all())
+
+    def test_steps_spilled_once(self):
+        """Steps which were already spilled aren't spilled again"""
+        steps = [_CountedSpillStep(self.doc, i + 1) for i in range(6)]
+        for step in steps:
+            self.stack.do(step)
+        self.assertEqual([s.spill_count for s in steps], [1, 1, 1, 1, 0, 0])
+
+    def test_spill_file_unused_within_budget(self):
+        """Nothing is written while the history fits the budget"""
+        self.stack.do(_Step(self.doc, 1))
+        self.stack.do(_Step(self.doc, 2))
+        self.assertEqual(self.spill_file.size, 0)
+
+
+class SnapshotMemoryUsage (unittest.TestCase):
+    """Tests estimating the memory layer snapshots retain"""
+
+    def test_changed_tiles_only(self):
+        """Only tiles replaced since the snapshot are counted"""
+        layer = lib.layer.PaintingLayer()
+        surface = layer._surface
+        for tx in range(8):
+            with surface.tile_request(tx, 0, readonly=False) as rgba:
+                rgba[...] = 1
+        before = layer.save_snapshot()
+        with surface.tile_request(3, 0, readonly=False) as rgba:
+            rgba[...] = 2
+        after = layer.save_snapshot()
+        cmd = _Step(_Document(), 0)
+        cmd._update_memory_usage([before], [after])
+        self.assertEqual(cmd.get_memory_usage(), TILE_BYTES)
+        # Worked out from the snapshot logs, without a full tiledict
+        self.assertIsNone(before.surface_sshot._tiledict)
+        cmd._update_memory_usage([before], [layer])
+        self.assertEqual(cmd.get_memory_usage(), TILE_BYTES)
+
+
+if __name__ == "__main__":
+    unittest.main()